@@ -0,0 +1,408 @@
+"""Build many target repos at once
+
+A manifest lists the target repos, one INI section per repo::
+
+    [/srv/repos/ovirt-master-el7]
+    yum-config = /etc/mkrepo/ovirt-master-el7.conf
+    custom-source = /srv/builds/ovirt-engine
+        /srv/builds/vdsm
+    repoman-config = /etc/mkrepo/repoman.conf
+
+The section name is the path of the target repo, ``yum-config`` is
+required. The union of the repoids of all the yum configs is synced
+once, then the target repos are merged in parallel.
+
+The repoids are synced per yum config, only the caches of the repoids
+of the yum config being synced are locked meanwhile. Every merge then
+locks just its own target repo (exclusively) and the caches it reads
+(shared), so merges of different target repos run concurrently.
+"""
+
+import logging
+import os
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from contextlib import ExitStack
+
+from mkrepo import cachegc
+from mkrepo import linking
+from mkrepo import merge
+from mkrepo import metrics as metrics_mod
+from mkrepo import publish
+from mkrepo import reposetup_core
+from mkrepo import reposync
+from mkrepo import sourcecache
+from mkrepo import utils
+from mkrepo import verify as verify_mod
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MERGE_JOBS = 4
+
+
+class ManifestError(Exception):
+    pass
+
+
+Build = namedtuple(
+    'Build', ('dest', 'yum_config', 'custom_source', 'repoman_config')
+)
+"""A target repo of a manifest
+
+Attributes:
+    dest(str): Path to the target repo
+    yum_config(str): Path to its yum config
+    custom_source(list of str): Its custom sources, in order
+    repoman_config(str): Path to its repoman config, if any
+"""
+
+
+def read_manifest(path):
+    """Read the target repos of a manifest
+
+    Relative paths are relative to the directory of the manifest.
+
+    Args:
+        path(str)
+
+    Returns:
+        list of Build
+
+    Raises:
+        ManifestError: If the manifest is invalid
+    """
+    cp = ConfigParser(interpolation=None)
+    try:
+        with open(path) as f:
+            cp.read_file(f)
+    except Exception as e:
+        raise ManifestError('Failed to read {}: {}'.format(path, e))
+
+    base = os.path.dirname(os.path.abspath(path))
+
+    def resolve(p):
+        return os.path.join(base, p) if p else None
+
+    builds = []
+    for section in cp.sections():
+        if not cp.has_option(section, 'yum-config'):
+            raise ManifestError(
+                'No yum-config for {} in {}'.format(section, path)
+            )
+        builds.append(
+            Build(
+                dest=resolve(section),
+                yum_config=resolve(cp.get(section, 'yum-config')),
+                custom_source=cp.get(
+                    section, 'custom-source', fallback=''
+                ).split(),
+                repoman_config=resolve(
+                    cp.get(section, 'repoman-config', fallback=None)
+                ),
+            )
+        )
+
+    if len(set(b.dest for b in builds)) != len(builds):
+        raise ManifestError('Duplicated target repos in {}'.format(path))
+
+    return builds
+
+
+def build_many(
+    builds, sync_dir, sync=True, lock_timeout=180, sync_jobs=1,
+    merge_jobs=DEFAULT_MERGE_JOBS, metrics_file=None, **kwargs
+):
+    """Sync the repoids of ``builds`` once, then build every target repo
+
+    Args:
+        builds(list of Build)
+        sync_dir(str)
+        sync(bool)
+        lock_timeout(int)
+        sync_jobs(int): Number of repoids to sync concurrently
+        merge_jobs(int): Number of target repos to merge concurrently
+        metrics_file(str): Where to write the metrics of the run
+        **kwargs: See :func:`_build_many`
+
+    Raises:
+        reposetup_core.ReposetupError: If one of the builds failed, the
+            other builds are done anyway
+    """
+    metrics = metrics_mod.Metrics() if metrics_file else metrics_mod.NULL
+    try:
+        failed = _build_many(
+            builds, sync_dir, sync, lock_timeout, sync_jobs, merge_jobs,
+            metrics=metrics, **kwargs
+        )
+    except Exception as e:
+        LOGGER.error('Failed to build {} repos'.format(len(builds)))
+        reposetup_core.debug_err(e)
+        raise reposetup_core.ReposetupError(str(e))
+    finally:
+        if metrics_file:
+            metrics.write(metrics_file)
+
+    if failed:
+        raise reposetup_core.ReposetupError(
+            'Failed to build: {}'.format(', '.join(failed))
+        )
+
+
+def _build_many(
+    builds, sync_dir, sync, lock_timeout, sync_jobs, merge_jobs,
+    metrics=metrics_mod.NULL,
+    metadata_cache_max_age=reposync.DEFAULT_CACHE_MAX_AGE,
+    metadata_cache_max_size=reposync.DEFAULT_CACHE_MAX_SIZE,
+    incremental_merge=False, link_mode=linking.COPY,
+    sync_timeout=None, merge_timeout=None,
+    sync_retries=reposync.DEFAULT_RETRY_ATTEMPTS,
+    sync_retry_backoff=reposync.DEFAULT_RETRY_BACKOFF,
+    merge_backend=merge.REPOMAN, sync_max_age=None, dedup=False,
+    cache_custom_sources=False, force_merge=False, staged=False,
+    verify=False
+):
+    """Run the batch flow
+
+    The args are the same as for :func:`reposetup_core._reposetup`
+
+    Returns:
+        list of str: The target repos that failed to build
+    """
+    reposetup_core.check_link_mode(link_mode, merge_backend)
+    repo_paths = dict(
+        (b.dest, reposetup_core.get_repo_paths(sync_dir, b.yum_config))
+        for b in builds
+    )
+    configs = _repoid_configs(builds)
+    utils.safe_mkdir(
+        *[_lock_dest(b.dest, staged) for b in builds]
+        + [p for paths in repo_paths.values() for p in paths.values()]
+    )
+
+    sync_kwargs = dict(
+        cache_max_age=metadata_cache_max_age,
+        cache_max_size=metadata_cache_max_size,
+        timeout=sync_timeout,
+        retry=reposync.RetryPolicy(
+            attempts=sync_retries, backoff=sync_retry_backoff
+        ),
+        dedup=dedup
+    )
+    failed_repoids = set()
+    if sync and configs:
+        failed_repoids = _sync_all(
+            configs, sync_dir, lock_timeout, sync_jobs, metrics,
+            sync_max_age=sync_max_age, **sync_kwargs
+        )
+    if verify and configs:
+        failed_repoids.update(
+            _verify_all(
+                OrderedDict(
+                    (r, c) for r, c in configs.items()
+                    if r not in failed_repoids
+                ),
+                sync_dir, lock_timeout, metrics,
+                dict(sync_kwargs, jobs=sync_jobs, metrics=metrics)
+                if sync else None
+            )
+        )
+
+    failed = []
+    to_merge = []
+    for b in builds:
+        missing = failed_repoids.intersection(repo_paths[b.dest])
+        if missing:
+            LOGGER.error(
+                'Not building {}, failed to sync or verify: {}'.format(
+                    b.dest, ', '.join(sorted(missing))
+                )
+            )
+            failed.append(b.dest)
+        else:
+            to_merge.append(b)
+
+    def merge_one(build):
+        try:
+            _merge(
+                build, repo_paths[build.dest], lock_timeout, metrics,
+                sync_dir=sync_dir,
+                cache_custom_sources=cache_custom_sources,
+                force=force_merge,
+                staged=staged,
+                incremental=incremental_merge,
+                link_mode=link_mode,
+                timeout=merge_timeout,
+                backend=merge_backend
+            )
+            LOGGER.info('Successfully created repo {}'.format(build.dest))
+            return None
+        except Exception as e:
+            LOGGER.error('Failed to create repo {}: {}'.format(build.dest, e))
+            reposetup_core.debug_err(e)
+            return build.dest
+
+    with metrics.phase('merge-all'):
+        with ThreadPoolExecutor(max_workers=merge_jobs) as executor:
+            failed.extend(d for d in executor.map(merge_one, to_merge) if d)
+
+    return failed
+
+
+def _repoid_configs(builds):
+    """Map every repoid to the yum config to sync it with
+
+    A repoid can be shared by several yum configs only if both its
+    section and the ``[main]`` section of the configs are the same.
+
+    Raises:
+        ManifestError: If a repoid is defined differently in two configs
+    """
+    configs = OrderedDict()
+    definitions = {}
+    for b in builds:
+        for repoid, definition in _repo_definitions(b.yum_config).items():
+            if repoid not in configs:
+                configs[repoid] = b.yum_config
+                definitions[repoid] = definition
+            elif definitions[repoid] != definition:
+                raise ManifestError(
+                    'Repoid {} is defined differently in {} and {}'.format(
+                        repoid, configs[repoid], b.yum_config
+                    )
+                )
+
+    return configs
+
+
+def _repo_definitions(yum_config):
+    cp = ConfigParser(interpolation=None)
+    with open(yum_config) as f:
+        cp.read_file(f)
+
+    main = dict(cp.items('main')) if cp.has_section('main') else {}
+    return OrderedDict(
+        (section, (main, dict(cp.items(section))))
+        for section in cp.sections()
+        if section != 'main'
+    )
+
+
+def _sync_all(
+    configs, sync_dir, lock_timeout, jobs, metrics, sync_max_age=None,
+    **kwargs
+):
+    """Sync every repoid of ``configs`` once
+
+    The repoids of every yum config are locked and synced in turn, their
+    freshness is checked once their caches are locked
+    (see :func:`reposetup_core.lock_stale`).
+
+    Returns:
+        set of str: The repoids that failed to sync
+    """
+    groups = OrderedDict()
+    for repoid, yum_config in configs.items():
+        groups.setdefault(yum_config, OrderedDict())[repoid] = os.path.join(
+            sync_dir, repoid
+        )
+
+    failed = set()
+    for yum_config, repoid_to_path in groups.items():
+        paths = list(repoid_to_path.values())
+        with ExitStack() as stack:
+            with metrics.phase('lock'):
+                locks = stack.enter_context(
+                    utils.LockFiles(
+                        [] if sync_max_age is not None else paths,
+                        shared_paths=paths,
+                        timeout=lock_timeout,
+                        lock_name='mkrepo.lock'
+                    )
+                )
+            to_sync, checksums = list(repoid_to_path.keys()), {}
+            if sync_max_age is not None:
+                to_sync, checksums = reposetup_core.lock_stale(
+                    locks, yum_config, sync_dir, repoid_to_path,
+                    sync_max_age, metrics=metrics
+                )
+            if not to_sync:
+                continue
+
+            cachegc.touch([repoid_to_path[r] for r in to_sync])
+            with metrics.phase('sync'):
+                try:
+                    reposetup_core.do_sync(
+                        yum_config, sync_dir, to_sync, jobs=jobs,
+                        metrics=metrics, repomd_checksums=checksums,
+                        **kwargs
+                    )
+                except reposync.ReposyncError as e:
+                    failed.update(e.repoids)
+
+    return failed
+
+
+def _verify_all(configs, sync_dir, lock_timeout, metrics, sync_kwargs):
+    """Verify every repoid of ``configs`` once
+
+    See :func:`reposetup_core.verify_caches`
+
+    Returns:
+        set of str: The repoids that have corrupt RPMs, or that failed to
+            sync again
+    """
+    groups = OrderedDict()
+    for repoid, yum_config in configs.items():
+        groups.setdefault(yum_config, []).append(repoid)
+
+    paths = [os.path.join(sync_dir, r) for r in configs]
+    failed = set()
+    with utils.LockFiles(
+        paths, timeout=lock_timeout, lock_name='mkrepo.lock'
+    ):
+        for yum_config, repoids in groups.items():
+            try:
+                reposetup_core.verify_caches(
+                    yum_config, sync_dir, repoids, sync_kwargs,
+                    metrics=metrics
+                )
+            except (verify_mod.VerifyError, reposync.ReposyncError) as e:
+                failed.update(e.repoids)
+
+    return failed
+
+
+def _lock_dest(dest, staged):
+    return publish.generations_dir(dest) if staged else dest
+
+
+def _merge(
+    build, repo_paths, lock_timeout, metrics, sync_dir,
+    cache_custom_sources=False, staged=False, **kwargs
+):
+    cache_paths = list(repo_paths.values())
+    custom_source, source_paths = build.custom_source, []
+    if cache_custom_sources:
+        custom_source, source_paths = sourcecache.resolve(
+            sync_dir, custom_source, lock_timeout=lock_timeout
+        )
+
+    with utils.LockFiles(
+        **reposetup_core.get_lock_plan(
+            _lock_dest(build.dest, staged), cache_paths, False, lock_timeout,
+            source_paths=source_paths
+        )
+    ):
+        cachegc.touch(cache_paths + source_paths)
+        reposetup_core.merge_if_changed(
+            reposetup_core.merge_sources(custom_source, cache_paths),
+            build.dest,
+            build.yum_config,
+            build.repoman_config,
+            staged=staged,
+            lock_timeout=lock_timeout,
+            cache_dirs=cache_paths + source_paths,
+            metrics=metrics,
+            **kwargs
+        )
@@ -0,0 +1,254 @@
+"""A content-addressed store for the RPMs of the cache
+
+Many repoids (base/updates variants, per-release copies) contain
+byte-identical RPMs. The blob store keeps a single copy of every RPM,
+under ``<sync_dir>/.blobs/sha256/<xx>/<sha256>``, and the RPMs in the
+per-repoid dirs are hardlinks to it.
+
+RPMs are added to the store by :func:`dedup`, which replaces the
+duplicates with links. Before a repoid is synced, :func:`prelink` links
+the RPMs that are already in the store into the repoid's dir, so
+reposync doesn't download them again.
+"""
+
+import bz2
+import errno
+import gzip
+import logging
+import lzma
+import os
+from collections import namedtuple
+from xml.etree import ElementTree
+
+from mkrepo import linking
+from mkrepo import rpmindex
+from mkrepo import utils
+
+LOGGER = logging.getLogger(__name__)
+
+BLOBS_DIR = '.blobs'
+ALGORITHM = 'sha256'
+DEFAULT_LOCK_TIMEOUT = 180
+
+_COMMON_NS = '{http://linux.duke.edu/metadata/common}'
+
+
+DedupReport = namedtuple('DedupReport', ('files', 'linked', 'reclaimed'))
+"""The result of :func:`dedup`
+
+Attributes:
+    files(int): Number of RPMs that were checked
+    linked(int): Number of RPMs that were replaced with a link to a blob
+    reclaimed(int): Bytes freed by replacing RPMs with links
+"""
+
+
+PrimaryPackage = namedtuple('PrimaryPackage', ('href', 'sha256', 'size'))
+"""A package of a repo's primary metadata
+
+Attributes:
+    href(str): Its path, relative to the repo
+    sha256(str): Its checksum
+    size(int): Its size in bytes
+"""
+
+
+class BlobStore(object):
+    """The blob store of a ``sync_dir``
+
+    Attributes:
+        root(str): Where the blobs are stored
+    """
+
+    def __init__(self, sync_dir):
+        self.root = os.path.join(sync_dir, BLOBS_DIR, ALGORITHM)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def lock(self, shared=True, timeout=DEFAULT_LOCK_TIMEOUT):
+        """Lock the store
+
+        Blobs are added and linked under a shared lock, and removed
+        under an exclusive one (see :mod:`mkrepo.cachegc`).
+
+        Returns:
+            utils.LockFiles
+        """
+        utils.safe_mkdir(self.root)
+        return utils.LockFiles(
+            [] if shared else [self.root],
+            timeout=timeout,
+            lock_name='mkrepo.lock',
+            shared_paths=[self.root] if shared else [],
+        )
+
+    def store(self, path, digest):
+        """Make ``path`` a link to the blob of ``digest``
+
+        If there is no such blob yet, ``path`` becomes the blob.
+
+        Args:
+            path(str): An RPM whose checksum is ``digest``
+            digest(str)
+
+        Returns:
+            tuple: If ``path`` was replaced with a link, and the number of
+                bytes this freed.
+        """
+        blob = self.path(digest)
+        utils.safe_mkdir(os.path.dirname(blob))
+        try:
+            os.link(path, blob)
+            return False, 0
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        st = os.stat(path)
+        blob_st = os.stat(blob)
+        if (st.st_dev, st.st_ino) == (blob_st.st_dev, blob_st.st_ino):
+            return False, 0
+        if st.st_size != blob_st.st_size:
+            LOGGER.warning(
+                'Size of {} does not match its blob {}'.format(path, blob)
+            )
+            return False, 0
+
+        method = linking.link_or_copy(blob, path, linking.HARDLINK)
+        if method != linking.HARDLINK:
+            return False, 0
+
+        return True, st.st_size if st.st_nlink == 1 else 0
+
+    def link(self, digest, dst):
+        """Create ``dst`` as a link to the blob of ``digest``
+
+        Returns:
+            bool: False if there is no such blob
+        """
+        blob = self.path(digest)
+        if not os.path.isfile(blob):
+            return False
+
+        utils.safe_mkdir(os.path.dirname(dst))
+        method = linking.link_or_copy(blob, dst, linking.HARDLINK)
+        return method == linking.HARDLINK
+
+
+def dedup(sync_dir, repo_paths):
+    """Replace the duplicated RPMs of ``repo_paths`` with links to blobs
+
+    The checksums are taken from the :class:`rpmindex.RpmIndex` of every
+    repo, so only RPMs that changed since the last time are read.
+
+    Args:
+        sync_dir(str): The sync dir that holds the blob store
+        repo_paths(list of str): Dirs of repoids in ``sync_dir``
+
+    Returns:
+        DedupReport
+    """
+    store = BlobStore(sync_dir)
+    files, linked, reclaimed = 0, 0, 0
+    for repo_path in repo_paths:
+        with rpmindex.RpmIndex(repo_path) as index, store.lock():
+            index.refresh()
+            for rpm in index.rpms():
+                files += 1
+                digest = index.checksum(rpm)
+                was_linked, freed = store.store(
+                    os.path.join(repo_path, rpm.path), digest
+                )
+                if was_linked:
+                    linked += 1
+                    reclaimed += freed
+                    index.replaced(rpm, digest)
+
+    report = DedupReport(files, linked, reclaimed)
+    LOGGER.info(
+        'Dedup of {} RPMs: {} linked to blobs, {} bytes reclaimed'.format(
+            *report
+        )
+    )
+    return report
+
+
+def prelink(sync_dir, repo_path, packages):
+    """Link the ``packages`` that are in the blob store into ``repo_path``
+
+    Args:
+        sync_dir(str): The sync dir that holds the blob store
+        repo_path(str): Dir of a repoid in ``sync_dir``
+        packages(iterable of PrimaryPackage): The packages of the repoid
+
+    Returns:
+        int: Number of RPMs that were linked
+    """
+    store = BlobStore(sync_dir)
+    linked = 0
+    with store.lock():
+        for pkg in packages:
+            dst = os.path.normpath(os.path.join(repo_path, pkg.href))
+            if not dst.startswith(repo_path + os.sep) or os.path.exists(dst):
+                continue
+            if store.link(pkg.sha256, dst):
+                linked += 1
+
+    if linked:
+        LOGGER.info(
+            'Linked {} RPMs from the blob store into {}'.format(
+                linked, repo_path
+            )
+        )
+    return linked
+
+
+def primary_location(repomd):
+    """Get the href of the primary metadata from a repomd.xml file object"""
+    for data in ElementTree.parse(repomd).getroot():
+        if data.get('type') == 'primary':
+            return data.find(
+                '{http://linux.duke.edu/metadata/repo}location'
+            ).get('href')
+
+    return None
+
+
+def read_primary(primary, href=''):
+    """Read the packages of a primary metadata file object
+
+    Args:
+        primary(file): primary.xml, possibly compressed
+        href(str): Where ``primary`` comes from, to detect its compression
+
+    Returns:
+        list of PrimaryPackage: The packages that have a sha256 checksum
+    """
+    if href.endswith('.gz'):
+        primary = gzip.GzipFile(fileobj=primary)
+    elif href.endswith('.xz'):
+        primary = lzma.LZMAFile(primary)
+    elif href.endswith('.bz2'):
+        primary = bz2.BZ2File(primary)
+
+    packages = []
+    for _, elem in ElementTree.iterparse(primary):
+        if elem.tag != _COMMON_NS + 'package':
+            continue
+        checksum = elem.find(_COMMON_NS + 'checksum')
+        location = elem.find(_COMMON_NS + 'location')
+        size = elem.find(_COMMON_NS + 'size')
+        if (
+            checksum is not None and location is not None
+            and checksum.get('type') == ALGORITHM
+        ):
+            packages.append(
+                PrimaryPackage(
+                    location.get('href'), checksum.text.strip(),
+                    int(size.get('package')) if size is not None else None
+                )
+            )
+        elem.clear()
+
+    return packages
@@ -0,0 +1,252 @@
+"""Garbage collection of the RPM cache
+
+Every build records when it last used each of its repoids, in
+``<sync_dir>/<repoid>/.mkrepo/last-used`` (see :func:`touch`).
+:func:`collect` keeps the cache under a byte budget:
+
+1. Blobs that no repoid links to anymore are removed
+   (see :mod:`mkrepo.blobstore`).
+2. If the cache is still over the budget, the least recently used
+   repoids are evicted, one by one, until it fits. The RPMs, the index,
+   the metadata cache and the sync stamp of an evicted repoid are
+   removed, only its dir and its lock file are kept. The cached custom
+   sources (see :mod:`mkrepo.sourcecache`) are evicted the same way.
+
+Eviction is per repoid only: the RPMs of a repoid that is kept are never
+evicted one by one. Every build of a repoid merges all of its RPMs, so
+none of them is less recently used than the others, and reposync's
+``--delete`` already removes the ones that are gone upstream. The only
+per-package eviction is of the orphan blobs.
+
+A repoid is evicted only if its ``mkrepo.lock`` can be taken
+exclusively right away, so a repoid that is used by a running build is
+never evicted. The blob store is locked exclusively while blobs are
+removed.
+"""
+
+import errno
+import logging
+import os
+import shutil
+import time
+from collections import namedtuple
+
+from mkrepo import blobstore
+from mkrepo import reposync
+from mkrepo import sourcecache
+from mkrepo import utils
+
+LOGGER = logging.getLogger(__name__)
+
+LAST_USED = 'last-used'
+LOCK_NAME = 'mkrepo.lock'
+
+
+GcReport = namedtuple(
+    'GcReport', ('before', 'after', 'evicted', 'orphan_blobs')
+)
+"""The result of :func:`collect`
+
+Attributes:
+    before(int): Size of the cache in bytes before the collection
+    after(int): Size of the cache in bytes after the collection
+    evicted(list of str): The repoids that were evicted
+    orphan_blobs(int): Number of blobs that were removed
+"""
+
+
+def touch(repo_paths):
+    """Record that a build used ``repo_paths`` now"""
+    for repo_path in repo_paths:
+        path = os.path.join(repo_path, utils.STATE_DIR, LAST_USED)
+        utils.safe_mkdir(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('{}\n'.format(time.time()))
+
+
+def last_used(repo_path):
+    """When a build last used ``repo_path``, 0 if never"""
+    try:
+        return os.stat(
+            os.path.join(repo_path, utils.STATE_DIR, LAST_USED)
+        ).st_mtime
+    except OSError:
+        return 0
+
+
+def usage(sync_dir):
+    """Size in bytes of ``sync_dir``, counting hardlinked files once"""
+    seen = set()
+    total = 0
+    for dirpath, _, filenames in os.walk(sync_dir):
+        for f in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, f))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_size
+
+    return total
+
+
+def collect(
+    sync_dir, budget, keep=(), lock_timeout=blobstore.DEFAULT_LOCK_TIMEOUT
+):
+    """Shrink the cache in ``sync_dir`` to ``budget`` bytes
+
+    Whole repoids are evicted, not single RPMs, so the cache may stay
+    over ``budget`` if the repoids that can't be evicted are bigger.
+
+    Args:
+        sync_dir(str)
+        budget(int): Max size of the cache in bytes
+        keep(list of str): Repoids, or cached custom sources relative to
+            ``sync_dir``, that must not be evicted
+        lock_timeout(float): Max seconds to wait for the lock of the
+            blob store
+
+    Returns:
+        GcReport
+    """
+    before = usage(sync_dir)
+    store = blobstore.BlobStore(sync_dir)
+    with store.lock(shared=False, timeout=lock_timeout):
+        orphans, _ = _remove_orphan_blobs(store)
+        size = usage(sync_dir)
+
+        evicted = []
+        keep = set(keep)
+        names = repoids(sync_dir) + [
+            os.path.relpath(p, sync_dir)
+            for p in sourcecache.entries(sync_dir)
+        ]
+        candidates = sorted(
+            (last_used(os.path.join(sync_dir, name)), name)
+            for name in names
+            if name not in keep
+            and not _is_empty(os.path.join(sync_dir, name))
+        )
+        for _, name in candidates:
+            if size <= budget:
+                break
+            freed = _evict(sync_dir, name)
+            if freed is None:
+                continue
+            removed, blobs_freed = _remove_orphan_blobs(store)
+            orphans += removed
+            size -= freed + blobs_freed
+            evicted.append(name)
+
+    report = GcReport(before, usage(sync_dir), evicted, orphans)
+    LOGGER.info(
+        'Cache {} shrunk from {} to {} bytes, evicted {} repoids '
+        'and {} blobs'.format(
+            sync_dir, report.before, report.after, len(report.evicted),
+            report.orphan_blobs
+        )
+    )
+    if report.after > budget:
+        LOGGER.warning(
+            'Cache {} is still bigger than {} bytes'.format(sync_dir, budget)
+        )
+    return report
+
+
+def repoids(sync_dir):
+    """The repoids that have a dir in ``sync_dir``"""
+    return [
+        name for name in sorted(os.listdir(sync_dir))
+        if not name.startswith('.')
+        and os.path.isdir(os.path.join(sync_dir, name))
+    ]
+
+
+def _is_empty(repo_path):
+    return not set(os.listdir(repo_path)) - set([LOCK_NAME])
+
+
+def _evict(sync_dir, repoid):
+    """Remove everything of ``repoid`` but its dir and lock file
+
+    ``repoid`` may also be a cached custom source, relative to
+    ``sync_dir``.
+
+    Returns:
+        int: The bytes freed, not counting blobs, or None if the repoid
+            is in use
+    """
+    repo_path = os.path.join(sync_dir, repoid)
+    lock = utils.Flock(
+        os.path.join(repo_path, LOCK_NAME), readonly=False, blocking=False
+    )
+    try:
+        lock.acquire()
+    except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        LOGGER.info('{} is in use, not evicting it'.format(repoid))
+        return None
+
+    try:
+        LOGGER.info('Evicting {} from {}'.format(repoid, sync_dir))
+        freed = _exclusive_size(repo_path)
+        for name in os.listdir(repo_path):
+            path = os.path.join(repo_path, name)
+            if name == LOCK_NAME:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+
+        if not repoid.startswith(sourcecache.CACHE_DIR + os.sep):
+            cache = reposync.MetadataCache(sync_dir)
+            freed += _exclusive_size(cache.path(repoid))
+            cache.clear(repoid)
+            reposync.drop_stamp(sync_dir, repoid)
+    finally:
+        lock.release()
+
+    return freed
+
+
+def _exclusive_size(path):
+    """Bytes of the files under ``path`` that aren't linked elsewhere"""
+    inodes = {}
+    for dirpath, _, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, f))
+            except OSError:
+                continue
+            links, _, size = inodes.get(
+                (st.st_dev, st.st_ino), (0, st.st_nlink, st.st_size)
+            )
+            inodes[(st.st_dev, st.st_ino)] = (links + 1, st.st_nlink, size)
+
+    return sum(
+        size for links, nlink, size in inodes.values() if links >= nlink
+    )
+
+
+def _remove_orphan_blobs(store):
+    """Remove the blobs that no repoid links to
+
+    Returns:
+        tuple: Number of removed blobs and bytes freed
+    """
+    removed, freed = 0, 0
+    for dirpath, _, filenames in os.walk(store.root):
+        for f in filenames:
+            path = os.path.join(dirpath, f)
+            if f == LOCK_NAME:
+                continue
+            st = os.lstat(path)
+            if st.st_nlink == 1:
+                os.unlink(path)
+                removed += 1
+                freed += st.st_size
+
+    return removed, freed
@@ -1,21 +1,46 @@
 # -*- coding: utf-8 -*-
 
-"""Console script for mkrepo."""
+"""Console script for mkrepo.
+
+mkrepo runs thousands of times a day, so this module only imports
+click and :mod:`mkrepo.defaults`: the modules of a command are imported
+when it is invoked.
+"""
 from __future__ import print_function
 
 import click
-from pkg_resources import get_distribution
 import logging
+import os
 import sys
+from functools import partial
 from textwrap import dedent
 
-from mkrepo import reposetup_core
+from mkrepo import defaults
 
 
 LOGGER = logging.getLogger(__name__)
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 
+def _parse_size(ctx, param, value):
+    if value is None:
+        return None
+    from mkrepo import utils
+    try:
+        return utils.parse_size(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param=param)
+
+
+def _check_merge_backend(merge_backend, link_mode, pipeline=False):
+    from mkrepo import reposetup_core
+    try:
+        reposetup_core.check_link_mode(link_mode, merge_backend)
+        reposetup_core.check_pipeline(pipeline, merge_backend)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+
 @click.group(context_settings=CONTEXT_SETTINGS)
 @click.option(
     '--log-level', '-l',
@@ -37,6 +62,233 @@ def cli(log_level):
     metavar='<lock-timeout>',
     help='Time in seconds to wait for a lock for all the required repos'
 )
+@click.option(
+    '--sync-jobs',
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    metavar='<sync-jobs>',
+    help='Number of repoids to sync concurrently'
+)
+@click.option(
+    '--metadata-cache-max-age',
+    type=click.IntRange(min=0),
+    default=7 * 24 * 60 * 60,
+    show_default=True,
+    metavar='<seconds>',
+    help='Evict the reposync metadata cache of a repoid after '
+         'that many seconds'
+)
+@click.option(
+    '--metadata-cache-max-size',
+    callback=_parse_size,
+    default='1G',
+    show_default=True,
+    metavar='<size>',
+    help='Evict the reposync metadata cache of a repoid when it gets '
+         'bigger than that (e.g 512M, 1G)'
+)
+@click.option(
+    '--incremental-merge/--full-merge',
+    default=False,
+    show_default=True,
+    help=dedent(
+        """
+        Only add, replace or remove the RPMs that changed in the sources
+        since the last merge into the target repo, instead of merging
+        all the sources again. A full merge is still done when a source
+        has filters other than 'only-missing', e.g ':latest'. Note that
+        with '--merge-backend repoman', every repoman add regenerates
+        the repodata from scratch, the repodata is updated incrementally
+        only with '--merge-backend builtin', or when packages were only
+        removed.
+        """
+    )
+)
+@click.option(
+    '--link-mode',
+    type=click.Choice(['copy', 'hardlink', 'reflink', 'auto']),
+    default='copy',
+    show_default=True,
+    help=dedent(
+        """
+        How to store RPMs from the RPM cache in the target repo.
+        'hardlink' and 'reflink' fall back to a copy when the
+        filesystem doesn't allow it, 'auto' tries a reflink,
+        then a hardlink, then a copy. Only 'copy' is supported with
+        '--merge-backend repoman', as repoman always copies the RPMs.
+        Note that with hardlinks, RPMs changed in place in the target
+        repo are changed in the RPM cache as well.
+        """
+    )
+)
+@click.option(
+    '--merge-backend',
+    type=click.Choice(['repoman', 'builtin']),
+    default='repoman',
+    show_default=True,
+    help=dedent(
+        """
+        How to build the target repo. 'builtin' resolves the packages
+        in-process and runs createrepo_c instead of repoman, it supports
+        only local sources and ignores --repoman-config and
+        --incremental-merge.
+        """
+    )
+)
+@click.option(
+    '--sync-timeout',
+    type=click.FloatRange(min=0),
+    metavar='<seconds>',
+    help='Terminate a reposync run that takes longer than that',
+)
+@click.option(
+    '--merge-timeout',
+    type=click.FloatRange(min=0),
+    metavar='<seconds>',
+    help='Terminate a repoman run that takes longer than that',
+)
+@click.option(
+    '--metrics-file',
+    type=click.Path(dir_okay=False, writable=True, resolve_path=True),
+    metavar='<metrics-file>',
+    help=dedent(
+        """
+        Write a JSON report with the duration of every phase, of every
+        reposync and repoman run (with their CPU time and max RSS), and
+        the RPMs added and removed per repo.
+        """
+    )
+)
+@click.option(
+    '--sync-retries',
+    type=click.IntRange(min=1),
+    default=3,
+    show_default=True,
+    metavar='<attempts>',
+    help='Max number of reposync runs for a repoid',
+)
+@click.option(
+    '--sync-retry-backoff',
+    type=click.FloatRange(min=0),
+    default=5,
+    show_default=True,
+    metavar='<seconds>',
+    help='Seconds to wait before the first reposync retry, '
+         'doubled for every retry',
+)
+@click.option(
+    '--sync-max-age',
+    type=click.FloatRange(min=0),
+    metavar='<seconds>',
+    help=dedent(
+        """
+        Skip the sync of a repoid that was synced less than that many
+        seconds ago, or whose upstream repomd.xml didn't change since
+        its last sync. By default, every repoid is synced.
+        """
+    )
+)
+@click.option(
+    '--dedup/--no-dedup',
+    default=False,
+    show_default=True,
+    help=dedent(
+        """
+        Store the synced RPMs once in a content-addressed store under
+        the sync dir, and hardlink them into the repoid dirs. RPMs that
+        are already in the store are linked before reposync runs, so
+        they aren't downloaded again.
+        """
+    )
+)
+@click.option(
+    '--staged/--in-place',
+    default=False,
+    show_default=True,
+    help=dedent(
+        """
+        Build the target repo in a new generation, populated with
+        hardlinks from the current one, and publish it by atomically
+        swapping <dest>, which becomes a symlink, so its consumers never
+        see a half-written repo. The generations are kept next to
+        <dest>, in .<name>.generations. The first staged build of an
+        existing plain dir <dest> is not atomic: <dest> is missing
+        between its move into the generations and the creation of the
+        symlink.
+        """
+    )
+)
+@click.option(
+    '--force-merge',
+    is_flag=True,
+    help=dedent(
+        """
+        Merge even if nothing changed since the last build of the target
+        repo. By default, the merge is skipped if the yum config, the
+        repoman config, the sources and their RPMs, and the target repo
+        itself didn't change since the last build.
+        """
+    )
+)
+@click.option(
+    '--pipeline/--no-pipeline',
+    default=False,
+    show_default=True,
+    help=dedent(
+        """
+        Merge every repoid as soon as it is synced, in the order of the
+        yum config, instead of waiting for all of them, and release the
+        lock of its cache dir once merged. If a repoid fails to sync,
+        the repoids after it are not merged, use with --staged to keep
+        <dest> intact. Pipelined merges are never incremental, and never
+        skipped. Requires --merge-backend builtin, which generates the
+        repodata once after the last repoid, repoman would generate it
+        after every repoid.
+        """
+    )
+)
+@click.option(
+    '--verify/--no-verify',
+    default=False,
+    show_default=True,
+    help=dedent(
+        """
+        Before merging, verify the RPMs of the cache against the
+        checksums of their repos (see `mkrepo verify`). The corrupt RPMs
+        are removed and their repoids are synced again, unless
+        --skip-sync is given, the build fails if corrupt RPMs are left.
+        """
+    )
+)
+@click.option(
+    '--cache-custom-sources/--no-cache-custom-sources',
+    default=False,
+    show_default=True,
+    help=dedent(
+        """
+        Keep a local copy of every local dir, RPM URL and yum repo URL
+        of the custom sources under the sync dir, and merge it instead
+        of the source. A copy is refreshed only when the RPMs of its
+        dir, or the ETag/Last-Modified of its URL, changed.
+        """
+    )
+)
+@click.option(
+    '--gc-budget',
+    callback=_parse_size,
+    metavar='<size>',
+    help='Once the build is done, evict the least recently used repoids '
+         'until the RPM cache is smaller than that (e.g 50G), '
+         'see `mkrepo gc`',
+)
+@click.option(
+    '--server',
+    type=click.Path(dir_okay=False),
+    metavar='<socket>',
+    help='Send the job to the `mkrepo serve` daemon listening on '
+         '<socket> and wait for it, instead of running it locally',
+)
 @click.option(
     '--custom-source',
     type=str,
@@ -89,35 +341,390 @@ def cli(log_level):
 )
 @click.option(
     '--dest',
-    type=click.Path(dir_okay=True, resolve_path=True),
+    type=click.Path(dir_okay=True),
     required=True,
     metavar='<dest>',
     help='Where to create the repo',
+    # Not resolved, a staged <dest> is a symlink to its generation
+    callback=lambda ctx, param, value: os.path.abspath(value),
 )
 def reposetup(
     dest, sync_dir, sync, yum_config,
-    repoman_config, custom_source, lock_timeout
+    repoman_config, custom_source, lock_timeout, sync_jobs,
+    metadata_cache_max_age, metadata_cache_max_size, incremental_merge,
+    link_mode, sync_timeout, merge_timeout, metrics_file,
+    sync_retries, sync_retry_backoff, merge_backend, sync_max_age, dedup,
+    cache_custom_sources, staged, force_merge, pipeline, verify, gc_budget,
+    server
 ):
     """Run the main flow"""
+    _check_merge_backend(merge_backend, link_mode, pipeline)
+    params = dict(
+        dest=dest,
+        sync_dir=sync_dir,
+        sync=sync,
+        yum_config=yum_config,
+        repoman_config=repoman_config,
+        custom_source=list(custom_source),
+        lock_timeout=lock_timeout,
+        sync_jobs=sync_jobs,
+        metadata_cache_max_age=metadata_cache_max_age,
+        metadata_cache_max_size=metadata_cache_max_size,
+        incremental_merge=incremental_merge,
+        link_mode=link_mode,
+        sync_timeout=sync_timeout,
+        merge_timeout=merge_timeout,
+        metrics_file=metrics_file,
+        sync_retries=sync_retries,
+        sync_retry_backoff=sync_retry_backoff,
+        merge_backend=merge_backend,
+        sync_max_age=sync_max_age,
+        dedup=dedup,
+        cache_custom_sources=cache_custom_sources,
+        force_merge=force_merge,
+        staged=staged,
+        pipeline=pipeline,
+        verify=verify,
+        gc_budget=gc_budget
+    )
+    if server:
+        from mkrepo import server as server_mod
+        run, errors = (
+            partial(server_mod.request, server, 'reposetup'),
+            server_mod.ServerError
+        )
+    else:
+        from mkrepo import reposetup_core
+        run, errors = reposetup_core.reposetup, reposetup_core.ReposetupError
+
+    try:
+        run(**params)
+    except errors as e:
+        LOGGER.error('Failed to run reposetup: {}'.format(str(e)))
+        sys.exit(1)
+
+
+@cli.command('build-many')
+@click.option(
+    '--lock-timeout',
+    type=int,
+    default=180,
+    show_default=True,
+    metavar='<lock-timeout>',
+    help='Time in seconds to wait for the locks of every phase'
+)
+@click.option(
+    '--sync-jobs',
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    metavar='<sync-jobs>',
+    help='Number of repoids to sync concurrently'
+)
+@click.option(
+    '--merge-jobs',
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    metavar='<merge-jobs>',
+    help='Number of target repos to merge concurrently'
+)
+@click.option(
+    '--sync-max-age',
+    type=click.FloatRange(min=0),
+    metavar='<seconds>',
+    help='See `mkrepo reposetup --help`',
+)
+@click.option(
+    '--incremental-merge/--full-merge',
+    default=False,
+    show_default=True,
+    help='See `mkrepo reposetup --help`',
+)
+@click.option(
+    '--link-mode',
+    type=click.Choice(['copy', 'hardlink', 'reflink', 'auto']),
+    default='copy',
+    show_default=True,
+    help='See `mkrepo reposetup --help`',
+)
+@click.option(
+    '--merge-backend',
+    type=click.Choice(['repoman', 'builtin']),
+    default='repoman',
+    show_default=True,
+    help='See `mkrepo reposetup --help`',
+)
+@click.option(
+    '--dedup/--no-dedup',
+    default=False,
+    show_default=True,
+    help='See `mkrepo reposetup --help`',
+)
+@click.option(
+    '--cache-custom-sources/--no-cache-custom-sources',
+    default=False,
+    show_default=True,
+    help='See `mkrepo reposetup --help`',
+)
+@click.option(
+    '--force-merge',
+    is_flag=True,
+    help='See `mkrepo reposetup --help`',
+)
+@click.option(
+    '--staged/--in-place',
+    default=False,
+    show_default=True,
+    help='See `mkrepo reposetup --help`',
+)
+@click.option(
+    '--verify/--no-verify',
+    default=False,
+    show_default=True,
+    help='See `mkrepo reposetup --help`',
+)
+@click.option(
+    '--metrics-file',
+    type=click.Path(dir_okay=False, writable=True, resolve_path=True),
+    metavar='<metrics-file>',
+    help='Write a JSON report of the run',
+)
+@click.option(
+    '--sync/--skip-sync',
+    default=True,
+    show_default=True,
+    help='Sync RPM cache or not',
+)
+@click.option(
+    '--sync-dir',
+    type=click.Path(dir_okay=True, resolve_path=True),
+    default='/var/cache/mkrepo',
+    show_default=True,
+    metavar='<sync-dir>',
+    help='Where to store RPM cache'
+)
+@click.argument(
+    'manifest',
+    type=click.Path(exists=True, dir_okay=False, resolve_path=True),
+)
+def build_many(manifest, sync_dir, sync, lock_timeout, **kwargs):
+    """Build every target repo of MANIFEST
+
+    MANIFEST is an INI file with a section per target repo, named after
+    its path, with a 'yum-config', and optionally 'custom-source'
+    (one per line) and 'repoman-config'. The repoids of all the yum
+    configs are synced once, then the target repos are merged in
+    parallel.
+    """
+    from mkrepo import batch
+    from mkrepo import reposetup_core
+
+    _check_merge_backend(kwargs['merge_backend'], kwargs['link_mode'])
     try:
-        reposetup_core.reposetup(
-            dest=dest,
+        batch.build_many(
+            batch.read_manifest(manifest),
             sync_dir=sync_dir,
             sync=sync,
-            yum_config=yum_config,
-            repoman_config=repoman_config,
-            custom_source=list(custom_source),
-            lock_timeout=lock_timeout
+            lock_timeout=lock_timeout,
+            **kwargs
         )
-    except reposetup_core.ReposetupError as e:
-        LOGGER.error('Failed to run reposetup: {}'.format(str(e)))
+    except (batch.ManifestError, reposetup_core.ReposetupError) as e:
+        LOGGER.error('Failed to run build-many: {}'.format(str(e)))
+        sys.exit(1)
+
+
+@cli.command()
+@click.option(
+    '--lock-timeout',
+    type=int,
+    default=180,
+    show_default=True,
+    metavar='<lock-timeout>',
+    help='Time in seconds to wait for a lock for all the repoids'
+)
+@click.option(
+    '--yum-config',
+    type=click.Path(exists=True, resolve_path=True, readable=True),
+    required=True,
+    metavar='<yum-config>',
+    help='Yum config of the RPM cache',
+)
+@click.option(
+    '--sync-dir',
+    type=click.Path(dir_okay=True, resolve_path=True),
+    default='/var/cache/mkrepo',
+    show_default=True,
+    metavar='<sync-dir>',
+    help='Where the RPM cache is stored'
+)
+def dedup(sync_dir, yum_config, lock_timeout):
+    """Replace the duplicated RPMs of the cache with hardlinks"""
+    from mkrepo import reposetup_core
+
+    try:
+        report = reposetup_core.dedup(sync_dir, yum_config, lock_timeout)
+    except Exception as e:
+        LOGGER.error('Failed to dedup {}: {}'.format(sync_dir, str(e)))
+        sys.exit(1)
+
+    print(
+        'Checked {} RPMs, linked {}, reclaimed {} bytes'.format(*report)
+    )
+
+
+@cli.command()
+@click.option(
+    '--lock-timeout',
+    type=int,
+    default=180,
+    show_default=True,
+    metavar='<lock-timeout>',
+    help='Time in seconds to wait for a lock for all the repoids'
+)
+@click.option(
+    '--jobs',
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    metavar='<jobs>',
+    help='Max number of RPMs to hash concurrently',
+)
+@click.option(
+    '--remove/--no-remove',
+    default=True,
+    show_default=True,
+    help='Remove the corrupt RPMs, so the next sync downloads them again',
+)
+@click.option(
+    '--yum-config',
+    type=click.Path(exists=True, resolve_path=True, readable=True),
+    required=True,
+    metavar='<yum-config>',
+    help='Yum config of the RPM cache',
+)
+@click.option(
+    '--sync-dir',
+    type=click.Path(dir_okay=True, resolve_path=True),
+    default='/var/cache/mkrepo',
+    show_default=True,
+    metavar='<sync-dir>',
+    help='Where the RPM cache is stored'
+)
+def verify(sync_dir, yum_config, remove, jobs, lock_timeout):
+    """Verify the RPMs of the cache against the checksums of their repos
+
+    Only the RPMs that changed since the last verification are hashed.
+    Exits with 1 if corrupt RPMs were found.
+    """
+    from mkrepo import reposetup_core
+
+    try:
+        reports = reposetup_core.verify(
+            sync_dir, yum_config, lock_timeout, jobs=jobs, remove=remove
+        )
+    except Exception as e:
+        LOGGER.error('Failed to verify {}: {}'.format(sync_dir, str(e)))
+        sys.exit(1)
+
+    for report in reports:
+        print(
+            '{}: checked {} RPMs, hashed {}, {} corrupt, {} unknown'.format(
+                report.repoid, report.checked, report.hashed,
+                len(report.corrupt), report.unknown
+            )
+        )
+        for path in report.corrupt:
+            print('  corrupt: {}'.format(path))
+    if any(report.corrupt for report in reports):
         sys.exit(1)
 
 
+@cli.command()
+@click.option(
+    '--lock-timeout',
+    type=int,
+    default=180,
+    show_default=True,
+    metavar='<lock-timeout>',
+    help='Time in seconds to wait for the lock of the blob store'
+)
+@click.option(
+    '--budget',
+    callback=_parse_size,
+    required=True,
+    metavar='<size>',
+    help='Max size of the RPM cache (e.g 512M, 50G)'
+)
+@click.option(
+    '--sync-dir',
+    type=click.Path(dir_okay=True, resolve_path=True, exists=True),
+    default='/var/cache/mkrepo',
+    show_default=True,
+    metavar='<sync-dir>',
+    help='Where the RPM cache is stored'
+)
+def gc(sync_dir, budget, lock_timeout):
+    """Evict the least recently used repoids from the RPM cache
+
+    Whole repoids are evicted, along with the blobs no repoid uses
+    anymore, never single RPMs of the repoids that are kept. Repoids
+    that are used by a running build are never evicted.
+    """
+    from mkrepo import cachegc
+
+    try:
+        report = cachegc.collect(sync_dir, budget, lock_timeout=lock_timeout)
+    except Exception as e:
+        LOGGER.error('Failed to collect {}: {}'.format(sync_dir, str(e)))
+        sys.exit(1)
+
+    print(
+        'Shrunk from {} to {} bytes, evicted: {}, removed {} blobs'.format(
+            report.before, report.after,
+            ', '.join(report.evicted) or 'nothing', report.orphan_blobs
+        )
+    )
+
+
+@cli.command()
+@click.option(
+    '--socket',
+    'socket_path',
+    type=click.Path(dir_okay=False, resolve_path=True),
+    default=defaults.SERVER_SOCKET,
+    show_default=True,
+    metavar='<socket>',
+    help='Unix socket to listen on',
+)
+@click.option(
+    '--jobs',
+    type=click.IntRange(min=1),
+    default=defaults.SERVER_JOBS,
+    show_default=True,
+    metavar='<jobs>',
+    help='Max number of reposetup jobs to run concurrently',
+)
+def serve(socket_path, jobs):
+    """Run reposetup jobs sent with `mkrepo reposetup --server`"""
+    from mkrepo import server as server_mod
+
+    server_mod.serve(socket_path, jobs)
+
+
 @cli.command()
 def version():
     """Print version and exit"""
-    print(get_distribution('mkrepo').version)
+    try:
+        from importlib.metadata import version as get_version
+    except ImportError:
+        # Python < 3.8
+        from pkg_resources import get_distribution
+
+        def get_version(name):
+            return get_distribution(name).version
+
+    print(get_version('mkrepo'))
 
 
 def setup_logging(level):
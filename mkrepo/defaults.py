@@ -0,0 +1,10 @@
+"""Defaults shared by :mod:`mkrepo.cli` and the modules of its commands
+
+The cli reads them when it's imported, so this module must not import
+anything.
+"""
+
+SERVER_SOCKET = '/var/run/mkrepo.sock'
+"""Where ``mkrepo serve`` listens"""
+SERVER_JOBS = 4
+"""Max number of builds ``mkrepo serve`` runs concurrently"""
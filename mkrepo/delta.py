@@ -0,0 +1,213 @@
+"""Incremental merge of sources into an existing repo
+
+The RPMs that were merged into a repo are recorded in a manifest kept
+inside the repo. On the next merge, the current content of the sources
+is compared with the manifest, and only the packages that were added,
+changed or removed since then are handled.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from collections import namedtuple
+
+from mkrepo import rpmindex
+from mkrepo import sources as sources_mod
+from mkrepo import utils
+
+LOGGER = logging.getLogger(__name__)
+
+MANIFEST = 'merge-manifest.json'
+_MANIFEST_VERSION = 2
+_PER_FILE_FILTERS = set(['only-missing'])
+"""The filters that give the same result on a single RPM of a source as
+on the whole source, other filters (e.g ``latest``) select RPMs
+according to the rest of the source"""
+
+
+MergePlan = namedtuple('MergePlan', ('sources', 'remove'))
+"""What an incremental merge should do
+
+Attributes:
+    sources(list of str): Repoman sources to add, in order
+    remove(set of str): RPM file names to remove from the repo first
+"""
+
+
+def state_dir(dest):
+    return os.path.join(dest, utils.STATE_DIR)
+
+
+def snapshot(sources, repoman_config=None, indexed=()):
+    """Record the content of ``sources``
+
+    Args:
+        sources(list of str): Repoman sources
+        repoman_config(str): Path to repoman's config, if any
+        indexed(iterable of str): Source dirs that are owned by mkrepo,
+            and can be listed with :class:`rpmindex.RpmIndex`. The package
+            names of the other sources are guessed from the file names.
+
+    Returns:
+        dict: The snapshot, or None if one of the sources can't be
+            inspected locally.
+    """
+    indexed = set(indexed)
+    files = []
+    for source in sources:
+        parsed = sources_mod.parse_source(source)
+        if parsed.kind != sources_mod.LOCAL:
+            LOGGER.debug('Can not snapshot source {}'.format(source))
+            return None
+        if parsed.location in indexed:
+            files.append(_list_indexed_rpms(parsed.location))
+        else:
+            files.append(
+                dict(
+                    (name, info + (sources_mod.package_name(name),))
+                    for name, info in
+                    sources_mod.list_rpms(parsed.location).items()
+                )
+            )
+
+    return {
+        'version': _MANIFEST_VERSION,
+        'sources': list(sources),
+        'repoman_config': _file_digest(repoman_config),
+        'files': files,
+    }
+
+
+def load_manifest(dest):
+    try:
+        with open(os.path.join(state_dir(dest), MANIFEST)) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if manifest.get('version') != _MANIFEST_VERSION:
+        return None
+
+    return manifest
+
+
+def save_manifest(dest, manifest):
+    utils.safe_mkdir(state_dir(dest))
+    path = os.path.join(state_dir(dest), MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(path + '.tmp', path)
+
+
+def drop_manifest(dest):
+    try:
+        os.unlink(os.path.join(state_dir(dest), MANIFEST))
+    except OSError:
+        pass
+
+
+def plan(previous, current):
+    """Compute what should be merged into the repo
+
+    Args:
+        previous(dict): The manifest of the last merge
+        current(dict): The snapshot of the sources
+
+    Returns:
+        MergePlan: The delta to apply, an empty plan if nothing changed,
+            or None if a full merge is required, e.g when a source has
+            filters other than ``only-missing``.
+    """
+    if previous is None or current is None:
+        return None
+
+    if any(
+        set(sources_mod.parse_source(source).filters) - _PER_FILE_FILTERS
+        for source in current['sources']
+    ):
+        return None
+
+    if (
+        previous['sources'] != current['sources']
+        or previous['repoman_config'] != current['repoman_config']
+    ):
+        return None
+
+    affected = set()
+    for prev_files, cur_files in zip(previous['files'], current['files']):
+        for name, info in cur_files.items():
+            prev_info = prev_files.get(name)
+            if prev_info is None or list(prev_info[1:3]) != list(info[1:3]):
+                affected.add(name)
+        affected.update(set(prev_files) - set(cur_files))
+
+    if not affected:
+        return MergePlan([], set())
+
+    # Packages with the same name may shadow each other (custom sources
+    # come first, and caches are added with 'only-missing'), so every
+    # provider of an affected package name is added again, in order.
+    affected_names = set(
+        info[3]
+        for files in previous['files'] + current['files']
+        for name, info in files.items()
+        if name in affected
+    )
+    to_add = []
+    for source, cur_files in zip(current['sources'], current['files']):
+        filters = sources_mod.parse_source(source).filters
+        to_add.extend(
+            sources_mod.format_source(info[0], filters)
+            for name, info in sorted(cur_files.items())
+            if info[3] in affected_names
+        )
+
+    return MergePlan(to_add, affected)
+
+
+def remove_rpms(dest, names):
+    """Remove every copy of the RPMs named ``names`` from ``dest``
+
+    Args:
+        dest(str): Path to the repo
+        names(set of str): RPM file names
+
+    Returns:
+        int: Number of removed files
+    """
+    with rpmindex.RpmIndex(dest) as index:
+        index.refresh()
+        removed = [
+            rpm.path for rpm in index.rpms()
+            if os.path.basename(rpm.path) in names
+        ]
+        for path in removed:
+            LOGGER.debug('Removing {}'.format(os.path.join(dest, path)))
+            os.unlink(os.path.join(dest, path))
+        index.forget(removed)
+
+    return len(removed)
+
+
+def _list_indexed_rpms(path):
+    with rpmindex.RpmIndex(path) as index:
+        index.refresh()
+        rpms = {}
+        for rpm in index.rpms():
+            rpms.setdefault(
+                os.path.basename(rpm.path),
+                (
+                    os.path.join(path, rpm.path), rpm.size,
+                    rpm.mtime // 10 ** 9, rpm.name
+                )
+            )
+        return rpms
+
+
+def _file_digest(path):
+    if not path:
+        return None
+
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
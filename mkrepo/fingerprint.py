@@ -0,0 +1,162 @@
+"""Fingerprints of builds, to skip the merges that would change nothing
+
+The fingerprint of a build covers everything the merge reads: the yum
+config, the repoman config, the ordered merge sources, how they are
+merged, and the path, size and mtime of the RPMs of every source. It is
+saved in ``<dest>/.mkrepo/fingerprint`` after a successful merge, with
+a listing of ``dest`` itself, so a merge is skipped only if its inputs
+didn't change and nothing else changed ``dest`` in the meantime.
+
+Builds with sources that can't be listed locally (e.g URLs, or
+``conf:<path>``) have no fingerprint, so they are always merged.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from mkrepo import sources as sources_mod
+from mkrepo import utils
+
+LOGGER = logging.getLogger(__name__)
+
+FINGERPRINT = 'fingerprint'
+LOCK_NAME = 'mkrepo.lock'
+_VERSION = 1
+
+
+def compute(
+    sources, yum_config=None, repoman_config=None, listings=None, **options
+):
+    """Compute the fingerprint of a merge
+
+    Args:
+        sources(list of str): The merge sources, in order
+        yum_config(str): Path to the yum config, if any
+        repoman_config(str): Path to the repoman config, if any
+        listings(dict): The :func:`listing` of some of the sources, taken
+            when they were merged, by location
+        **options: Other things that change the result of the merge,
+            e.g the merge backend, must be JSON serializable
+
+    Returns:
+        str: The fingerprint, or None if one of the sources isn't local
+    """
+    digest = hashlib.sha256()
+    digest.update(
+        json.dumps(
+            [
+                _VERSION, list(sources), _file_digest(yum_config),
+                _file_digest(repoman_config), options
+            ],
+            sort_keys=True
+        ).encode('utf-8')
+    )
+    for source in sources:
+        parsed = sources_mod.parse_source(source)
+        if parsed.kind != sources_mod.LOCAL:
+            LOGGER.debug('Can not fingerprint source {}'.format(source))
+            return None
+        digest.update(
+            '\0{}\0{}\n'.format(
+                parsed.location,
+                (listings or {}).get(parsed.location)
+                or listing(parsed.location)
+            ).encode('utf-8')
+        )
+
+    return digest.hexdigest()
+
+
+def listing(location):
+    """A digest of the path, size and mtime of the RPMs of a source"""
+    digest = hashlib.sha256()
+    _update_listing(digest, location, rpms_only=True)
+    return digest.hexdigest()
+
+
+def matches(dest, fingerprint):
+    """Check if ``dest`` was built from ``fingerprint`` and is unchanged"""
+    if fingerprint is None:
+        return False
+
+    saved = _load(dest)
+    return (
+        saved.get('fingerprint') == fingerprint
+        and saved.get('dest') == _dest_listing(dest)
+    )
+
+
+def save(dest, fingerprint):
+    """Record that ``dest`` was just built from ``fingerprint``"""
+    if fingerprint is None:
+        drop(dest)
+        return
+
+    path = _path(dest)
+    utils.safe_mkdir(os.path.dirname(path))
+    with open(path + '.tmp', 'w') as f:
+        json.dump(
+            dict(fingerprint=fingerprint, dest=_dest_listing(dest)), f
+        )
+    os.rename(path + '.tmp', path)
+
+
+def drop(dest):
+    try:
+        os.unlink(_path(dest))
+    except OSError:
+        pass
+
+
+def _path(dest):
+    return os.path.join(dest, utils.STATE_DIR, FINGERPRINT)
+
+
+def _load(dest):
+    try:
+        with open(_path(dest)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _dest_listing(dest):
+    digest = hashlib.sha256()
+    _update_listing(digest, dest, rpms_only=False)
+    return digest.hexdigest()
+
+
+def _update_listing(digest, path, rpms_only):
+    """Add the path, size and mtime of the files under ``path`` to
+    ``digest``, skipping the state dirs and the lock files of mkrepo
+    """
+    if os.path.isfile(path):
+        st = os.stat(path)
+        digest.update('{}\0{}\n'.format(st.st_size, st.st_mtime_ns).encode())
+        return
+
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [d for d in dirnames if d != utils.STATE_DIR]
+        for f in filenames:
+            if f == LOCK_NAME or rpms_only and not f.endswith('.rpm'):
+                continue
+            file_path = os.path.join(dirpath, f)
+            st = os.lstat(file_path)
+            entries.append(
+                (os.path.relpath(file_path, path), st.st_size,
+                 st.st_mtime_ns)
+            )
+
+    for entry in sorted(entries):
+        digest.update('{}\0{}\0{}\n'.format(*entry).encode('utf-8'))
+
+
+def _file_digest(path):
+    if not path:
+        return None
+
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
@@ -0,0 +1,91 @@
+"""Populate a repo with links to the RPM cache instead of copies
+
+Only the builtin merge backend (see :mod:`mkrepo.merge`) can put links
+in the target repo, as it creates every RPM of it itself. Repoman
+always writes full copies.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+
+LOGGER = logging.getLogger(__name__)
+
+COPY = 'copy'
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+AUTO = 'auto'
+LINK_MODES = (COPY, HARDLINK, REFLINK, AUTO)
+
+_FICLONE = 0x40049409
+_FALLBACK_ERRNOS = (
+    errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.EINVAL,
+    errno.ENOTTY, errno.EMLINK,
+)
+
+
+def link_or_copy(src, dst, mode=AUTO):
+    """Create ``dst`` with the content of ``src``
+
+    ``hardlink`` and ``reflink`` fall back to a copy if the filesystem
+    doesn't support it, or if ``src`` and ``dst`` are on different
+    devices. ``auto`` tries a reflink, then a hardlink, then a copy.
+    ``dst`` is replaced atomically if it already exists.
+
+    Args:
+        src(str)
+        dst(str)
+        mode(str): One of LINK_MODES
+
+    Returns:
+        str: The method that was used, one of COPY, HARDLINK or REFLINK
+    """
+    methods = {
+        COPY: [],
+        HARDLINK: [HARDLINK],
+        REFLINK: [REFLINK],
+        AUTO: [REFLINK, HARDLINK],
+    }[mode]
+
+    tmp = '{}.{}.tmp'.format(dst, os.getpid())
+    try:
+        for method in methods:
+            try:
+                _link(method, src, tmp)
+                break
+            except (IOError, OSError) as e:
+                if e.errno not in _FALLBACK_ERRNOS:
+                    raise
+                LOGGER.debug(
+                    'Can not {} {} to {}: {}'.format(method, src, dst, e)
+                )
+                _unlink(tmp)
+        else:
+            method = COPY
+            shutil.copy2(src, tmp)
+
+        os.rename(tmp, dst)
+    except BaseException:
+        _unlink(tmp)
+        raise
+
+    return method
+
+
+def _link(method, src, dst):
+    if method == HARDLINK:
+        os.link(src, dst)
+        return
+
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+    shutil.copystat(src, dst)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
@@ -0,0 +1,312 @@
+"""An in-process merge backend
+
+An alternative to repoman for building the target repo. The final set
+of packages is resolved in-process, with the same precedence rules as
+the repoman flow of :func:`reposetup_core.do_merge`:
+
+* The packages already in the target repo are kept.
+* Sources are handled in order, custom sources first.
+* A package from a plain source is added unless the same NEVRA is
+  already selected.
+* A package from an ``only-missing`` source is added only if no package
+  with the same name is already selected.
+* ``latest`` keeps only the newest version of every package name of a
+  source, according to :func:`compare_evr`.
+* Source RPMs are skipped.
+
+The selected RPMs are then linked or copied into
+``<dest>/<distro>/<arch>/``, and the repodata of every distro dir is
+updated with :func:`repodata.update`.
+"""
+
+import logging
+import os
+import re
+from collections import OrderedDict, namedtuple
+
+from mkrepo import linking
+from mkrepo import metrics as metrics_mod
+from mkrepo import repodata
+from mkrepo import rpmindex
+from mkrepo import sources as sources_mod
+from mkrepo import utils
+
+LOGGER = logging.getLogger(__name__)
+
+REPOMAN = 'repoman'
+BUILTIN = 'builtin'
+BACKENDS = (REPOMAN, BUILTIN)
+
+ONLY_MISSING = 'only-missing'
+LATEST = 'latest'
+SUPPORTED_FILTERS = (ONLY_MISSING, LATEST)
+
+DEFAULT_DISTRO = 'default'
+_DISTRO_REGEX = re.compile(r'\.(?P<distro>(el|fc)\d+)')
+
+
+class MergeError(Exception):
+    pass
+
+
+Package = namedtuple(
+    'Package', ('name', 'epoch', 'version', 'release', 'arch', 'path')
+)
+
+
+def package_from_rpm(path, hdr):
+    return Package(
+        hdr['name'], hdr.get('epoch') or 0, hdr.get('version') or '',
+        hdr.get('release') or '', hdr.get('arch') or '', path
+    )
+
+
+def _from_indexed(root, rpm):
+    return Package(
+        rpm.name, rpm.epoch or 0, rpm.version or '', rpm.release or '',
+        rpm.arch or '', os.path.join(root, rpm.path)
+    )
+
+
+def nevra(pkg):
+    return (pkg.name, pkg.epoch, pkg.version, pkg.release, pkg.arch)
+
+
+def distro(pkg):
+    """Get the distro of a package from its release, e.g ``el7``"""
+    m = _DISTRO_REGEX.search(pkg.release)
+    return m.group('distro') if m else None
+
+
+def rpmvercmp(a, b):
+    """Compare two version (or release) strings like rpm does
+
+    Returns:
+        int: 1 if ``a`` is newer, -1 if ``b`` is newer, 0 if equal
+    """
+    if a == b:
+        return 0
+
+    i, j = 0, 0
+    while i < len(a) or j < len(b):
+        while i < len(a) and not a[i].isalnum() and a[i] not in '~^':
+            i += 1
+        while j < len(b) and not b[j].isalnum() and b[j] not in '~^':
+            j += 1
+
+        # '~' sorts before anything, even the end of the string
+        a_tilde = i < len(a) and a[i] == '~'
+        b_tilde = j < len(b) and b[j] == '~'
+        if a_tilde or b_tilde:
+            if not (a_tilde and b_tilde):
+                return -1 if a_tilde else 1
+            i, j = i + 1, j + 1
+            continue
+
+        # '^' sorts after the end of the string, but before anything else
+        a_caret = i < len(a) and a[i] == '^'
+        b_caret = j < len(b) and b[j] == '^'
+        if a_caret or b_caret:
+            if i >= len(a):
+                return -1
+            if j >= len(b):
+                return 1
+            if not (a_caret and b_caret):
+                return -1 if a_caret else 1
+            i, j = i + 1, j + 1
+            continue
+
+        if i >= len(a) or j >= len(b):
+            break
+
+        is_num = a[i].isdigit()
+        seg_a, i = _segment(a, i, is_num)
+        seg_b, j = _segment(b, j, is_num)
+        if not seg_b:
+            # Numeric segments are newer than alpha segments
+            return 1 if is_num else -1
+
+        if is_num:
+            seg_a, seg_b = seg_a.lstrip('0'), seg_b.lstrip('0')
+            if len(seg_a) != len(seg_b):
+                return 1 if len(seg_a) > len(seg_b) else -1
+
+        if seg_a != seg_b:
+            return 1 if seg_a > seg_b else -1
+
+    if i >= len(a) and j >= len(b):
+        return 0
+
+    return -1 if i >= len(a) else 1
+
+
+def _segment(s, start, is_num):
+    end = start
+    check = str.isdigit if is_num else str.isalpha
+    while end < len(s) and s[end].isascii() and check(s[end]):
+        end += 1
+    return s[start:end], end
+
+
+def compare_evr(a, b):
+    """Compare the (epoch, version, release) of two packages
+
+    Returns:
+        int: 1 if ``a`` is newer, -1 if ``b`` is newer, 0 if equal
+    """
+    if (a.epoch or 0) != (b.epoch or 0):
+        return 1 if (a.epoch or 0) > (b.epoch or 0) else -1
+
+    return (
+        rpmvercmp(a.version, b.version)
+        or rpmvercmp(a.release, b.release)
+    )
+
+
+def newest(packages):
+    """Keep only the newest package of every (name, arch)"""
+    result = OrderedDict()
+    for pkg in packages:
+        key = (pkg.name, pkg.arch)
+        if key not in result or compare_evr(pkg, result[key]) > 0:
+            result[key] = pkg
+    return list(result.values())
+
+
+def list_packages(path, indexed=False):
+    """List the packages under ``path``
+
+    Args:
+        path(str): A dir or a single RPM
+        indexed(bool): If ``path`` is a dir owned by mkrepo, list it
+            with :class:`rpmindex.RpmIndex`, otherwise read every header
+
+    Returns:
+        list of Package
+    """
+    if indexed:
+        with rpmindex.RpmIndex(path) as index:
+            index.refresh()
+            return [_from_indexed(path, r) for r in index.rpms() if r.name]
+
+    packages = []
+    for rpm_path, _, _ in sorted(sources_mod.list_rpms(path).values()):
+        try:
+            packages.append(
+                package_from_rpm(rpm_path, rpmindex.read_header(rpm_path))
+            )
+        except (IOError, OSError, rpmindex.RpmHeaderError) as e:
+            LOGGER.warning('Skipping {}: {}'.format(rpm_path, e))
+    return packages
+
+
+def resolve(sources, existing=(), cache_dirs=()):
+    """Resolve the packages of the target repo
+
+    Args:
+        sources(list of str): Sources, in the same format as for repoman,
+            only local paths are supported.
+        existing(list of Package): Packages already in the target repo
+        cache_dirs(list of str): Source dirs owned by mkrepo
+
+    Returns:
+        list of Package: The packages to add to the target repo
+
+    Raises:
+        MergeError: If a source or a filter isn't supported
+    """
+    cache_dirs = set(cache_dirs)
+    selected = set(nevra(p) for p in existing)
+    names = set(p.name for p in existing)
+    to_add = []
+    for source in sources:
+        parsed = sources_mod.parse_source(source)
+        if parsed.kind != sources_mod.LOCAL:
+            raise MergeError(
+                'The builtin merge backend supports only local sources, '
+                'got {}'.format(source)
+            )
+        unsupported = set(parsed.filters) - set(SUPPORTED_FILTERS)
+        if unsupported:
+            raise MergeError(
+                'Unsupported filters {} in {}'.format(
+                    ','.join(sorted(unsupported)), source
+                )
+            )
+
+        packages = [
+            p for p in list_packages(
+                parsed.location, parsed.location in cache_dirs
+            )
+            if p.arch != 'src'
+        ]
+        only_missing = ONLY_MISSING in parsed.filters
+        if only_missing or LATEST in parsed.filters:
+            packages = newest(packages)
+
+        source_names = set()
+        for pkg in packages:
+            if nevra(pkg) in selected:
+                continue
+            if only_missing and pkg.name in names:
+                continue
+            selected.add(nevra(pkg))
+            source_names.add(pkg.name)
+            to_add.append(pkg)
+        names.update(source_names)
+
+    return to_add
+
+
+def merge(
+    sources, dest, cache_dirs=(), link_mode=linking.COPY, timeout=None,
+    metrics=metrics_mod.NULL, update_repodata=True
+):
+    """Build the target repo in-process
+
+    Args:
+        sources(list of str): Sources, see :func:`resolve`
+        dest(str): Path to the target repo
+        cache_dirs(list of str): Source dirs owned by mkrepo
+        link_mode(str): How to put the RPMs in ``dest``, one of
+            :data:`linking.LINK_MODES`
+        timeout(float): Max seconds for a single createrepo_c run
+        metrics(metrics.Metrics): Where to record every createrepo_c run
+        update_repodata(bool): Update the repodata of ``dest``, turned off
+            when more sources will be merged right after
+
+    Returns:
+        list of str: The RPMs that were added to ``dest``
+
+    Raises:
+        MergeError: If a source or a filter isn't supported
+        repodata.RepodataError: If createrepo_c failed
+    """
+    with rpmindex.RpmIndex(dest) as dest_index:
+        dest_index.refresh()
+        existing = [
+            _from_indexed(dest, r) for r in dest_index.rpms() if r.name
+        ]
+
+    to_add = resolve(sources, existing, cache_dirs)
+    distros = set(filter(None, (distro(p) for p in existing + to_add)))
+    distros = distros or set([DEFAULT_DISTRO])
+
+    added = []
+    for pkg in to_add:
+        for d in sorted([distro(pkg)] if distro(pkg) else distros):
+            dst = os.path.join(
+                dest, d, pkg.arch, os.path.basename(pkg.path)
+            )
+            if os.path.exists(dst):
+                continue
+            utils.safe_mkdir(os.path.dirname(dst))
+            linking.link_or_copy(pkg.path, dst, link_mode)
+            added.append(dst)
+
+    LOGGER.info('Added {} RPMs to {}'.format(len(added), dest))
+    if update_repodata:
+        for d in sorted(distros):
+            repodata.update(dest, d, timeout=timeout, metrics=metrics)
+
+    return added
@@ -0,0 +1,168 @@
+"""Timing and throughput metrics of a reposetup run
+
+A :class:`Metrics` object is passed down the reposetup flow, every
+component records what it did, and the result is written as a JSON
+report.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from mkrepo import rpmindex
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """Collect the metrics of a single run
+
+    The report looks like::
+
+        {
+            "started": <epoch>,
+            "wall_time": <seconds>,
+            "phases": [{"name": "lock", "duration": <seconds>, "ok": true}],
+            "sync": {
+                "<repoid>": {
+                    "commands": [{"branch": "initial", ...}],
+                    "rpms": {"added": 0, "added_bytes": 0, ...}
+                }
+            },
+            "merge": {"<dest>": {"commands": [...], "rpms": {...}}}
+        }
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._phases = []
+        self._sections = {}
+
+    @contextmanager
+    def phase(self, name, **tags):
+        """Time the code in the context as phase ``name``"""
+        start = time.time()
+        record = dict(name=name, **tags)
+        try:
+            yield record
+            record['ok'] = True
+        except BaseException:
+            record['ok'] = False
+            raise
+        finally:
+            record['duration'] = time.time() - start
+            with self._lock:
+                self._phases.append(record)
+
+    def command(self, section, key, status, **tags):
+        """Record a command run for ``key`` in ``section``
+
+        Args:
+            section(str): e.g 'sync' or 'merge'
+            key(str): e.g a repoid
+            status(utils.CommandStatus): The result of the command,
+                or None if it didn't finish
+            **tags: Extra fields for the record
+        """
+        record = dict(tags)
+        if status is not None:
+            record['exit_code'] = status.code
+            record['duration'] = status.duration
+            record.update(_rusage(status.rusage))
+        with self._lock:
+            self._entry(section, key).setdefault('commands', []).append(
+                record
+            )
+
+    def rpm_changes(self, section, key, before, after):
+        """Record the RPMs added and removed for ``key`` in ``section``
+
+        Args:
+            section(str)
+            key(str)
+            before(dict): RPM path to size, see :func:`list_rpm_sizes`
+            after(dict): RPM path to size
+        """
+        added = set(after) - set(before)
+        removed = set(before) - set(after)
+        changed = set(
+            p for p in set(after) & set(before) if after[p] != before[p]
+        )
+        with self._lock:
+            self._entry(section, key)['rpms'] = dict(
+                added=len(added),
+                added_bytes=sum(after[p] for p in added),
+                removed=len(removed),
+                removed_bytes=sum(before[p] for p in removed),
+                changed=len(changed),
+                total=len(after),
+                total_bytes=sum(after.values()),
+            )
+
+    def _entry(self, section, key):
+        return self._sections.setdefault(section, {}).setdefault(key, {})
+
+    def report(self):
+        with self._lock:
+            report = dict(
+                started=self._started,
+                wall_time=time.time() - self._started,
+                phases=list(self._phases),
+            )
+            report.update(self._sections)
+        return report
+
+    def write(self, path):
+        """Write the report to ``path`` as JSON"""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+        os.rename(tmp, path)
+        LOGGER.info('Wrote metrics to {}'.format(path))
+
+
+class _NullMetrics(Metrics):
+    """Metrics that are not recorded"""
+
+    enabled = False
+
+    @contextmanager
+    def phase(self, name, **tags):
+        yield dict(name=name, **tags)
+
+    def command(self, section, key, status, **tags):
+        pass
+
+    def rpm_changes(self, section, key, before, after):
+        pass
+
+
+NULL = _NullMetrics()
+
+
+def list_rpm_sizes(path):
+    """Get the size of every RPM under ``path``, using its index
+
+    Returns:
+        dict: RPM path, relative to ``path``, to size
+    """
+    with rpmindex.RpmIndex(path) as index:
+        index.refresh()
+        return dict((rpm.path, rpm.size) for rpm in index.rpms())
+
+
+def _rusage(rusage):
+    if rusage is None:
+        return {}
+
+    return dict(
+        cpu_user=rusage.ru_utime,
+        cpu_system=rusage.ru_stime,
+        max_rss_kb=rusage.ru_maxrss,
+    )
@@ -0,0 +1,169 @@
+"""Staged builds of a repo, published atomically
+
+With staged builds, ``dest`` is a symlink to the current generation of
+the repo, which lives in a hidden sibling dir::
+
+    /srv/repos/el7 -> .el7.generations/20240101T120000.000000-1f0c2a9b
+    /srv/repos/.el7.generations/20240101T120000.000000-1f0c2a9b/...
+
+A build happens in a new generation, ``<id>.staging``, which is first
+populated from the current one: the RPMs and the createrepo_c checksum
+cache are hardlinked, as they are only ever replaced, never modified in
+place, and the rest is copied. Once the build is done, the generation is
+renamed to ``<id>`` and ``dest`` is swapped to point to it with an
+atomic rename of a symlink, so consumers of ``dest`` see either the old
+or the new repo, never a half-written one.
+
+If ``dest`` is a plain dir, e.g. built in place so far, the first
+publish moves it to the generations dir before creating the symlink.
+That one-time migration isn't atomic: ``dest`` is missing between the
+two renames.
+
+Two locks of the generations dir are used: the build lock,
+``mkrepo.lock``, is held for the whole build and serializes the builds
+of ``dest``, and the publish lock, ``publish.lock``, is held only for
+the swap and the removal of old generations. Readers that want a
+consistent view of ``dest`` across several reads can hold the publish
+lock shared, they never wait for a build.
+"""
+
+import logging
+import os
+import shutil
+import uuid
+from datetime import datetime
+
+from mkrepo import linking
+from mkrepo import repodata
+from mkrepo import utils
+
+LOGGER = logging.getLogger(__name__)
+
+BUILD_LOCK = 'mkrepo.lock'
+PUBLISH_LOCK = 'publish.lock'
+STAGING_SUFFIX = '.staging'
+INITIAL = '0-initial'
+"""The generation ``dest`` becomes if it was a plain dir, it sorts
+before the other generations"""
+DEFAULT_KEEP = 2
+"""Number of generations to keep, the published one included, so the
+previous one is still there for the consumers that are reading it"""
+
+
+def generations_dir(dest):
+    """The dir of the generations of ``dest``"""
+    dest = os.path.normpath(dest)
+    return os.path.join(
+        os.path.dirname(dest),
+        '.{}.generations'.format(os.path.basename(dest))
+    )
+
+
+def stage(dest):
+    """Create a new generation of ``dest``, populated from the current one
+
+    The build lock must be held.
+
+    Returns:
+        str: The path of the new generation
+    """
+    generations = generations_dir(dest)
+    utils.safe_mkdir(generations)
+    for name in os.listdir(generations):
+        if name.endswith(STAGING_SUFFIX):
+            LOGGER.info('Removing the stale stage {}'.format(name))
+            shutil.rmtree(os.path.join(generations, name))
+
+    path = os.path.join(
+        generations,
+        '{:%Y%m%dT%H%M%S.%f}-{}{}'.format(
+            datetime.now(), uuid.uuid4().hex[:8], STAGING_SUFFIX
+        )
+    )
+    if os.path.isdir(dest):
+        _populate(os.path.realpath(dest), path)
+    else:
+        os.mkdir(path)
+
+    LOGGER.debug('Staging {} in {}'.format(dest, path))
+    return path
+
+
+def publish(dest, staged, lock_timeout=180, keep=DEFAULT_KEEP):
+    """Make ``dest`` point to the generation ``staged``
+
+    If ``dest`` is a plain dir, it becomes the previous generation. That
+    isn't atomic, ``dest`` doesn't exist between its move and the
+    creation of the symlink, only the following publishes are.
+
+    Args:
+        dest(str)
+        staged(str): A generation made by :func:`stage`
+        lock_timeout(int): Max seconds to wait for the publish lock
+        keep(int): Number of generations to keep
+
+    Returns:
+        str: The path of the published generation
+    """
+    generations = generations_dir(dest)
+    path = staged[:-len(STAGING_SUFFIX)]
+    os.rename(staged, path)
+
+    with utils.LockFiles(
+        [generations], timeout=lock_timeout, lock_name=PUBLISH_LOCK
+    ):
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            LOGGER.info(
+                'Moving {} to {} to publish it atomically from now '
+                'on'.format(dest, generations)
+            )
+            os.rename(dest, os.path.join(generations, INITIAL))
+
+        tmp = '{}.{}.tmp'.format(dest, os.getpid())
+        os.symlink(os.path.relpath(path, os.path.dirname(dest)), tmp)
+        os.rename(tmp, dest)
+        LOGGER.info('Published {} as {}'.format(path, dest))
+        _prune(generations, path, keep)
+
+    return path
+
+
+def discard(staged):
+    """Remove a generation that won't be published"""
+    shutil.rmtree(staged, ignore_errors=True)
+
+
+def _populate(src, dst):
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel = os.path.relpath(dirpath, src)
+        target_dir = os.path.normpath(os.path.join(dst, rel))
+        os.mkdir(target_dir)
+        shutil.copystat(dirpath, target_dir)
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            target = os.path.join(target_dir, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), target)
+            elif name in filenames and (rel, name) != ('.', BUILD_LOCK):
+                if _immutable(os.path.relpath(path, src)):
+                    linking.link_or_copy(path, target, linking.HARDLINK)
+                else:
+                    shutil.copy2(path, target)
+
+
+def _immutable(rel_path):
+    return rel_path.endswith('.rpm') or rel_path.startswith(
+        os.path.join(utils.STATE_DIR, repodata.CACHE_DIR) + os.sep
+    )
+
+
+def _prune(generations, published, keep):
+    names = sorted(
+        name for name in os.listdir(generations)
+        if not name.endswith(STAGING_SUFFIX)
+        and os.path.isdir(os.path.join(generations, name))
+        and os.path.join(generations, name) != published
+    )
+    for name in names[:max(len(names) - keep + 1, 0)]:
+        LOGGER.debug('Removing the old generation {}'.format(name))
+        shutil.rmtree(os.path.join(generations, name), ignore_errors=True)
@@ -0,0 +1,170 @@
+"""Incremental repodata generation
+
+The repodata of every distro dir of a repo is generated with
+``createrepo_c --update``, which reuses the entries of the previous
+repodata for the RPMs whose size and mtime didn't change, and with a
+persistent ``--cachedir``, which keeps the checksums of the RPMs
+between runs. Both are kept in the repo's state dir.
+
+A stamp of the RPMs of every distro dir is recorded after its repodata
+was generated, so createrepo_c isn't run at all if they didn't change.
+
+Repoman can't be told to leave the repodata alone, so ``repoman add``
+still generates it from scratch. Only the builtin merge backend, and
+the incremental merges that only remove packages without a repoman
+config, go through :func:`update_all`.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+
+from mkrepo import metrics as metrics_mod
+from mkrepo import runner
+from mkrepo import utils
+
+LOGGER = logging.getLogger(__name__)
+
+CACHE_DIR = 'createrepo-cache'
+STAMPS_DIR = 'repodata-stamps'
+REPODATA = 'repodata'
+
+
+class RepodataError(Exception):
+    pass
+
+
+def repo_dirs(dest):
+    """Get the distro dirs of ``dest``, e.g ``<dest>/el7``
+
+    Returns:
+        list of str: Paths of the dirs that hold RPMs or repodata
+    """
+    dirs = []
+    for name in sorted(os.listdir(dest)):
+        path = os.path.join(dest, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        if os.path.isdir(os.path.join(path, REPODATA)) or _rpm_stats(path):
+            dirs.append(path)
+
+    return dirs
+
+
+def update(dest, distro, timeout=None, metrics=metrics_mod.NULL,
+           force=False):
+    """Generate or update the repodata of ``<dest>/<distro>``
+
+    Args:
+        dest(str): Path to the repo
+        distro(str): Name of the distro dir, e.g ``el7``
+        timeout(float): Max seconds for the createrepo_c run
+        metrics(metrics.Metrics): Where to record the createrepo_c run
+        force(bool): Run createrepo_c even if the RPMs didn't change
+
+    Returns:
+        bool: True if createrepo_c was run
+
+    Raises:
+        RepodataError: If createrepo_c failed
+    """
+    repo_dir = os.path.join(dest, distro)
+    state_dir = os.path.join(dest, utils.STATE_DIR)
+    stamp_path = os.path.join(state_dir, STAMPS_DIR, distro)
+    utils.safe_mkdir(repo_dir, os.path.dirname(stamp_path))
+
+    stamp = _stamp(repo_dir)
+    if not force and _read_stamp(stamp_path) == stamp and os.path.isfile(
+        os.path.join(repo_dir, REPODATA, 'repomd.xml')
+    ):
+        LOGGER.info('Repodata of {} is up to date'.format(repo_dir))
+        return False
+
+    _drop_stamp(stamp_path)
+    LOGGER.info('Updating repodata of {}'.format(repo_dir))
+    cmd = [
+        'createrepo_c', '--update',
+        '--cachedir', os.path.join(state_dir, CACHE_DIR),
+        repo_dir,
+    ]
+    status = None
+    try:
+        status = runner.run_command_sync(cmd, timeout=timeout)
+    finally:
+        metrics.command('merge', dest, status, subcommand='createrepo_c')
+    if status.code:
+        raise RepodataError(
+            'Failed to generate repodata for {}\n{}'.format(
+                repo_dir, status.err
+            )
+        )
+
+    with open(stamp_path + '.tmp', 'w') as f:
+        f.write(stamp)
+    os.rename(stamp_path + '.tmp', stamp_path)
+    return True
+
+
+def update_all(dest, timeout=None, metrics=metrics_mod.NULL):
+    """Call :func:`update` for every distro dir of ``dest``
+
+    Returns:
+        list of str: The distros whose repodata was generated
+    """
+    return [
+        os.path.basename(repo_dir) for repo_dir in repo_dirs(dest)
+        if update(
+            dest, os.path.basename(repo_dir), timeout=timeout,
+            metrics=metrics
+        )
+    ]
+
+
+def invalidate(dest):
+    """Forget the stamps of ``dest``, e.g when something else wrote its
+    repodata
+    """
+    shutil.rmtree(
+        os.path.join(dest, utils.STATE_DIR, STAMPS_DIR), ignore_errors=True
+    )
+
+
+def _stamp(repo_dir):
+    digest = hashlib.sha256()
+    for path, size, mtime in sorted(_rpm_stats(repo_dir)):
+        digest.update('{}\0{}\0{}\n'.format(path, size, mtime).encode())
+    return digest.hexdigest()
+
+
+def _rpm_stats(repo_dir):
+    stats = []
+    for dirpath, dirnames, filenames in os.walk(repo_dir):
+        dirnames[:] = [
+            d for d in dirnames if not d.startswith('.') and d != REPODATA
+        ]
+        for f in filenames:
+            if not f.endswith('.rpm'):
+                continue
+            path = os.path.join(dirpath, f)
+            st = os.stat(path)
+            stats.append(
+                (os.path.relpath(path, repo_dir), st.st_size, st.st_mtime_ns)
+            )
+
+    return stats
+
+
+def _read_stamp(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def _drop_stamp(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
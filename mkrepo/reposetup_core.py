@@ -4,12 +4,29 @@
 
 import logging
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from collections import OrderedDict
-
-
+from contextlib import ExitStack
+from functools import partial
+
+
+from mkrepo import blobstore
+from mkrepo import cachegc
+from mkrepo import delta
+from mkrepo import fingerprint
+from mkrepo import linking
+from mkrepo import merge
+from mkrepo import metrics as metrics_mod
+from mkrepo import publish
+from mkrepo import repodata
 from mkrepo import reposync
+from mkrepo import runner
+from mkrepo import sourcecache
 from mkrepo import utils
+from mkrepo import verify as verify_mod
 
 LOGGER = logging.getLogger(__name__)
 
@@ -24,8 +41,18 @@ class RepomanError(Exception):
 
 def reposetup(
     dest, sync_dir, sync, yum_config,
-    repoman_config, custom_source, lock_timeout
+    repoman_config, custom_source, lock_timeout, sync_jobs=1,
+    metadata_cache_max_age=reposync.DEFAULT_CACHE_MAX_AGE,
+    metadata_cache_max_size=reposync.DEFAULT_CACHE_MAX_SIZE,
+    incremental_merge=False, link_mode=linking.COPY,
+    sync_timeout=None, merge_timeout=None, metrics_file=None,
+    sync_retries=reposync.DEFAULT_RETRY_ATTEMPTS,
+    sync_retry_backoff=reposync.DEFAULT_RETRY_BACKOFF,
+    merge_backend=merge.REPOMAN, sync_max_age=None, dedup=False,
+    gc_budget=None, cache_custom_sources=False, force_merge=False,
+    staged=False, pipeline=False, verify=False
 ):
+    metrics = metrics_mod.Metrics() if metrics_file else metrics_mod.NULL
     try:
         _reposetup(
             dest=dest,
@@ -34,18 +61,49 @@ def reposetup(
             yum_config=yum_config,
             repoman_config=repoman_config,
             custom_source=custom_source,
-            lock_timeout=lock_timeout
+            lock_timeout=lock_timeout,
+            sync_jobs=sync_jobs,
+            metadata_cache_max_age=metadata_cache_max_age,
+            metadata_cache_max_size=metadata_cache_max_size,
+            incremental_merge=incremental_merge,
+            link_mode=link_mode,
+            sync_timeout=sync_timeout,
+            merge_timeout=merge_timeout,
+            metrics=metrics,
+            sync_retries=sync_retries,
+            sync_retry_backoff=sync_retry_backoff,
+            merge_backend=merge_backend,
+            sync_max_age=sync_max_age,
+            dedup=dedup,
+            gc_budget=gc_budget,
+            cache_custom_sources=cache_custom_sources,
+            force_merge=force_merge,
+            staged=staged,
+            pipeline=pipeline,
+            verify=verify
         )
         LOGGER.info('Successfully created repo {}'.format(dest))
     except Exception as e:
         LOGGER.error('Failed to create repo {}'.format(dest))
         debug_err(e)
         raise ReposetupError(str(e))
+    finally:
+        if metrics_file:
+            metrics.write(metrics_file)
 
 
 def _reposetup(
     dest, sync_dir, sync, yum_config,
-    repoman_config, custom_source, lock_timeout
+    repoman_config, custom_source, lock_timeout, sync_jobs=1,
+    metadata_cache_max_age=reposync.DEFAULT_CACHE_MAX_AGE,
+    metadata_cache_max_size=reposync.DEFAULT_CACHE_MAX_SIZE,
+    incremental_merge=False, link_mode=linking.COPY,
+    sync_timeout=None, merge_timeout=None, metrics=metrics_mod.NULL,
+    sync_retries=reposync.DEFAULT_RETRY_ATTEMPTS,
+    sync_retry_backoff=reposync.DEFAULT_RETRY_BACKOFF,
+    merge_backend=merge.REPOMAN, sync_max_age=None, dedup=False,
+    gc_budget=None, cache_custom_sources=False, force_merge=False,
+    staged=False, pipeline=False, verify=False
 ):
     """Run the main flow
 
@@ -56,31 +114,559 @@ def _reposetup(
         yum_config (str)
         repoman_config (str)
         custom_source (list)
+        lock_timeout (int)
+        sync_jobs (int): Number of repoids to sync concurrently
+        metadata_cache_max_age (int): Max age in seconds of a repoid's
+            reposync metadata cache
+        metadata_cache_max_size (int): Max size in bytes of a repoid's
+            reposync metadata cache
+        incremental_merge (bool): Only merge the packages that changed
+            since the last merge into dest
+        link_mode (str): How to populate dest with RPMs from the cache,
+            one of :data:`linking.LINK_MODES`
+        sync_timeout (float): Max seconds for a single reposync run
+        merge_timeout (float): Max seconds for a single repoman run
+        metrics (metrics.Metrics): Where to record timings and throughput
+        sync_retries (int): Max number of reposync runs per repoid
+        sync_retry_backoff (float): Seconds to wait before the first
+            reposync retry, doubled for every retry
+        merge_backend (str): One of :data:`merge.BACKENDS`
+        sync_max_age (float): If set, skip the sync of the repoids that
+            were synced less than that many seconds ago, or whose
+            upstream repomd.xml didn't change since their last sync
+            (see :func:`reposync.check_freshness`)
+        dedup (bool): Store the synced RPMs in the blob store of
+            ``sync_dir`` (see :mod:`mkrepo.blobstore`)
+        gc_budget (int): If set, shrink the RPM cache to that many bytes
+            once the build is done (see :func:`cachegc.collect`)
+        cache_custom_sources (bool): Merge local copies of the custom
+            sources, kept in ``sync_dir`` (see :mod:`mkrepo.sourcecache`)
+        force_merge (bool): Merge even if the fingerprint of the build
+            didn't change (see :func:`merge_if_changed`)
+        staged (bool): Build a new generation of ``dest`` and publish it
+            atomically, instead of merging into ``dest``
+            (see :mod:`mkrepo.publish`)
+        pipeline (bool): Merge every repoid as soon as it's synced,
+            instead of once all of them are (see :func:`_pipelined_merge`),
+            only with the builtin ``merge_backend``
+        verify (bool): Verify the RPMs of the cache before merging them,
+            see :func:`verify_caches`
     """
+    check_link_mode(link_mode, merge_backend)
+    check_pipeline(pipeline, merge_backend)
     repoid_to_path = get_repo_paths(sync_dir, yum_config)
-    utils.safe_mkdir(dest, *repoid_to_path.values())
+    lock_dest = publish.generations_dir(dest) if staged else dest
+    utils.safe_mkdir(lock_dest, *repoid_to_path.values())
+
+    check_freshness = bool(sync and yum_config and sync_max_age is not None)
+
+    source_paths = []
+    if cache_custom_sources:
+        with metrics.phase('custom-sources'):
+            custom_source, source_paths = sourcecache.resolve(
+                sync_dir, custom_source, lock_timeout=lock_timeout
+            )
+
+    with ExitStack() as stack:
+        with metrics.phase('lock'):
+            locks = stack.enter_context(
+                utils.LockFiles(
+                    **get_lock_plan(
+                        lock_dest, repoid_to_path.values(), sync,
+                        lock_timeout,
+                        fresh_paths=(
+                            repoid_to_path.values() if check_freshness
+                            else ()
+                        ),
+                        source_paths=source_paths,
+                        verify=verify
+                    )
+                )
+            )
+        to_sync, repomd_checksums = list(repoid_to_path.keys()), {}
+        if check_freshness:
+            to_sync, repomd_checksums = lock_stale(
+                locks, yum_config, sync_dir, repoid_to_path, sync_max_age,
+                metrics=metrics
+            )
+        cachegc.touch(list(repoid_to_path.values()) + source_paths)
+
+        sync_kwargs = dict(
+            jobs=sync_jobs,
+            cache_max_age=metadata_cache_max_age,
+            cache_max_size=metadata_cache_max_size,
+            timeout=sync_timeout,
+            metrics=metrics,
+            retry=reposync.RetryPolicy(
+                attempts=sync_retries, backoff=sync_retry_backoff
+            ),
+            repomd_checksums=repomd_checksums,
+            dedup=dedup
+        )
+        if pipeline and sync and yum_config and to_sync:
+            if incremental_merge:
+                LOGGER.info('Pipelined merges are never incremental')
+            _pipelined_merge(
+                yum_config, sync_dir, repoid_to_path, to_sync, locks,
+                custom_source, source_paths, dest, repoman_config,
+                sync_kwargs,
+                staged=staged,
+                verify=verify,
+                lock_timeout=lock_timeout,
+                link_mode=link_mode,
+                timeout=merge_timeout,
+                metrics=metrics,
+                backend=merge_backend
+            )
+        else:
+            if sync and to_sync:
+                with metrics.phase('sync'):
+                    do_sync(yum_config, sync_dir, to_sync, **sync_kwargs)
+            if verify and yum_config:
+                verify_caches(
+                    yum_config, sync_dir, list(repoid_to_path.keys()),
+                    sync_kwargs if sync else None, metrics=metrics
+                )
+
+            merge_if_changed(
+                merge_sources(custom_source, repoid_to_path.values()),
+                dest,
+                yum_config,
+                repoman_config,
+                force=force_merge,
+                staged=staged,
+                lock_timeout=lock_timeout,
+                incremental=incremental_merge,
+                cache_dirs=list(repoid_to_path.values()) + source_paths,
+                link_mode=link_mode,
+                timeout=merge_timeout,
+                metrics=metrics,
+                backend=merge_backend
+            )
+
+    if gc_budget is not None:
+        with metrics.phase('gc'):
+            cachegc.collect(
+                sync_dir, gc_budget,
+                keep=list(repoid_to_path.keys()) + [
+                    os.path.relpath(p, sync_dir) for p in source_paths
+                ],
+                lock_timeout=lock_timeout
+            )
+
+
+def lock_stale(
+    locks, yum_config, sync_dir, repoid_to_path, max_age,
+    metrics=metrics_mod.NULL
+):
+    """Find the repoids that need a sync, and lock their cache dirs
+    exclusively
+
+    The freshness of the repoids is checked while ``locks`` holds the
+    cache dirs, at least shared, so no other build can sync them in
+    between. Upgrading the locks of the stale cache dirs releases the
+    locks that come after them for a moment though (see
+    :meth:`utils.LockFiles.upgrade`), so the repoids whose sync stamp
+    changed meanwhile are checked again.
+
+    Args:
+        locks (utils.LockFiles): The locks of the cache dirs
+        yum_config (str)
+        sync_dir (str)
+        repoid_to_path (dict): The cache dir of every repoid
+        max_age (float): See :func:`reposync.check_freshness`
+        metrics (metrics.Metrics)
+
+    Returns:
+        tuple: The list of repoids to sync, and a dict of repoid to the
+            sha256 of its upstream repomd.xml
+    """
+    stale, checksums = set(), {}
+    to_check = list(repoid_to_path.keys())
+    while to_check:
+        with metrics.phase('freshness'):
+            fresh, found = reposync.check_freshness(
+                yum_config, sync_dir, to_check, max_age
+            )
+        checksums.update(found)
+        new_stale = [r for r in to_check if r not in fresh]
+        if not new_stale:
+            break
+
+        stamps = dict((r, reposync.read_stamp(sync_dir, r)) for r in fresh)
+        locks.upgrade([repoid_to_path[r] for r in new_stale])
+        stale.update(new_stale)
+        to_check = [
+            r for r in fresh if reposync.read_stamp(sync_dir, r) != stamps[r]
+        ]
+
+    return [r for r in repoid_to_path if r in stale], checksums
+
+
+def merge_sources(custom_source, cache_paths):
+    """The sources of a target repo: the custom sources first, then
+    the packages of the RPM cache which are not in them
+    """
+    return list(custom_source) + [p + ':only-missing' for p in cache_paths]
+
+
+def merge_if_changed(
+    sources, dest, yum_config, repoman_config, force=False,
+    metrics=metrics_mod.NULL, staged=False, lock_timeout=180, **kwargs
+):
+    """Call :func:`do_merge`, unless ``dest`` is already the result
+
+    The fingerprint of the build (see :mod:`mkrepo.fingerprint`) is
+    compared with the one of the last merge into ``dest``, the merge is
+    skipped if they match.
+
+    Args:
+        sources (list of str)
+        dest (str)
+        yum_config (str)
+        repoman_config (str)
+        force (bool): Merge even if the fingerprints match
+        metrics (metrics.Metrics)
+        staged (bool): Merge into a new generation of ``dest``, and
+            publish it atomically (see :mod:`mkrepo.publish`). The build
+            lock of ``dest`` must be held instead of the lock of
+            ``dest``.
+        lock_timeout (int): Max seconds to wait for the publish lock
+        **kwargs: See :func:`do_merge`
+
+    Returns:
+        bool: True if the merge was run
+    """
+    with metrics.phase('fingerprint'):
+        current = fingerprint.compute(
+            sources, yum_config, repoman_config,
+            backend=kwargs.get('backend', merge.REPOMAN),
+            link_mode=kwargs.get('link_mode', linking.COPY),
+        )
+        if not force and fingerprint.matches(dest, current):
+            LOGGER.info(
+                'Nothing changed since the last build of {}, '
+                'skipping the merge'.format(dest)
+            )
+            return False
+
+    target = dest
+    if staged:
+        with metrics.phase('stage'):
+            target = publish.stage(dest)
+    try:
+        fingerprint.drop(target)
+        do_merge(sources, target, repoman_config, metrics=metrics, **kwargs)
+        fingerprint.save(target, current)
+        if staged:
+            with metrics.phase('publish'):
+                publish.publish(dest, target, lock_timeout)
+    except BaseException:
+        if staged:
+            publish.discard(target)
+        raise
+
+    return True
+
+
+def _pipelined_merge(
+    yum_config, sync_dir, repoid_to_path, to_sync, locks, custom_source,
+    source_paths, dest, repoman_config, sync_kwargs, staged=False,
+    verify=False, lock_timeout=180, link_mode=linking.COPY, timeout=None,
+    metrics=metrics_mod.NULL, backend=merge.BUILTIN
+):
+    """Sync ``to_sync`` in the background, and merge every cache dir into
+    ``dest`` as soon as it's synced
+
+    The sources are merged one at a time, in the order of
+    :func:`merge_sources`: the custom sources, then the cache dirs in
+    the order of the yum config, so the result is the same as a full
+    merge. Once a cache dir is synced (and verified) its lock is
+    downgraded to a shared one, and once it's merged its lock is
+    released, so other builds can sync it. The repodata is generated
+    once, after the last merge, so only the builtin backend is supported.
+
+    Args:
+        yum_config (str)
+        sync_dir (str)
+        repoid_to_path (OrderedDict): repoid to cache dir
+        to_sync (list of str): The repoids to sync
+        locks (utils.LockFiles): The held locks of the cache dirs
+        custom_source (list of str)
+        source_paths (list of str): The cached custom sources
+        dest (str)
+        repoman_config (str)
+        sync_kwargs (dict): kwargs for :func:`do_sync`
+        staged (bool): See :func:`merge_if_changed`
+        verify (bool): Verify every cache dir before merging it, the
+            merge stops before the first one with corrupt RPMs
+        lock_timeout (int)
+        link_mode (str)
+        timeout (float): Max seconds for a single merge command
+        metrics (metrics.Metrics)
+        backend (str): Must be :data:`merge.BUILTIN`
+
+    Raises:
+        ValueError: If ``backend`` isn't the builtin one
+        reposync.ReposyncError: If a repoid failed to sync, the merge
+            stops before it, ``dest`` is left partially merged unless
+            ``staged`` is set
+        verify.VerifyError: If a repoid has corrupt RPMs, likewise
+    """
+    check_link_mode(link_mode, backend)
+    check_pipeline(True, backend)
+    target = dest
+    if staged:
+        with metrics.phase('stage'):
+            target = publish.stage(dest)
+
+    def merge_step(sources, cache_dirs, name):
+        with metrics.phase('merge-step', source=name):
+            merge.merge(
+                sources, target, cache_dirs=cache_dirs,
+                link_mode=link_mode, timeout=timeout, metrics=metrics,
+                update_repodata=False
+            )
+
+    def sync():
+        with metrics.phase('sync'):
+            do_sync(
+                yum_config, sync_dir, to_sync, on_done=results.put,
+                **sync_kwargs
+            )
+
+    results = queue.Queue()
+    synced = {}
+    listings = {}
+    try:
+        fingerprint.drop(target)
+        delta.drop_manifest(target)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            syncing = executor.submit(sync)
+            if custom_source:
+                merge_step(custom_source, source_paths, 'custom-sources')
+            for repoid, path in repoid_to_path.items():
+                if repoid in to_sync and not _wait_for_sync(
+                    repoid, results, syncing, synced,
+                    None if verify else locks, repoid_to_path
+                ):
+                    LOGGER.error(
+                        'Failed to sync {}, not merging it and the '
+                        'repoids after it'.format(repoid)
+                    )
+                    break
+                if verify:
+                    verify_caches(
+                        yum_config, sync_dir, [repoid], metrics=metrics
+                    )
+                    locks.downgrade(path)
+                merge_step([path + ':only-missing'], [path], repoid)
+                listings[path] = fingerprint.listing(path)
+                locks.release(path)
+        syncing.result()
+
+        repodata.update_all(target, timeout=timeout, metrics=metrics)
+        fingerprint.save(
+            target,
+            fingerprint.compute(
+                merge_sources(custom_source, repoid_to_path.values()),
+                yum_config, repoman_config, listings=listings,
+                backend=backend, link_mode=link_mode
+            )
+        )
+        if staged:
+            with metrics.phase('publish'):
+                publish.publish(dest, target, lock_timeout)
+    except BaseException:
+        if staged:
+            publish.discard(target)
+        raise
+
+
+def _wait_for_sync(repoid, results, syncing, synced, locks, repoid_to_path):
+    """Wait until ``repoid`` is synced
+
+    The lock of every repoid that finished syncing in the meantime is
+    downgraded to a shared one, unless ``locks`` is None.
+
+    Returns:
+        bool: True if ``repoid`` was synced successfully
+    """
+    while repoid not in synced:
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            if syncing.done() and results.empty():
+                return False
+            continue
+        synced[result.repoid] = result
+        if result.error is None and locks is not None:
+            locks.downgrade(repoid_to_path[result.repoid])
+
+    return synced[repoid].error is None
+
+
+def verify_caches(
+    yum_config, sync_dir, repoids, sync_kwargs=None,
+    metrics=metrics_mod.NULL
+):
+    """Verify the RPMs of ``repoids``, and remove the corrupt ones
+
+    The locks of the cache dirs must be held exclusively.
+
+    Args:
+        yum_config (str)
+        sync_dir (str)
+        repoids (list of str)
+        sync_kwargs (dict): kwargs for :func:`do_sync`, to sync the
+            repoids with corrupt RPMs again, which are verified again
+            afterwards. If None, they are not synced.
+        metrics (metrics.Metrics)
+
+    Raises:
+        verify.VerifyError: If corrupt RPMs are left
+    """
+    reports = verify_mod.verify(sync_dir, yum_config, repoids, metrics=metrics)
+    corrupt = [r.repoid for r in reports if r.corrupt]
+    if corrupt and sync_kwargs is not None:
+        LOGGER.info(
+            'Syncing {} again to replace their corrupt RPMs'.format(
+                ', '.join(corrupt)
+            )
+        )
+        with metrics.phase('sync'):
+            do_sync(yum_config, sync_dir, corrupt, **sync_kwargs)
+        reports = verify_mod.verify(
+            sync_dir, yum_config, corrupt, metrics=metrics
+        )
+        corrupt = [r.repoid for r in reports if r.corrupt]
+
+    if corrupt:
+        raise verify_mod.VerifyError(
+            'Corrupt RPMs in: {}'.format(', '.join(corrupt)), corrupt
+        )
+
+
+def verify(
+    sync_dir, yum_config, lock_timeout, jobs=verify_mod.DEFAULT_JOBS,
+    remove=True
+):
+    """Verify the RPMs of every repoid against their primary metadata
+
+    Args:
+        sync_dir (str)
+        yum_config (str)
+        lock_timeout (int)
+        jobs (int): Max number of RPMs to hash concurrently
+        remove (bool): Remove the corrupt RPMs
 
+    Returns:
+        list of verify.VerifyReport
+    """
+    repoid_to_path = get_repo_paths(sync_dir, yum_config)
+    utils.safe_mkdir(*repoid_to_path.values())
+    paths = list(repoid_to_path.values())
     with utils.LockFiles(
-        [dest] + repoid_to_path.values(),
+        paths if remove else [],
+        shared_paths=[] if remove else paths,
         timeout=lock_timeout,
         lock_name='mkrepo.lock'
     ):
-        if sync:
-            do_sync(yum_config, sync_dir, repoid_to_path.keys())
-
-        do_merge(
-            custom_source
-            + [r + ':only-missing' for r in repoid_to_path.values()],
-            dest,
-            repoman_config
+        return verify_mod.verify(
+            sync_dir, yum_config, list(repoid_to_path.keys()), jobs=jobs,
+            remove=remove
         )
 
 
+def dedup(sync_dir, yum_config, lock_timeout):
+    """Store the RPMs of every repoid in the blob store of ``sync_dir``
+
+    Args:
+        sync_dir (str)
+        yum_config (str)
+        lock_timeout (int)
+
+    Returns:
+        blobstore.DedupReport
+    """
+    repo_paths = list(get_repo_paths(sync_dir, yum_config).values())
+    utils.safe_mkdir(*repo_paths)
+    with utils.LockFiles(
+        repo_paths, timeout=lock_timeout, lock_name='mkrepo.lock'
+    ):
+        return blobstore.dedup(sync_dir, repo_paths)
+
+
+def get_lock_plan(
+    dest, cache_paths, sync, lock_timeout, fresh_paths=(), source_paths=(),
+    verify=False
+):
+    """Get the arguments for :class:`utils.LockFiles`
+
+    ``dest`` is always locked exclusively. The cache dirs are locked
+    exclusively only if they are going to be synced or verified,
+    otherwise they are only read by :func:`do_merge`, so a shared lock
+    is enough.
+
+    Args:
+        dest (str)
+        cache_paths (list of str): The cache dirs of the repoids
+        sync (bool): If the cache dirs are going to be synced
+        lock_timeout (int)
+        fresh_paths (list of str): Cache dirs that are not going to be
+            synced even if ``sync`` is True
+        source_paths (list of str): Cached custom sources, they are only
+            read, so they are locked shared
+        verify (bool): If the cache dirs are going to be verified, corrupt
+            RPMs are removed from them
+
+    Returns:
+        dict: kwargs for :class:`utils.LockFiles`
+    """
+    cache_paths = list(cache_paths)
+    fresh_paths = set(fresh_paths)
+    synced = [
+        p for p in cache_paths if verify or sync and p not in fresh_paths
+    ]
+    exclusive = [dest] + synced
+    shared = [p for p in cache_paths if p not in synced] + list(source_paths)
+
+    return dict(
+        paths=exclusive,
+        shared_paths=shared,
+        timeout=lock_timeout,
+        lock_name='mkrepo.lock',
+    )
+
+
+_repo_paths_cache = {}
+_repo_paths_lock = threading.Lock()
+
+
 def get_repo_paths(sync_dir, yum_config):
-    if yum_config:
-        return _get_repo_paths(sync_dir, yum_config)
+    """Get the paths where each repo will be synced
 
-    return {}
+    The result is cached as long as ``yum_config`` isn't modified,
+    which helps a long running process like ``mkrepo serve``.
+    """
+    if not yum_config:
+        return {}
+
+    key = (sync_dir, yum_config)
+    try:
+        st = os.stat(yum_config)
+        stamp = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        stamp = None
+
+    with _repo_paths_lock:
+        cached_stamp, cached = _repo_paths_cache.get(key, (None, None))
+    if stamp is None or cached_stamp != stamp:
+        cached = _get_repo_paths(sync_dir, yum_config)
+        with _repo_paths_lock:
+            _repo_paths_cache[key] = (stamp, cached)
+
+    return OrderedDict(cached)
 
 
 def _get_repo_paths(sync_dir, yum_config):
@@ -111,16 +697,20 @@ def _get_repo_paths(sync_dir, yum_config):
     )
 
 
-def do_sync(yum_config, sync_dir, repoids):
+def do_sync(yum_config, sync_dir, repoids, jobs=1, **kwargs):
     if yum_config and repoids:
-        reposync.sync(yum_config, sync_dir, repoids)
+        reposync.sync(yum_config, sync_dir, repoids, jobs=jobs, **kwargs)
     elif yum_config:
         LOGGER.debug('Yum config is empty')
     else:
         LOGGER.debug('Yum config not provided, skipping sync')
 
 
-def do_merge(sources, dest, repoman_config=None):
+def do_merge(
+    sources, dest, repoman_config=None, incremental=False, cache_dirs=(),
+    link_mode=linking.COPY, timeout=None, metrics=metrics_mod.NULL,
+    backend=merge.REPOMAN
+):
     """
     Run repoman on ``sources``, creating a new RPM repository in
     ``dest``
@@ -138,18 +728,152 @@ def do_merge(sources, dest, repoman_config=None):
             |  on_wrong_distro=copy_to_all
             |  with_srcrpms=false
             |  with_sources=false
+        incremental(bool): If True, only merge the packages that changed
+            in ``sources`` since the last merge into ``dest``
+            (see :mod:`mkrepo.delta`). A full merge is done if there is
+            no record of the last merge, if the list of sources or
+            the repoman config changed, or if one of the sources isn't
+            a local path or has filters other than ``only-missing``.
+            If packages were only removed, the repodata is updated with
+            :func:`repodata.update_all`, unless a ``repoman_config`` was
+            passed, otherwise repoman generates it from scratch.
+        cache_dirs(list of str): The dirs of the RPM cache that are part
+            of ``sources``. They are listed with :class:`rpmindex.RpmIndex`
+            in incremental mode.
+        link_mode(str): One of :data:`linking.LINK_MODES`, how the
+            builtin backend puts the RPMs of ``cache_dirs`` in ``dest``.
+            Repoman always copies them, so only ``copy`` is allowed with
+            the repoman backend.
+        timeout(float): Max seconds for a single repoman run
+        metrics(metrics.Metrics): Where to record the duration of the
+            merge, every repoman run and the RPMs added and removed
+        backend(str): One of :data:`merge.BACKENDS`. With ``builtin``,
+            the packages are resolved in-process by :func:`merge.merge`
+            instead of repoman, which only adds the missing RPMs to
+            ``dest``, so ``incremental`` and ``repoman_config`` are
+            ignored, and the RPMs are linked right away.
 
     Raises:
+        :exc:`ValueError`: If ``link_mode`` isn't ``copy`` with the
+            repoman backend.
         :exc:`RepositoryMergeError`: If repoman command failed.
         :exc:`IOError`: If ``repoman_config`` is passed but does not exists.
+        :exc:`runner.CommandTimeout`: If repoman didn't finish in time.
+        :exc:`merge.MergeError`: If the builtin backend failed.
 
     Returns:
         None
     """
-    cmd = []
-    cmd_suffix = [
-        '--option=store.RPMStore.rpm_dir=', dest, 'add'
-    ] + sources
+    check_link_mode(link_mode, backend)
+    if metrics.enabled:
+        rpms_before = metrics_mod.list_rpm_sizes(dest)
+
+    if backend == merge.BUILTIN:
+        with metrics.phase('merge'):
+            merge.merge(
+                sources, dest, cache_dirs=cache_dirs, link_mode=link_mode,
+                timeout=timeout, metrics=metrics
+            )
+    else:
+        _repoman_merge(
+            sources, dest, repoman_config, incremental, cache_dirs,
+            timeout, metrics
+        )
+
+    if metrics.enabled:
+        metrics.rpm_changes(
+            'merge', dest, rpms_before, metrics_mod.list_rpm_sizes(dest)
+        )
+
+
+def check_link_mode(link_mode, backend):
+    """Check that ``backend`` can populate a repo with ``link_mode``
+
+    Raises:
+        ValueError: If it can't
+    """
+    if link_mode != linking.COPY and backend != merge.BUILTIN:
+        raise ValueError(
+            'Link mode {} is only supported by the {} merge '
+            'backend'.format(link_mode, merge.BUILTIN)
+        )
+
+
+def check_pipeline(pipeline, backend):
+    """Check that ``backend`` can merge a repo in a pipeline
+
+    The builtin backend generates the repodata once all the repoids are
+    merged, repoman would generate it on every merge.
+
+    Raises:
+        ValueError: If it can't
+    """
+    if pipeline and backend != merge.BUILTIN:
+        raise ValueError(
+            'Pipelined merges are only supported by the {} merge '
+            'backend'.format(merge.BUILTIN)
+        )
+
+
+def _repoman_merge(
+    sources, dest, repoman_config, incremental, cache_dirs, timeout,
+    metrics
+):
+    repoman_cmd = _get_repoman_cmd(dest, repoman_config)
+    run_repoman = partial(
+        _run_repoman, dest=dest, timeout=timeout, metrics=metrics
+    )
+    update_repodata = partial(
+        repodata.update_all, dest, timeout=timeout, metrics=metrics
+    )
+    repodata.invalidate(dest)
+
+    with metrics.phase('merge'):
+        if incremental:
+            _incremental_merge(
+                repoman_cmd, sources, dest, repoman_config, cache_dirs,
+                run_repoman, update_repodata
+            )
+        else:
+            run_repoman(repoman_cmd + ['add'] + sources, sources)
+
+
+def _incremental_merge(
+    repoman_cmd, sources, dest, repoman_config, cache_dirs, run_repoman,
+    update_repodata
+):
+    current = delta.snapshot(sources, repoman_config, cache_dirs)
+    merge_plan = delta.plan(delta.load_manifest(dest), current)
+    delta.drop_manifest(dest)
+
+    if merge_plan is None:
+        LOGGER.info('Running a full merge into {}'.format(dest))
+        run_repoman(repoman_cmd + ['add'] + sources, sources)
+    elif not merge_plan.remove:
+        LOGGER.info('{} is up to date, nothing to merge'.format(dest))
+    else:
+        LOGGER.info(
+            'Merging {} changed packages into {}'.format(
+                len(merge_plan.remove), dest
+            )
+        )
+        delta.remove_rpms(dest, merge_plan.remove)
+        if merge_plan.sources:
+            run_repoman(
+                repoman_cmd + ['add'] + merge_plan.sources,
+                merge_plan.sources
+            )
+        elif repoman_config is None:
+            update_repodata()
+        else:
+            run_repoman(repoman_cmd + ['createrepo'], [])
+
+    if current is not None:
+        delta.save_manifest(dest, current)
+
+
+def _get_repoman_cmd(dest, repoman_config=None):
+    cmd_suffix = ['--option=store.RPMStore.rpm_dir=', dest]
     if repoman_config is None:
         repoman_params = [
             '--option=main.on_empty_source=warn',
@@ -157,20 +881,29 @@ def do_merge(sources, dest, repoman_config=None):
             '--option=store.RPMStore.with_srcrpms=false',
             '--option=store.RPMStore.with_sources=false',
         ]
-        cmd = ['repoman'] + repoman_params + cmd_suffix
-    else:
-        if os.path.isfile(repoman_config):
-            cmd = ['repoman', '--config={0}'.format(repoman_config)
-                   ] + cmd_suffix
-        else:
-            raise IOError(
-                ('error running repoman, {0} not '
-                 'found').format(repoman_config)
-            )
+        return ['repoman'] + repoman_params + cmd_suffix
+
+    if os.path.isfile(repoman_config):
+        return ['repoman', '--config={0}'.format(repoman_config)
+                ] + cmd_suffix
 
+    raise IOError(
+        ('error running repoman, {0} not '
+         'found').format(repoman_config)
+    )
+
+
+def _run_repoman(cmd, sources, dest, timeout=None, metrics=metrics_mod.NULL):
     LOGGER.info('Running repoman')
 
-    ret, out, err = utils.run_command(cmd)
+    status = None
+    try:
+        status = runner.run_command_sync(cmd, timeout=timeout)
+    finally:
+        metrics.command(
+            'merge', dest, status, subcommand=cmd[cmd.index(dest) + 1]
+        )
+    ret, out, err = status
     if ret:
         raise RepomanError(
             (
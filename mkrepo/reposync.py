@@ -1,71 +1,591 @@
 """Wrapper around reposync"""
 
+import asyncio
+import hashlib
+import json
 import logging
+import random
 import re
 import itertools
 import os
-import tempfile
 import shutil
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from urllib.request import urlopen
 
+from mkrepo import blobstore
+from mkrepo import metrics as metrics_mod
+from mkrepo import rpmindex
+from mkrepo import runner
 from mkrepo import utils
 
 LOGGER = logging.getLogger(__name__)
 
 
 class ReposyncError(Exception):
-    pass
+    """Reposync failed
 
+    Attributes:
+        repoids(list of str): The repoids that failed to sync
+    """
+
+    def __init__(self, message, repoids=()):
+        super(ReposyncError, self).__init__(message)
+        self.repoids = list(repoids)
+
+
+SyncResult = namedtuple('SyncResult', ('repoid', 'attempts', 'error'))
+
+DEFAULT_RETRY_ATTEMPTS = 3
+DEFAULT_RETRY_BACKOFF = 5
+DEFAULT_RETRY_MAX_BACKOFF = 60
+
+
+class RetryPolicy(namedtuple(
+    'RetryPolicy', ('attempts', 'backoff', 'max_backoff')
+)):
+    """How to retry a failed reposync
+
+    Attributes:
+        attempts(int): Max number of reposync runs for a repoid
+        backoff(float): Seconds to wait before the first retry, doubled
+            for every retry
+        max_backoff(float): Max seconds to wait between retries
+    """
+
+    def __new__(
+        cls, attempts=DEFAULT_RETRY_ATTEMPTS,
+        backoff=DEFAULT_RETRY_BACKOFF,
+        max_backoff=DEFAULT_RETRY_MAX_BACKOFF
+    ):
+        return super(RetryPolicy, cls).__new__(
+            cls, attempts, backoff, max_backoff
+        )
+
+    def delay(self, attempt):
+        """Seconds to wait after ``attempt`` failed, with jitter"""
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return delay * random.uniform(0.5, 1)
+
+
+METADATA_CACHE_DIR = '.reposync-cache'
+DEFAULT_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+DEFAULT_CACHE_MAX_SIZE = 1024 ** 3
+
+
+class MetadataCache(object):
+    """A persistent reposync metadata cache, one cache dir per repoid
+
+    The cache lives under ``sync_dir`` so it survives between runs.
+    A cache dir is only touched while syncing its repoid, hence it is
+    protected by the lock of the repoid's sync dir.
+
+    Attributes:
+        root(str): Path to the dir that holds all the cache dirs
+        max_age(int): Cache dirs created more than ``max_age`` seconds
+            ago are evicted before they are used.
+        max_size(int): Cache dirs bigger than ``max_size`` bytes are
+            evicted before they are used.
+    """
+
+    _STAMP = '.created'
+
+    def __init__(
+        self, sync_dir,
+        max_age=DEFAULT_CACHE_MAX_AGE, max_size=DEFAULT_CACHE_MAX_SIZE
+    ):
+        self.root = os.path.join(sync_dir, METADATA_CACHE_DIR)
+        self.max_age = max_age
+        self.max_size = max_size
+
+    def path(self, repoid):
+        return os.path.join(self.root, repoid)
+
+    def prepare(self, repoid):
+        """Get the cache dir of ``repoid``, evicting it if needed
+
+        Args:
+            repoid(str)
+
+        Returns:
+            str: Path to the cache dir
+        """
+        path = self.path(repoid)
+        reason = self._eviction_reason(path)
+        if reason:
+            LOGGER.info(
+                'Evicting metadata cache of {}: {}'.format(repoid, reason)
+            )
+            self.clear(repoid)
+
+        stamp = os.path.join(path, self._STAMP)
+        if not os.path.exists(stamp):
+            utils.safe_mkdir(path)
+            open(stamp, 'w').close()
+
+        return path
+
+    def clear(self, repoid):
+        """Remove the cache dir of ``repoid`` only
+
+        Args:
+            repoid(str)
+        """
+        shutil.rmtree(self.path(repoid), ignore_errors=True)
+
+    def _eviction_reason(self, path):
+        try:
+            created = os.stat(os.path.join(path, self._STAMP)).st_mtime
+        except OSError:
+            return None
+
+        age = time.time() - created
+        if self.max_age is not None and age > self.max_age:
+            return 'older than {} seconds'.format(self.max_age)
+
+        if self.max_size is not None:
+            size = utils.dir_size(path)
+            if size > self.max_size:
+                return 'bigger than {} bytes'.format(self.max_size)
+
+        return None
+
+
+SYNC_STAMP_SUFFIX = '.sync-stamp'
+DEFAULT_UPSTREAM_TIMEOUT = 30
+
+
+SyncStamp = namedtuple('SyncStamp', ('time', 'repomd_sha256'))
+"""When a repoid was last synced successfully
+
+Attributes:
+    time(float): When the sync finished
+    repomd_sha256(str): The sha256 of the upstream repomd.xml before the
+        sync, or None if it wasn't known
+"""
+
+
+def stamp_path(sync_dir, repoid):
+    return os.path.join(sync_dir, repoid + SYNC_STAMP_SUFFIX)
+
+
+def read_stamp(sync_dir, repoid):
+    """Get the :class:`SyncStamp` of ``repoid``, or None"""
+    try:
+        with open(stamp_path(sync_dir, repoid)) as f:
+            data = json.load(f)
+        return SyncStamp(float(data['time']), data.get('repomd_sha256'))
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_stamp(sync_dir, repoid, repomd_sha256=None):
+    path = stamp_path(sync_dir, repoid)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(dict(time=time.time(), repomd_sha256=repomd_sha256), f)
+    os.rename(path + '.tmp', path)
+
+
+def drop_stamp(sync_dir, repoid):
+    try:
+        os.unlink(stamp_path(sync_dir, repoid))
+    except OSError:
+        pass
+
+
+def upstream_baseurl(yum_config, repoid):
+    """Get the first baseurl of ``repoid``
+
+    Returns:
+        str: The baseurl, or None if there is no baseurl, or it has yum
+            variables other than $basearch
+    """
+    return upstream_baseurls(yum_config, [repoid])[repoid]
+
+
+def upstream_baseurls(yum_config, repoids):
+    """Get the first baseurl of every repoid, see :func:`upstream_baseurl`
+
+    The yum config is parsed once.
+
+    Returns:
+        dict: repoid to baseurl
+    """
+    cp = ConfigParser(interpolation=None)
+    with open(yum_config) as f:
+        cp.read_file(f)
+
+    return dict((repoid, _baseurl(cp, repoid)) for repoid in repoids)
+
+
+def _baseurl(cp, repoid):
+    try:
+        baseurl = cp.get(repoid, 'baseurl').split()[0]
+    except Exception:
+        LOGGER.debug('No baseurl for {}'.format(repoid))
+        return None
+    baseurl = baseurl.replace('$basearch', os.uname()[4])
+    if '$' in baseurl:
+        LOGGER.debug('Can not expand baseurl of {}'.format(repoid))
+        return None
+
+    return baseurl.rstrip('/')
+
+
+def _repomd_sha256(baseurl, timeout=DEFAULT_UPSTREAM_TIMEOUT):
+    """Get the sha256 of the repomd.xml of the repo at ``baseurl``, or
+    None if it can't be fetched
+    """
+    if baseurl is None:
+        return None
+
+    url = baseurl + '/repodata/repomd.xml'
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            return hashlib.sha256(response.read()).hexdigest()
+    except Exception as e:
+        LOGGER.debug('Failed to fetch {}: {}'.format(url, e))
+        return None
+
+
+def upstream_packages(yum_config, repoid, timeout=DEFAULT_UPSTREAM_TIMEOUT):
+    """Get the packages of the upstream primary metadata of ``repoid``
+
+    Returns:
+        list of blobstore.PrimaryPackage: Empty if they can't be fetched
+    """
+    baseurl = upstream_baseurl(yum_config, repoid)
+    if baseurl is None:
+        return []
+
+    try:
+        with urlopen(
+            baseurl + '/repodata/repomd.xml', timeout=timeout
+        ) as response:
+            href = blobstore.primary_location(response)
+        if href is None:
+            return []
+        with urlopen(baseurl + '/' + href, timeout=timeout) as response:
+            return blobstore.read_primary(response, href)
+    except Exception as e:
+        LOGGER.debug(
+            'Failed to fetch the primary metadata of {}: {}'.format(repoid, e)
+        )
+        return []
 
-def sync(yum_config, sync_dir, repoids):
+
+def check_freshness(
+    yum_config, sync_dir, repoids, max_age, timeout=DEFAULT_UPSTREAM_TIMEOUT
+):
+    """Find the repoids that don't need to be synced
+
+    A repoid is fresh if it was synced successfully less than
+    ``max_age`` seconds ago, or if the sha256 of its upstream repomd.xml
+    didn't change since its last successful sync.
+
+    Args:
+        yum_config(str): Path to the yum config
+        sync_dir(str): Where the RPMs are synced
+        repoids(list of str)
+        max_age(float): Max seconds since the last sync of a fresh repoid
+        timeout(float): Max seconds to wait for an upstream repo
+
+    Returns:
+        tuple: The set of fresh repoids, and a dict of repoid to the
+            sha256 of its upstream repomd.xml, for the other repoids
+    """
+    stamps = dict((r, read_stamp(sync_dir, r)) for r in repoids)
+    now = time.time()
+    fresh = set(
+        r for r, stamp in stamps.items()
+        if stamp is not None and 0 <= now - stamp.time <= max_age
+    )
+
+    to_check = [r for r in repoids if r not in fresh]
+    baseurls = upstream_baseurls(yum_config, to_check)
+    with ThreadPoolExecutor(max_workers=max(min(len(to_check), 8), 1)) as e:
+        checksums = dict(
+            zip(
+                to_check,
+                e.map(
+                    lambda r: _repomd_sha256(baseurls[r], timeout),
+                    to_check
+                )
+            )
+        )
+
+    for repoid, checksum in checksums.items():
+        stamp = stamps[repoid]
+        if (
+            checksum is not None and stamp is not None
+            and stamp.repomd_sha256 == checksum
+        ):
+            fresh.add(repoid)
+
+    for repoid in repoids:
+        if repoid in fresh:
+            LOGGER.info('{} is fresh, skipping its sync'.format(repoid))
+
+    return fresh, dict(
+        (r, c) for r, c in checksums.items() if r not in fresh
+    )
+
+
+def sync(
+    yum_config, sync_dir, repoids, jobs=1,
+    cache_max_age=DEFAULT_CACHE_MAX_AGE,
+    cache_max_size=DEFAULT_CACHE_MAX_SIZE,
+    timeout=None,
+    metrics=None,
+    retry=None,
+    repomd_checksums=None,
+    dedup=False,
+    on_done=None
+):
+    """Run reposync for every repoid in ``repoids``
+
+    Repoids are synced concurrently from one event loop, at most ``jobs``
+    at a time (see :mod:`mkrepo.runner`). Each repoid is synced with its
+    own persistent metadata cache dir (see :class:`MetadataCache`).
+    A failure of one repoid doesn't stop the sync of the others,
+    the failures are reported once all the repoids were handled.
+
+    Args:
+        yum_config(str): Path to the yum config
+        sync_dir(str): Where to download the RPMs
+        repoids(list of str): Repoids to sync
+        jobs(int): Max number of repoids to sync concurrently
+        cache_max_age(int): Max age in seconds of a metadata cache dir
+        cache_max_size(int): Max size in bytes of a metadata cache dir
+        timeout(float): Max seconds for a single reposync run, a repoid
+            whose reposync timed out is not retried.
+        metrics(metrics.Metrics): Where to record every reposync run and
+            the RPMs added and removed per repoid
+        retry(RetryPolicy): How to retry a failed repoid
+        repomd_checksums(dict): repoid to the sha256 of its upstream
+            repomd.xml, recorded in its :class:`SyncStamp`
+        dedup(bool): Use the blob store of ``sync_dir``, see
+            :mod:`mkrepo.blobstore`
+        on_done(callable): Called with the :class:`SyncResult` of every
+            repoid as soon as it is done, from the thread of the sync
+
+    Returns:
+        list of SyncResult: Result per repoid, in the order of ``repoids``
+
+    Raises:
+        ReposyncError: If one of the repoids failed to sync
+    """
     utils.safe_mkdir(sync_dir)
-    cache_dir = tempfile.mkdtemp(prefix='reposync_')
-    LOGGER.debug('Using {} as cache dir for reposync'.format(
-        cache_dir
+    repoids = list(repoids)
+    cache = MetadataCache(
+        sync_dir, max_age=cache_max_age, max_size=cache_max_size
+    )
+
+    LOGGER.info('Running reposync with {} jobs'.format(jobs))
+    results = runner.run(
+        runner.gather(
+            [
+                _notify(
+                    _sync_repo(
+                        yum_config, sync_dir, repoid, cache, timeout,
+                        metrics or metrics_mod.NULL, retry,
+                        (repomd_checksums or {}).get(repoid), dedup
+                    ),
+                    on_done
+                )
+                for repoid in repoids
+            ],
+            jobs=jobs
+        )
+    )
+
+    failed = [r for r in results if r.error is not None]
+    if failed:
+        for r in failed:
+            LOGGER.error(
+                'Failed to sync {} after {} attempts: {}'.format(
+                    r.repoid, r.attempts, r.error
+                )
+            )
+        raise ReposyncError(
+            'Failed to run Reposync for: {}'.format(
+                ', '.join(r.repoid for r in failed)
+            ),
+            [r.repoid for r in failed]
+        )
+
+    return results
+
+
+async def _notify(coro, on_done):
+    result = await coro
+    if on_done is not None:
+        on_done(result)
+    return result
+
+
+async def _sync_repo(
+    yum_config, sync_dir, repoid, cache, timeout=None,
+    metrics=metrics_mod.NULL, retry=None, repomd_sha256=None, dedup=False
+):
+    """Sync a single repoid, retrying on failure
+
+    A failed sync is retried with an exponential backoff (see
+    :class:`RetryPolicy`). If reposync reported failed packages, only
+    these packages are removed before retrying, reposync downloads only
+    the missing packages, and the metadata cache is kept.
+    The metadata cache of the repoid is cleared if reposync failed
+    without reporting failed packages, or if the same packages failed
+    again.
+
+    Args:
+        yum_config(str): Path to the yum config
+        sync_dir(str): Where to download the RPMs
+        repoid(str): Repoid to sync
+        cache(MetadataCache): Metadata cache to use
+        timeout(float): Max seconds for a single reposync run, a run that
+            timed out is not retried.
+        metrics(metrics.Metrics): Where to record every reposync run
+        retry(RetryPolicy): How many times and how fast to retry
+        repomd_sha256(str): The sha256 of the upstream repomd.xml, for
+            the :class:`SyncStamp`
+        dedup(bool): Before the sync, link the RPMs of the repoid which
+            are in the blob store, and after it, add the RPMs of the
+            repoid to the blob store
+
+    Returns:
+        SyncResult: The result of the sync, ``error`` is None on success
+    """
+    retry = retry or RetryPolicy()
+    cache_dir = cache.prepare(repoid)
+    LOGGER.debug('Using {} as cache dir for reposync of {}'.format(
+        cache_dir, repoid
     ))
-    base_cmd = [
+    cmd = [
         'reposync', '--config', yum_config,
         '--newest-only', '--delete',
         '--cachedir', cache_dir,
         '--download_path', sync_dir,
+        '--repoid', repoid,
     ]
+    repo_path = os.path.join(sync_dir, repoid)
+    drop_stamp(sync_dir, repoid)
 
-    LOGGER.info('Running reposync')
+    if metrics.enabled:
+        rpms_before = metrics_mod.list_rpm_sizes(repo_path)
+    attempt = 0
+    branch = 'initial'
+    failed_packages = set()
+    loop = asyncio.get_event_loop()
     try:
-        for repoid in repoids:
-            LOGGER.info('Syncing {}'.format(repoid))
-            cmd = base_cmd + ['--repoid', repoid]
-
-            ret, out, _ = utils.run_command(cmd)
-            if not ret:
-                LOGGER.info('Successfully synced {}'.format(repoid))
-                continue
-
-            LOGGER.info('Failed to sync {}, re-running'.format(repoid))
-            _fix_reposync_issues(
-                out,
-                os.path.join(sync_dir, repoid),
+        if dedup:
+            packages = await loop.run_in_executor(
+                None, upstream_packages, yum_config, repoid
             )
-            ret = utils.run_command(cmd)
-            if not ret:
-                continue
-
-            LOGGER.info(
-                'Failed to sync {} '
-                'clearing cache and re-running'.format(repoid)
+            await loop.run_in_executor(
+                None, blobstore.prelink, sync_dir, repo_path, packages
             )
-            shutil.rmtree(cache_dir)
-            os.mkdir(cache_dir)
-            ret, out, err = utils.run_command(cmd)
 
-            if ret:
+        LOGGER.info('Syncing {}'.format(repoid))
+        while True:
+            attempt += 1
+            issues = ReposyncIssues()
+            status = None
+            try:
+                status = await runner.run_command(
+                    cmd, timeout=timeout, line_callback=issues.feed
+                )
+            finally:
+                metrics.command(
+                    'sync', repoid, status, attempt=attempt, branch=branch
+                )
+
+            if status.code == 0:
+                LOGGER.info('Successfully synced {}'.format(repoid))
+                if dedup:
+                    await loop.run_in_executor(
+                        None, blobstore.dedup, sync_dir, [repo_path]
+                    )
+                write_stamp(sync_dir, repoid, repomd_sha256)
+                return SyncResult(repoid, attempt, None)
+
+            if attempt >= retry.attempts:
                 LOGGER.error(
                     'Reposync command failed for {}\n'
                     'stdout:\n\t{}\n'
-                    'stderr:\n\t{}\n'.format(repoid, out, err)
+                    'stderr:\n\t{}\n'.format(repoid, status.out, status.err)
                 )
-            raise ReposyncError('Failed to run Reposync')
+                return SyncResult(
+                    repoid, attempt,
+                    'reposync exited with code {}'.format(status.code)
+                )
+
+            if issues.packages and issues.packages != failed_packages:
+                branch = 'retry-packages'
+                failed_packages = issues.packages
+                LOGGER.info(
+                    'Failed to sync {} packages of {}, re-running'.format(
+                        len(failed_packages), repoid
+                    )
+                )
+                _remove_failed_packages(failed_packages, repo_path)
+            else:
+                branch = 'clear-cache'
+                failed_packages = set()
+                LOGGER.info(
+                    'Failed to sync {} '
+                    'clearing cache and re-running'.format(repoid)
+                )
+                cache.clear(repoid)
+                cache.prepare(repoid)
+
+            delay = retry.delay(attempt)
+            LOGGER.debug('Retrying {} in {:.1f} seconds'.format(
+                repoid, delay
+            ))
+            await asyncio.sleep(delay)
+    except Exception as e:
+        LOGGER.debug(str(e), exc_info=True)
+        return SyncResult(repoid, attempt, str(e))
     finally:
-        shutil.rmtree(cache_dir)
+        if metrics.enabled:
+            metrics.rpm_changes(
+                'sync', repoid,
+                rpms_before, metrics_mod.list_rpm_sizes(repo_path)
+            )
+
+
+class ReposyncIssues(object):
+    """Collect the packages that reposync failed to download
+
+    Reposync's output can be fed line by line while it runs.
+
+    Attributes:
+        packages(set of str): Names of the RPM files that failed
+    """
+
+    _rpm_regex = r'[a-z]{1}[a-zA-Z0-9._\\-]+'
+    _wrong_version = re.compile(
+        r'(?P<package_name>' + _rpm_regex + r'): \[Errno 256\]'
+    )
+    _wrong_release = re.compile(
+        r'(?P<package_name>' + _rpm_regex + r') FAILED'
+    )
+
+    def __init__(self):
+        self.packages = set()
+
+    def feed(self, line, stream_name='out'):
+        if stream_name != 'out':
+            return
+        self.packages.update(
+            itertools.chain(
+                self._wrong_version.findall(line),
+                self._wrong_release.findall(line)
+            )
+        )
 
 
 def _fix_reposync_issues(reposync_out, repo_path):
@@ -75,7 +595,7 @@ def _fix_reposync_issues(reposync_out, repo_path):
         https://bugzilla.redhat.com//show_bug.cgi?id=1332441
 
     """
-    if len(repo_path) == 0 or len(reposync_out) == 0:
+    if len(reposync_out) == 0:
         LOGGER.warning(
             (
                 'unable to run _fix_reposync_issues, no reposync output '
@@ -83,34 +603,40 @@ def _fix_reposync_issues(reposync_out, repo_path):
             )
         )
         return
-    rpm_regex = r'[a-z]{1}[a-zA-Z0-9._\\-]+'
-    wrong_version = re.compile(
-        r'(?P<package_name>' + rpm_regex + r'): \[Errno 256\]'
-    )
-    wrong_release = re.compile(r'(?P<package_name>' + rpm_regex + r') FAILED')
-    packages = set(
-        itertools.chain(
-            wrong_version.findall(reposync_out),
-            wrong_release.findall(reposync_out)
+    issues = ReposyncIssues()
+    for line in reposync_out.splitlines():
+        issues.feed(line)
+    _remove_failed_packages(issues.packages, repo_path)
+
+
+def _remove_failed_packages(packages, repo_path):
+    """Remove the RPMs reposync failed to download from ``repo_path``
+
+    See :func:`_fix_reposync_issues`
+
+    Args:
+        packages(set of str): RPM file names (or prefixes of them)
+        repo_path(str)
+    """
+    if len(repo_path) == 0:
+        LOGGER.warning(
+            'unable to remove failed packages, empty repo path.'
         )
-    )
-    count = 0
+        return
     LOGGER.debug(
         'detected package errors in reposync output in repo_path:%s: %s',
         repo_path, ','.join(packages)
     )
 
-    for dirpath, _, filenames in os.walk(repo_path):
-        rpms = (
-            file for file in filenames
-            if file.endswith('.rpm') and dirpath.startswith(repo_path)
-        )
-        for rpm in rpms:
-            if any(map(rpm.startswith, packages)):
-                bad_package = os.path.join(dirpath, rpm)
-                LOGGER.info('removing conflicting RPM: %s', bad_package)
-                os.unlink(bad_package)
-                count = count + 1
+    with rpmindex.RpmIndex(repo_path) as index:
+        index.refresh()
+        bad_packages = [rpm.path for rpm in index.find(packages)]
+        for rpm in bad_packages:
+            bad_package = os.path.join(repo_path, rpm)
+            LOGGER.info('removing conflicting RPM: %s', bad_package)
+            os.unlink(bad_package)
+        index.forget(bad_packages)
+    count = len(bad_packages)
 
     if count > 0:
         LOGGER.debug(
@@ -0,0 +1,317 @@
+"""A persistent index of the RPMs under a directory
+
+The index is an SQLite database kept in ``<root>/.mkrepo/index.sqlite``.
+It holds the NEVRA, size, inode and mtime of every RPM under ``root``,
+and its sha256 once it was asked for. Refreshing the index only stats
+the files, headers are re-read only for files whose stat data changed.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import struct
+from collections import namedtuple
+
+from mkrepo import sources
+from mkrepo import utils
+
+LOGGER = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.sqlite'
+
+IndexedRpm = namedtuple(
+    'IndexedRpm', (
+        'path', 'name', 'epoch', 'version', 'release', 'arch',
+        'size', 'inode', 'mtime', 'sha256',
+    )
+)
+"""An RPM in the index, ``path`` is relative to the index root"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rpms (
+    path TEXT PRIMARY KEY,
+    name TEXT,
+    epoch INTEGER,
+    version TEXT,
+    release TEXT,
+    arch TEXT,
+    size INTEGER,
+    inode INTEGER,
+    mtime INTEGER,
+    sha256 TEXT
+)
+"""
+
+
+class RpmHeaderError(Exception):
+    pass
+
+
+class RpmIndex(object):
+    """An index of the RPMs under ``root``
+
+    Attributes:
+        root(str): The indexed directory
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._conn = None
+
+    @property
+    def db_path(self):
+        return os.path.join(self.root, utils.STATE_DIR, INDEX_FILE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _db(self):
+        if self._conn is None:
+            utils.safe_mkdir(os.path.dirname(self.db_path))
+            self._conn = sqlite3.connect(self.db_path, timeout=60)
+            self._conn.execute(_SCHEMA)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def refresh(self):
+        """Bring the index up to date with the content of ``root``
+
+        Returns:
+            tuple: Number of (re)indexed RPMs and number of dropped RPMs
+        """
+        db = self._db()
+        known = dict(
+            (row[0], tuple(row[1:]))
+            for row in db.execute('SELECT path, size, inode, mtime FROM rpms')
+        )
+        updated = 0
+        with db:
+            for path, st in _walk_rpms(self.root):
+                stat_data = (st.st_size, st.st_ino, _mtime(st))
+                if known.pop(path, None) == stat_data:
+                    continue
+                self._index(db, path, stat_data)
+                updated += 1
+
+            db.executemany(
+                'DELETE FROM rpms WHERE path = ?', [(p,) for p in known]
+            )
+
+        if updated or known:
+            LOGGER.debug(
+                'Index of {}: {} RPMs updated, {} dropped'.format(
+                    self.root, updated, len(known)
+                )
+            )
+        return updated, len(known)
+
+    def _index(self, db, path, stat_data):
+        full_path = os.path.join(self.root, path)
+        try:
+            hdr = read_header(full_path)
+        except (IOError, OSError, RpmHeaderError) as e:
+            LOGGER.debug('Failed to read header of {}: {}'.format(
+                full_path, e
+            ))
+            hdr = dict(name=sources.package_name(path))
+
+        db.execute(
+            'INSERT OR REPLACE INTO rpms '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                path, hdr.get('name'), hdr.get('epoch'),
+                hdr.get('version'), hdr.get('release'), hdr.get('arch'),
+            ) + stat_data + (None,)
+        )
+
+    def rpms(self):
+        """list of IndexedRpm: Every RPM in the index"""
+        return [
+            IndexedRpm(*row)
+            for row in self._db().execute('SELECT * FROM rpms ORDER BY path')
+        ]
+
+    def find(self, prefixes):
+        """Find the RPMs whose file name starts with one of ``prefixes``
+
+        Args:
+            prefixes(iterable of str)
+
+        Returns:
+            list of IndexedRpm
+        """
+        prefixes = tuple(prefixes)
+        return [
+            rpm for rpm in self.rpms()
+            if prefixes and os.path.basename(rpm.path).startswith(prefixes)
+        ]
+
+    def checksum(self, rpm):
+        """Get the sha256 of ``rpm``, calculating it if it isn't known
+
+        Args:
+            rpm(IndexedRpm)
+
+        Returns:
+            str: Hex digest
+        """
+        if rpm.sha256:
+            return rpm.sha256
+
+        digest = file_digest(os.path.join(self.root, rpm.path))
+        self.record_checksum(rpm, digest)
+        return digest
+
+    def record_checksum(self, rpm, sha256):
+        """Record the sha256 of ``rpm``, calculated by the caller
+
+        It's kept only as long as the stat data of ``rpm`` doesn't
+        change.
+
+        Args:
+            rpm(IndexedRpm)
+            sha256(str): Hex digest
+        """
+        with self._db() as db:
+            db.execute(
+                'UPDATE rpms SET sha256 = ? WHERE path = ? AND inode = ? '
+                'AND size = ? AND mtime = ?',
+                (sha256, rpm.path, rpm.inode, rpm.size, rpm.mtime)
+            )
+
+    def replaced(self, rpm, sha256=None):
+        """Record that ``rpm`` was replaced with an identical file
+
+        E.g with a link, so its header isn't read again by the next
+        :meth:`refresh`, and its checksum is kept.
+
+        Args:
+            rpm(IndexedRpm)
+            sha256(str): The checksum of ``rpm``, if known
+        """
+        st = os.stat(os.path.join(self.root, rpm.path))
+        with self._db() as db:
+            db.execute(
+                'UPDATE rpms SET size = ?, inode = ?, mtime = ?, sha256 = ? '
+                'WHERE path = ?',
+                (
+                    st.st_size, st.st_ino, _mtime(st),
+                    sha256 or rpm.sha256, rpm.path
+                )
+            )
+
+    def forget(self, paths):
+        """Drop ``paths`` (relative to root) from the index"""
+        with self._db() as db:
+            db.executemany(
+                'DELETE FROM rpms WHERE path = ?', [(p,) for p in paths]
+            )
+
+
+def file_digest(path, algorithm='sha256', chunk_size=1024 * 1024):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _mtime(st):
+    return getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9))
+
+
+def _walk_rpms(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for f in filenames:
+            if not f.endswith('.rpm'):
+                continue
+            full_path = os.path.join(dirpath, f)
+            try:
+                st = os.stat(full_path)
+            except OSError:
+                continue
+            yield os.path.relpath(full_path, root), st
+
+
+_LEAD_SIZE = 96
+_LEAD_MAGIC = b'\xed\xab\xee\xdb'
+_HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+_INT32_TYPE = 4
+_STRING_TYPES = (6, 9)
+_TAGS = {
+    1000: 'name',
+    1001: 'version',
+    1002: 'release',
+    1003: 'epoch',
+    1022: 'arch',
+    1044: 'sourcerpm',
+}
+
+
+def read_header(path):
+    """Read the NEVRA out of the header of an RPM file
+
+    Args:
+        path(str): Path to an RPM file
+
+    Returns:
+        dict: name, epoch, version, release and arch. ``arch`` is ``src``
+            for source RPMs.
+
+    Raises:
+        RpmHeaderError: If the file isn't an RPM
+    """
+    with open(path, 'rb') as f:
+        lead = f.read(_LEAD_SIZE)
+        if len(lead) != _LEAD_SIZE or lead[:4] != _LEAD_MAGIC:
+            raise RpmHeaderError('Bad lead')
+
+        # The signature header is padded to a multiple of 8 bytes
+        nindex, hsize = _read_header_intro(f)
+        sig_size = 16 * nindex + hsize
+        f.seek(sig_size + (8 - sig_size % 8) % 8, os.SEEK_CUR)
+
+        nindex, hsize = _read_header_intro(f)
+        index = f.read(16 * nindex)
+        store = f.read(hsize)
+        if len(index) != 16 * nindex or len(store) != hsize:
+            raise RpmHeaderError('Truncated header')
+
+    hdr = dict(epoch=None)
+    for i in range(nindex):
+        tag, tag_type, offset, count = struct.unpack(
+            '>4I', index[i * 16:(i + 1) * 16]
+        )
+        key = _TAGS.get(tag)
+        if key is None:
+            continue
+        if tag_type == _INT32_TYPE:
+            hdr[key] = struct.unpack('>i', store[offset:offset + 4])[0]
+        elif tag_type in _STRING_TYPES:
+            end = store.index(b'\0', offset)
+            hdr[key] = store[offset:end].decode('utf-8', 'replace')
+
+    if 'name' not in hdr:
+        raise RpmHeaderError('No name in header')
+
+    if 'sourcerpm' not in hdr:
+        hdr['arch'] = 'src'
+    hdr.pop('sourcerpm', None)
+
+    return hdr
+
+
+def _read_header_intro(f):
+    intro = f.read(16)
+    if len(intro) != 16 or intro[:4] != _HEADER_MAGIC:
+        raise RpmHeaderError('Bad header magic')
+    return struct.unpack('>2I', intro[8:])
@@ -0,0 +1,213 @@
+"""An asyncio based command runner
+
+Commands are run with a wall-clock timeout. When it expires the command
+is terminated, and killed if it doesn't exit within ``term_timeout``.
+Several commands can run concurrently from a single event loop, see
+:func:`gather`.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import time
+import uuid
+from collections import deque
+
+from mkrepo import utils
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_TERM_TIMEOUT = 10
+DEFAULT_TAIL_LINES = 1000
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+async def run_command(
+    command,
+    timeout=None,
+    term_timeout=DEFAULT_TERM_TIMEOUT,
+    env=None,
+    tail_lines=DEFAULT_TAIL_LINES,
+    line_callback=None,
+    _uuid=None,
+):
+    """Run a command, streaming its output
+
+    Args:
+        command(list of str): args of the command to execute
+        timeout(float): Terminate the command after that many seconds,
+            if None wait forever.
+        term_timeout(float): Seconds to wait after terminating the command
+            before killing it.
+        env(dict of str:str): If set, will use the given dict as env for the
+            subprocess
+        tail_lines(int): How many lines of stdout and stderr to keep
+        line_callback(callable): Called with every line of the output and
+            the name of its stream ('out' or 'err')
+        _uuid(uuid): If set the command will be logged with the given uuid
+
+    Returns:
+        utils.CommandStatus: The exit code and the tails of stdout/stderr,
+            with the resource usage of the command from :func:`os.wait4`
+
+    Raises:
+        CommandTimeout: If the command didn't finish in time
+    """
+    if _uuid is None:
+        _uuid = uuid.uuid4()
+
+    loop = asyncio.get_running_loop()
+    LOGGER.debug('Run command: {}'.format(' '.join(command)))
+    start = time.time()
+    popen = subprocess.Popen(
+        command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+    )
+    tails = {}
+    readers = [
+        asyncio.ensure_future(
+            _read_lines(
+                loop, popen.stdout, 'out', tails, tail_lines,
+                line_callback, _uuid
+            )
+        ),
+        asyncio.ensure_future(
+            _read_lines(
+                loop, popen.stderr, 'err', tails, tail_lines,
+                line_callback, _uuid
+            )
+        ),
+    ]
+    # The child is reaped here and not by asyncio's child watcher,
+    # so it works from any thread and we get its resource usage.
+    waiter = loop.run_in_executor(None, os.wait4, popen.pid, 0)
+
+    timed_out = False
+    try:
+        await asyncio.wait_for(asyncio.shield(waiter), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        LOGGER.warning(
+            '%s: command timed out after %s seconds', _uuid, timeout
+        )
+        await _terminate(popen, waiter, term_timeout)
+    except asyncio.CancelledError:
+        await _terminate(popen, waiter, term_timeout)
+        raise
+
+    _, status, rusage = await waiter
+    popen.returncode = _exit_code(status)
+    duration = time.time() - start
+    # Orphaned children of a terminated command may keep the pipes open
+    _, pending = await asyncio.wait(
+        readers, timeout=term_timeout if timed_out else None
+    )
+    for reader in pending:
+        reader.cancel()
+
+    LOGGER.debug(
+        '%s: command exit with return code: %d', str(_uuid), popen.returncode
+    )
+    if timed_out:
+        raise CommandTimeout(
+            'Command {} timed out after {} seconds'.format(
+                ' '.join(command), timeout
+            )
+        )
+
+    return utils.CommandStatus(
+        popen.returncode,
+        ''.join(tails.get('out', ())),
+        ''.join(tails.get('err', ())),
+        rusage=rusage,
+        duration=duration,
+    )
+
+
+async def _read_lines(
+    loop, pipe, name, tails, tail_lines, line_callback, _uuid
+):
+    tail = tails[name] = deque(maxlen=tail_lines)
+    reader = asyncio.StreamReader(limit=2 ** 20)
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), pipe
+    )
+    try:
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # A line longer than the limit, take what we have
+                line = await reader.read(2 ** 20)
+            if not line:
+                break
+            line = line.decode('utf-8', 'replace')
+            LOGGER.debug('%s: command std%s: %s', _uuid, name, line.rstrip())
+            tail.append(line)
+            if line_callback is not None:
+                line_callback(line, name)
+    finally:
+        transport.close()
+
+
+async def _terminate(popen, waiter, term_timeout):
+    _send_signal(popen, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(asyncio.shield(waiter), term_timeout)
+    except asyncio.TimeoutError:
+        LOGGER.warning('Killing pid %d', popen.pid)
+        _send_signal(popen, signal.SIGKILL)
+
+
+def _send_signal(popen, sig):
+    try:
+        os.kill(popen.pid, sig)
+    except OSError:
+        pass
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+async def gather(coros, jobs=None):
+    """Run ``coros`` concurrently, at most ``jobs`` at a time
+
+    Args:
+        coros(list of coroutine)
+        jobs(int): Max number of coroutines to run at once,
+            unlimited if None.
+
+    Returns:
+        list: The results of ``coros``, in order
+    """
+    if not jobs:
+        return await asyncio.gather(*coros)
+
+    semaphore = asyncio.Semaphore(jobs)
+
+    async def limited(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*[limited(c) for c in coros])
+
+
+def run(coro):
+    """Run ``coro`` in a new event loop, and return its result"""
+    return asyncio.run(coro)
+
+
+def run_command_sync(command, **kwargs):
+    """Run :func:`run_command` from synchronous code"""
+    return run(run_command(command, **kwargs))
@@ -0,0 +1,223 @@
+"""A long running mkrepo daemon
+
+``mkrepo serve`` listens on a Unix socket and runs reposetup jobs sent
+by :func:`request` (or ``mkrepo reposetup --server``), at most ``jobs``
+at a time, from a single process, so the parsed yum configs stay warm
+between builds (see :func:`reposetup_core.get_repo_paths`).
+
+The protocol is one JSON object per line, one request per connection::
+
+    {"command": "reposetup", "params": {"dest": ..., ...}}
+    {"ok": true}
+
+The params are the arguments of :func:`reposetup_core.reposetup`.
+Identical requests are coalesced: a request that is identical to a
+queued build waits for that build instead of starting a new one. A
+build that is already running read its inputs before the request
+arrived, so a request identical to it queues a single follow-up build
+instead, which the next identical requests join. Builds of the same
+``dest`` are serialized in the daemon, so they don't contend on the
+lock of ``dest``.
+"""
+
+import asyncio
+import inspect
+import json
+import logging
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from mkrepo import defaults
+from mkrepo import reposetup_core
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = defaults.SERVER_SOCKET
+DEFAULT_JOBS = defaults.SERVER_JOBS
+
+
+class ServerError(Exception):
+    pass
+
+
+class Server(object):
+    """The mkrepo daemon
+
+    Attributes:
+        socket_path(str): Where to listen
+        jobs(int): Max number of builds to run concurrently
+        stats(dict): Number of requests, builds and coalesced requests
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, jobs=DEFAULT_JOBS):
+        self.socket_path = socket_path
+        self.jobs = jobs
+        self.stats = dict(requests=0, builds=0, coalesced=0)
+        self._server = None
+        self._executor = None
+        self._builds = {}
+        self._dest_locks = {}
+
+    async def start(self):
+        _remove_stale_socket(self.socket_path)
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self._server = await asyncio.start_unix_server(
+            self._handle, path=self.socket_path
+        )
+        LOGGER.info(
+            'Listening on {} with {} jobs'.format(self.socket_path, self.jobs)
+        )
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._executor.shutdown(wait=True)
+        _remove_stale_socket(self.socket_path)
+
+    async def serve(self):
+        """Serve until cancelled"""
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = json.loads((await reader.readline()).decode('utf-8'))
+            response = await self.handle_request(request)
+        except Exception as e:
+            LOGGER.debug(str(e), exc_info=True)
+            response = dict(ok=False, error=str(e))
+
+        writer.write((json.dumps(response) + '\n').encode('utf-8'))
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def handle_request(self, request):
+        """Handle a decoded request
+
+        Returns:
+            dict: The response
+
+        Raises:
+            ServerError: If the request is invalid
+        """
+        self.stats['requests'] += 1
+        command = request.get('command')
+        if command == 'ping':
+            return dict(ok=True, stats=self.stats)
+        if command == 'reposetup':
+            await self.reposetup(request.get('params') or {})
+            return dict(ok=True)
+
+        raise ServerError('Unknown command: {}'.format(command))
+
+    async def reposetup(self, params):
+        """Run reposetup with ``params``, or wait for an identical queued
+        build
+        """
+        _check_params(params)
+        key = json.dumps(params, sort_keys=True)
+        build = self._builds.get(key)
+        if build is None:
+            build = asyncio.ensure_future(self._build(key, params))
+            self._builds[key] = build
+        else:
+            LOGGER.info('Coalescing a build of {}'.format(params['dest']))
+            self.stats['coalesced'] += 1
+
+        await asyncio.shield(build)
+
+    async def _build(self, key, params):
+        try:
+            dest = params['dest']
+            lock = self._dest_locks.setdefault(dest, asyncio.Lock())
+            async with lock:
+                self._dequeue(key)
+                self.stats['builds'] += 1
+                await asyncio.get_event_loop().run_in_executor(
+                    self._executor,
+                    partial(reposetup_core.reposetup, **params)
+                )
+        finally:
+            self._dequeue(key)
+
+    def _dequeue(self, key):
+        """Stop coalescing requests with the current build of ``key``"""
+        if self._builds.get(key) is asyncio.current_task():
+            del self._builds[key]
+
+
+def _check_params(params):
+    signature = inspect.signature(reposetup_core.reposetup)
+    unknown = set(params) - set(signature.parameters)
+    if unknown:
+        raise ServerError(
+            'Unknown reposetup params: {}'.format(', '.join(sorted(unknown)))
+        )
+    try:
+        signature.bind(**params)
+    except TypeError as e:
+        raise ServerError('Bad reposetup params: {}'.format(e))
+
+
+def _remove_stale_socket(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def serve(socket_path=DEFAULT_SOCKET, jobs=DEFAULT_JOBS):
+    """Run the daemon until interrupted"""
+    try:
+        asyncio.run(Server(socket_path, jobs).serve())
+    except KeyboardInterrupt:
+        LOGGER.info('Shutting down')
+
+
+def request(socket_path, command, timeout=None, **params):
+    """Send a request to the daemon and wait for the response
+
+    Args:
+        socket_path(str): The socket of the daemon
+        command(str): 'reposetup' or 'ping'
+        timeout(float): Max seconds to wait for the response
+        **params: The params of the command
+
+    Returns:
+        dict: The response
+
+    Raises:
+        ServerError: If the daemon can't be reached or the command failed
+    """
+    payload = json.dumps(dict(command=command, params=params)) + '\n'
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            sock.sendall(payload.encode('utf-8'))
+            data = b''
+            while not data.endswith(b'\n'):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+    except (OSError, socket.timeout) as e:
+        raise ServerError(
+            'Failed to talk to mkrepo at {}: {}'.format(socket_path, e)
+        )
+
+    try:
+        response = json.loads(data.decode('utf-8'))
+    except ValueError:
+        raise ServerError('Bad response from mkrepo at {}'.format(socket_path))
+    if not response.get('ok'):
+        raise ServerError(response.get('error', 'Unknown error'))
+
+    return response
@@ -0,0 +1,350 @@
+"""A local cache of the custom sources
+
+Repoman rescans or refetches every custom source on every build. With
+the cache, every local dir and every URL of the custom sources is
+materialized once under ``<sync_dir>/.custom-sources/<sha256>``, the
+sha256 of its location, and the merge reads the cached copy instead::
+
+    /builds/vdsm:latest -> <sync_dir>/.custom-sources/1f0c...:latest
+
+The copy is refreshed only when its validator changed:
+
+* Local dirs and RPMs: the path, size, mtime and inode of their RPMs.
+  The RPMs are linked into the cache (see :func:`linking.link_or_copy`).
+* URLs of an RPM: the ETag and Last-Modified headers of the RPM.
+* Other URLs are taken as yum repos: the ETag and Last-Modified headers
+  of their ``repodata/repomd.xml``, or its sha256 if the server sends
+  neither. The RPMs listed in the primary metadata are linked from the
+  blob store (see :mod:`mkrepo.blobstore`) or downloaded, and checked
+  against their sha256.
+
+Sources that can't be cached (e.g ``conf:<path>``, or URLs that aren't
+yum repos) are passed to repoman unchanged. An entry is locked
+exclusively while it is refreshed, and shared while it is merged.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from mkrepo import blobstore
+from mkrepo import linking
+from mkrepo import sources as sources_mod
+from mkrepo import utils
+
+LOGGER = logging.getLogger(__name__)
+
+CACHE_DIR = '.custom-sources'
+VALIDATOR = 'validator.json'
+LOCK_NAME = 'mkrepo.lock'
+DEFAULT_TIMEOUT = 30
+DEFAULT_LOCK_TIMEOUT = 180
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class SourceCacheError(Exception):
+    pass
+
+
+def entry_path(sync_dir, location):
+    """Where the source at ``location`` is cached"""
+    return os.path.join(
+        sync_dir, CACHE_DIR,
+        hashlib.sha256(location.encode('utf-8')).hexdigest()
+    )
+
+
+def entries(sync_dir):
+    """The dirs of the cached sources of ``sync_dir``"""
+    root = os.path.join(sync_dir, CACHE_DIR)
+    try:
+        names = sorted(os.listdir(root))
+    except OSError:
+        return []
+
+    return [
+        os.path.join(root, name) for name in names
+        if os.path.isdir(os.path.join(root, name))
+    ]
+
+
+def resolve(
+    sync_dir, sources, lock_timeout=DEFAULT_LOCK_TIMEOUT,
+    timeout=DEFAULT_TIMEOUT
+):
+    """Refresh the cached copies of ``sources``
+
+    Args:
+        sync_dir(str): Where to cache the sources
+        sources(list of str): Repoman sources
+        lock_timeout(int): Max seconds to wait for the lock of an entry
+        timeout(float): Max seconds to wait for a remote source
+
+    Returns:
+        tuple: The sources to merge instead of ``sources``, in the same
+            order, and the dirs of the cache entries they use
+    """
+    resolved, paths = [], []
+    for source in sources:
+        parsed = sources_mod.parse_source(source)
+        if parsed.kind == sources_mod.OPAQUE:
+            resolved.append(source)
+            continue
+
+        path = entry_path(sync_dir, parsed.location)
+        utils.safe_mkdir(path)
+        try:
+            with utils.LockFiles(
+                [path], timeout=lock_timeout, lock_name=LOCK_NAME
+            ):
+                refresh(parsed, path, sync_dir, timeout)
+        except (IOError, OSError, SourceCacheError) as e:
+            LOGGER.warning('Not caching {}: {}'.format(source, e))
+            LOGGER.debug(str(e), exc_info=True)
+            resolved.append(source)
+            continue
+
+        resolved.append(sources_mod.format_source(path, parsed.filters))
+        paths.append(path)
+
+    return resolved, paths
+
+
+def refresh(parsed, path, sync_dir, timeout=DEFAULT_TIMEOUT):
+    """Refresh the copy of a source in ``path`` if it changed
+
+    Args:
+        parsed(sources.Source): The source
+        path(str): Its cache entry, must be locked exclusively
+        sync_dir(str): The sync dir that holds the blob store
+        timeout(float): Max seconds to wait for a remote source
+
+    Returns:
+        bool: True if the copy was refreshed
+
+    Raises:
+        SourceCacheError: If the source can't be cached
+    """
+    validator = read_validator(path)
+    if parsed.kind == sources_mod.LOCAL:
+        current = dict(listing=_listing_digest(parsed.location))
+        if validator.get('listing') == current['listing']:
+            LOGGER.debug('{} is up to date'.format(parsed.location))
+            return False
+        _drop_validator(path)
+        _mirror_local(parsed.location, path)
+    elif parsed.location.endswith('.rpm'):
+        name = os.path.basename(parsed.location)
+        current = _download(
+            parsed.location, os.path.join(path, name), validator, timeout
+        )
+        if current is None:
+            return False
+        _remove_rpms(path, keep=[name])
+    else:
+        current = _fetch_repo(
+            parsed.location, path, sync_dir, validator, timeout
+        )
+        if current is None:
+            return False
+
+    current['location'] = parsed.location
+    _write_validator(path, current)
+    LOGGER.info('Cached {} in {}'.format(parsed.location, path))
+    return True
+
+
+def read_validator(path):
+    """The validator of the cache entry ``path``, empty if it has none"""
+    try:
+        with open(_validator_path(path)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _validator_path(path):
+    return os.path.join(path, utils.STATE_DIR, VALIDATOR)
+
+
+def _write_validator(path, validator):
+    validator_path = _validator_path(path)
+    utils.safe_mkdir(os.path.dirname(validator_path))
+    with open(validator_path + '.tmp', 'w') as f:
+        json.dump(validator, f)
+    os.rename(validator_path + '.tmp', validator_path)
+
+
+def _drop_validator(path):
+    try:
+        os.unlink(_validator_path(path))
+    except OSError:
+        pass
+
+
+def _local_rpms(location):
+    """Map the RPMs of a local source to their path relative to it"""
+    if os.path.isfile(location):
+        return {os.path.basename(location): location}
+
+    rpms = {}
+    for dirpath, _, filenames in os.walk(location):
+        for f in filenames:
+            if f.endswith('.rpm'):
+                path = os.path.join(dirpath, f)
+                rpms[os.path.relpath(path, location)] = path
+
+    return rpms
+
+
+def _listing_digest(location):
+    digest = hashlib.sha256()
+    for rel, path in sorted(_local_rpms(location).items()):
+        st = os.stat(path)
+        digest.update(
+            '{}\0{}\0{}\0{}\n'.format(
+                rel, st.st_size, st.st_mtime_ns, st.st_ino
+            ).encode('utf-8')
+        )
+    return digest.hexdigest()
+
+
+def _mirror_local(location, path):
+    rpms = _local_rpms(location)
+    for rel, src in rpms.items():
+        dst = os.path.join(path, rel)
+        if _same_content(src, dst):
+            continue
+        utils.safe_mkdir(os.path.dirname(dst))
+        linking.link_or_copy(src, dst, linking.AUTO)
+
+    _remove_rpms(path, keep=rpms)
+
+
+def _same_content(src, dst):
+    try:
+        src_st, dst_st = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    if (src_st.st_dev, src_st.st_ino) == (dst_st.st_dev, dst_st.st_ino):
+        return True
+    return (src_st.st_size, src_st.st_mtime_ns) == (
+        dst_st.st_size, dst_st.st_mtime_ns
+    )
+
+
+def _remove_rpms(path, keep):
+    """Remove the files of the cache entry ``path`` that aren't in ``keep``
+
+    Args:
+        path(str)
+        keep(iterable of str): Paths relative to ``path``
+    """
+    keep = set(os.path.normpath(k) for k in keep)
+    for dirpath, dirnames, filenames in os.walk(path):
+        if dirpath == path:
+            dirnames[:] = [d for d in dirnames if d != utils.STATE_DIR]
+        for f in filenames:
+            rel = os.path.relpath(os.path.join(dirpath, f), path)
+            if rel != LOCK_NAME and rel not in keep:
+                os.unlink(os.path.join(path, rel))
+
+
+def _download(url, dst, validator=None, timeout=DEFAULT_TIMEOUT):
+    """Download ``url`` to ``dst``, unless it matches ``validator``
+
+    Args:
+        url(str)
+        dst(str)
+        validator(dict): The validator of the previous download, if any
+        timeout(float)
+
+    Returns:
+        dict: The validator of the download, or None if ``url`` didn't
+            change since ``validator``, ``dst`` isn't written then
+    """
+    if not validator or not os.path.exists(dst):
+        validator = {}
+    request = Request(url)
+    if validator.get('etag'):
+        request.add_header('If-None-Match', validator['etag'])
+    if validator.get('last_modified'):
+        request.add_header('If-Modified-Since', validator['last_modified'])
+
+    try:
+        response = urlopen(request, timeout=timeout)
+    except HTTPError as e:
+        if e.code == 304:
+            LOGGER.debug('{} was not modified'.format(url))
+            return None
+        raise
+
+    digest = hashlib.sha256()
+    tmp = '{}.{}.tmp'.format(dst, os.getpid())
+    utils.safe_mkdir(os.path.dirname(dst))
+    try:
+        with response, open(tmp, 'wb') as f:
+            for chunk in iter(lambda: response.read(_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                f.write(chunk)
+            current = dict(
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified'),
+                sha256=digest.hexdigest(),
+            )
+        if current['sha256'] == validator.get('sha256'):
+            os.unlink(tmp)
+            return None
+        os.rename(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+    return current
+
+
+def _fetch_repo(url, path, sync_dir, validator, timeout):
+    """Refresh the copy of the yum repo at ``url``
+
+    Returns:
+        dict: The new validator, or None if the repo didn't change
+    """
+    url = url.rstrip('/')
+    repomd = os.path.join(path, utils.STATE_DIR, 'repomd.xml')
+    current = _download(
+        url + '/repodata/repomd.xml', repomd, validator, timeout
+    )
+    if current is None:
+        return None
+
+    _drop_validator(path)
+    with open(repomd, 'rb') as f:
+        href = blobstore.primary_location(f)
+    if href is None:
+        raise SourceCacheError('No primary metadata in {}'.format(url))
+    with urlopen(url + '/' + href, timeout=timeout) as response:
+        packages = blobstore.read_primary(response, href)
+
+    blobstore.prelink(sync_dir, path, packages)
+    for pkg in packages:
+        dst = os.path.normpath(os.path.join(path, pkg.href))
+        if not dst.startswith(path + os.sep):
+            raise SourceCacheError(
+                'Bad package location {} in {}'.format(pkg.href, url)
+            )
+        if os.path.exists(dst) and os.path.getsize(dst) == pkg.size:
+            continue
+        downloaded = _download(url + '/' + pkg.href, dst, timeout=timeout)
+        if downloaded['sha256'] != pkg.sha256:
+            os.unlink(dst)
+            raise SourceCacheError(
+                'Checksum mismatch for {}/{}'.format(url, pkg.href)
+            )
+
+    _remove_rpms(path, keep=[pkg.href for pkg in packages])
+    return current
@@ -0,0 +1,91 @@
+"""Helpers for repoman source strings"""
+
+import os
+import re
+from collections import namedtuple
+
+
+Source = namedtuple('Source', ('location', 'filters', 'kind'))
+
+LOCAL = 'local'
+URL = 'url'
+OPAQUE = 'opaque'
+
+_PORT = re.compile(r'^\d+(/|$)')
+
+
+def parse_source(source):
+    """Split a repoman source string into its location and filters
+
+    Repoman sources look like ``<location>[:<filter>[:<filter>...]]``.
+    Only local paths are fully understood, URLs are split but can't be
+    inspected locally, and anything else (e.g ``conf:<path>``) is kept
+    as is.
+
+    Args:
+        source(str): A repoman source string
+
+    Returns:
+        Source: The location, the list of filters and the kind of the
+            source, one of ``LOCAL``, ``URL`` or ``OPAQUE``.
+    """
+    if '://' in source:
+        scheme, rest = source.split('://', 1)
+        parts = rest.split(':')
+        if len(parts) > 1 and _PORT.match(parts[1]):
+            parts[:2] = [':'.join(parts[:2])]
+        return Source(
+            '{}://{}'.format(scheme, parts[0]), parts[1:], URL
+        )
+
+    parts = source.split(':')
+    if os.path.isabs(parts[0]) and os.path.exists(parts[0]):
+        return Source(parts[0], parts[1:], LOCAL)
+
+    return Source(source, [], OPAQUE)
+
+
+def format_source(location, filters):
+    """The reverse of :func:`parse_source`"""
+    return ':'.join([location] + list(filters))
+
+
+def list_rpms(path):
+    """List the RPMs under ``path``
+
+    Args:
+        path(str): A directory or a path to a single RPM
+
+    Returns:
+        dict: basename to (path, size, mtime)
+    """
+    if os.path.isfile(path):
+        paths = [path] if path.endswith('.rpm') else []
+    else:
+        paths = (
+            os.path.join(dirpath, f)
+            for dirpath, _, filenames in os.walk(path)
+            for f in filenames
+            if f.endswith('.rpm')
+        )
+
+    rpms = {}
+    for p in paths:
+        st = os.stat(p)
+        rpms.setdefault(
+            os.path.basename(p), (p, st.st_size, int(st.st_mtime))
+        )
+
+    return rpms
+
+
+def package_name(rpm_file):
+    """Get the package name out of an RPM file name
+
+    Args:
+        rpm_file(str): e.g ``foo-bar-1.0.0-1.el7.x86_64.rpm``
+
+    Returns:
+        str: e.g ``foo-bar``
+    """
+    return os.path.basename(rpm_file).rsplit('-', 2)[0]
@@ -7,10 +7,16 @@ import logging
 import uuid
 from collections import namedtuple
 import fcntl
+import random
+import signal
+import threading
 import time
 
 LOGGER = logging.getLogger(__name__)
 
+STATE_DIR = '.mkrepo'
+"""Where mkrepo keeps its own state inside a repo or a cache dir"""
+
 
 _CommandStatus = namedtuple(
     'CommandStatus', ('code', 'out', 'err')
@@ -18,8 +24,25 @@ _CommandStatus = namedtuple(
 
 
 class CommandStatus(_CommandStatus):
-    def __nonzero__(self):
-        return self.code
+    """The result of a command
+
+    Attributes:
+        rusage(resource.struct_rusage): The resource usage of the command,
+            if known
+        duration(float): Wall time of the command in seconds, if known
+    """
+
+    def __new__(cls, code, out, err, rusage=None, duration=None):
+        status = super(CommandStatus, cls).__new__(cls, code, out, err)
+        status.rusage = rusage
+        status.duration = duration
+        return status
+
+    def __bool__(self):
+        """True if the command failed"""
+        return bool(self.code)
+
+    __nonzero__ = __bool__
 
 
 def run_command(
@@ -56,9 +79,6 @@ def run_command(
     Returns:
         lago.utils.CommandStatus: result of the interactive execution
     """
-    if env is None:
-        env = os.environ.copy()
-
     if _uuid is None:
         _uuid = uuid.uuid4()
 
@@ -71,25 +91,26 @@ def run_command(
         env = os.environ.copy()
     else:
         env['PATH'] = ':'.join(
-            list(
-                set(
-                    env.get('PATH', '').split(':') + os.environ['PATH']
-                    .split(':')
-                ),
-            ),
+            _unique(
+                env.get('PATH', '').split(':')
+                + os.environ['PATH'].split(':')
+            )
         )
 
     LOGGER.debug('Run command: {}'.format(' '.join(command)))
 
+    start = time.time()
     popen = subprocess.Popen(
-        ' '.join('"%s"' % arg for arg in command),
+        command,
         stdout=out_pipe,
         stderr=err_pipe,
-        shell=True,
         env=env,
+        encoding='utf-8',
+        errors='replace',
         **kwargs
     )
     out, err = popen.communicate(input_data)
+    duration = time.time() - start
     LOGGER.debug(
         '%s: command exit with return code: %d', str(_uuid), popen.returncode
     )
@@ -98,7 +119,12 @@ def run_command(
     if err:
         LOGGER.debug('%s: command stderr: %s', str(_uuid), err)
 
-    return CommandStatus(popen.returncode, out, err)
+    return CommandStatus(popen.returncode, out, err, duration=duration)
+
+
+def _unique(items):
+    seen = set()
+    return [i for i in items if not (i in seen or seen.add(i))]
 
 
 class Flock(object):
@@ -112,6 +138,9 @@ class Flock(object):
             lock is already acquired.
     """
 
+    _MIN_BACKOFF = 0.01
+    _MAX_BACKOFF = 0.5
+
     def __init__(self, path, readonly=False, blocking=True):
         self._path = path
         self._fd = None
@@ -127,18 +156,107 @@ class Flock(object):
     def path(self):
         return self._path
 
-    def acquire(self):
+    def acquire(self, timeout=None):
         """Acquire the lock
 
+        Args:
+            timeout(float): If set and the lock is blocking, give up after
+                ``timeout`` seconds. When called from the main thread,
+                a blocking flock interrupted by SIGALRM is used, so the
+                lock is taken as soon as it is released. Otherwise,
+                fall back to polling with a jittered exponential backoff.
+
         Raises:
-            IOError: if the call to flock fails
+            IOError: if the call to flock fails, or with errno EAGAIN
+                if ``timeout`` expired.
         """
         self._fd = open(self._path, mode='w+')
-        fcntl.flock(self._fd, self._op)
+        try:
+            if timeout is None or self._op & fcntl.LOCK_NB:
+                fcntl.flock(self._fd, self._op)
+            elif _can_use_alarm():
+                self._acquire_with_alarm(timeout)
+            else:
+                self._acquire_with_backoff(timeout)
+        except BaseException:
+            self._fd.close()
+            self._fd = None
+            raise
+
+    def _acquire_with_alarm(self, timeout):
+        if timeout <= 0:
+            fcntl.flock(self._fd, self._op | fcntl.LOCK_NB)
+            return
+
+        def on_alarm(signum, frame):
+            raise _AlarmTimeout()
+
+        prev_handler = signal.signal(signal.SIGALRM, on_alarm)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+            try:
+                fcntl.flock(self._fd, self._op)
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        except _AlarmTimeout:
+            raise IOError(
+                errno.EAGAIN,
+                'Timeout while waiting for lock {}'.format(self._path)
+            )
+        finally:
+            signal.signal(signal.SIGALRM, prev_handler)
+
+    def _acquire_with_backoff(self, timeout):
+        deadline = time.time() + timeout
+        delay = self._MIN_BACKOFF
+        while True:
+            try:
+                fcntl.flock(self._fd, self._op | fcntl.LOCK_NB)
+                return
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                raise IOError(
+                    errno.EAGAIN,
+                    'Timeout while waiting for lock {}'.format(self._path)
+                )
+            time.sleep(min(delay * random.uniform(0.5, 1), time_left))
+            delay = min(delay * 2, self._MAX_BACKOFF)
+
+    def downgrade(self):
+        """Turn an exclusive lock into a shared one
+
+        Note that flock doesn't convert locks atomically, another process
+        waiting for an exclusive lock may get it in between, in which
+        case this blocks until it's released.
+        """
+        self._op = fcntl.LOCK_SH | (self._op & fcntl.LOCK_NB)
+        fcntl.flock(self._fd, fcntl.LOCK_SH)
 
     def release(self):
         if self._fd is not None:
             self._fd.close()
+            self._fd = None
+
+
+class _AlarmTimeout(Exception):
+    pass
+
+
+def _can_use_alarm():
+    """Check if SIGALRM can be used to interrupt a blocking flock
+
+    Signal handlers can only be installed from the main thread,
+    and an already running timer must not be clobbered.
+    """
+    return (
+        hasattr(signal, 'setitimer')
+        and threading.current_thread() is threading.main_thread()
+        and signal.getitimer(signal.ITIMER_REAL)[0] == 0
+    )
 
 
 class TimerException(Exception):
@@ -149,19 +267,41 @@ class TimerException(Exception):
 
 
 class LockFiles(object):
-    def __init__(self, paths, timeout=180, lock_name='lock.lock'):
+    """Lock a list of directories, in a deterministic order
+
+    Every path is locked exclusively, unless it appears only in
+    ``shared_paths``, in which case a shared (reader) lock is taken,
+    so several readers of the same path can run concurrently.
+
+    Attributes:
+        wait_time(float): Seconds it took to acquire all the locks
+    """
+
+    def __init__(
+        self, paths, timeout=180, lock_name='lock.lock', shared_paths=()
+    ):
         self._timeout = timeout
         self._lock_name = lock_name
-        self._paths = sorted(paths)
+        exclusive = set(paths)
+        self._plan = sorted(
+            [(p, False) for p in exclusive]
+            + [(p, True) for p in set(shared_paths) - exclusive]
+        )
+        self._paths = [p for p, _ in self._plan]
         self._locks = []
         self._start_time = None
-        self._sleep_duration = timeout / 10 or 1
+        self.wait_time = None
+
+    @property
+    def plan(self):
+        """list of tuple: (path, shared) pairs, in locking order"""
+        return list(self._plan)
 
     def _get_path_to_lock(self, path):
         return os.path.join(path, self._lock_name)
 
     def _time_left(self):
-        return time.time() - self._start_time < self._timeout
+        return self._timeout - (time.time() - self._start_time)
 
     def __enter__(self):
         self._start_time = time.time()
@@ -171,29 +311,91 @@ class LockFiles(object):
             LOGGER.debug(str(e), exc_info=True)
             self._release_all()
             raise
+        self.wait_time = time.time() - self._start_time
+        LOGGER.info(
+            'Acquired {} locks in {:.3f} seconds'.format(
+                len(self._locks), self.wait_time
+            )
+        )
+        return self
 
-    def _lock_all(self):
-        for p in self._paths:
-            self._locks.append(self._lock(p))
-            LOGGER.info('Successfully locked {}'.format(p))
-
-    def _lock(self, path):
-        lock = Flock(
-            path=self._get_path_to_lock(path),
-            blocking=False
+    def downgrade(self, path):
+        """Turn the exclusive lock of ``path`` into a shared one"""
+        lock = self._locks[self._paths.index(path)]
+        if lock is not None:
+            lock.downgrade()
+            LOGGER.debug('Downgraded lock {}'.format(lock.path))
+
+    def upgrade(self, paths):
+        """Turn the shared locks of ``paths`` into exclusive ones
+
+        To keep the locking order, and so avoid deadlocks, every lock
+        that comes after the first of ``paths`` is released and taken
+        again, so what they protect may have changed in between, the
+        caller has to check it again.
+
+        Raises:
+            TimerException: If the locks weren't taken again in time,
+                all the locks are released then.
+        """
+        paths = set(p for p, shared in self._plan if shared and p in paths)
+        if not paths:
+            return
+
+        first = min(self._paths.index(p) for p in paths)
+        self._plan = [
+            (p, shared and p not in paths) for p, shared in self._plan
+        ]
+        released = set(
+            i for i, lock in enumerate(self._locks) if lock is None
         )
+        for lock in self._locks[first:]:
+            if lock is not None:
+                lock.release()
+        del self._locks[first:]
+
+        self._start_time = time.time()
+        try:
+            for i, (p, shared) in enumerate(self._plan[first:], first):
+                self._locks.append(
+                    None if i in released else self._lock(p, shared)
+                )
+        except Exception:
+            self._release_all()
+            raise
+        LOGGER.info('Upgraded {} locks'.format(len(paths)))
+
+    def release(self, path):
+        """Release the lock of ``path`` before the others"""
+        i = self._paths.index(path)
+        if self._locks[i] is not None:
+            self._locks[i].release()
+            LOGGER.debug('Released lock {}'.format(self._locks[i].path))
+            self._locks[i] = None
+
+    def _lock_all(self):
+        for p, shared in self._plan:
+            start = time.time()
+            self._locks.append(self._lock(p, shared))
+            LOGGER.info(
+                'Successfully locked {} ({}) after {:.3f} seconds'.format(
+                    p, 'shared' if shared else 'exclusive',
+                    time.time() - start
+                )
+            )
+
+    def _lock(self, path, shared=False):
+        lock = Flock(path=self._get_path_to_lock(path), readonly=shared)
         self._wait_for_lock(lock)
 
         return lock
 
     def _wait_for_lock(self, lock):
-        while self._time_left():
-            try:
-                lock.acquire()
-                break
-            except IOError:
-                time.sleep(self._sleep_duration)
-        else:
+        try:
+            lock.acquire(timeout=max(self._time_left(), 0))
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
             LOGGER.debug(
                 'Got timeout while trying to lock {}'.format(lock.path)
             )
@@ -206,13 +408,55 @@ class LockFiles(object):
 
     def _release_all(self):
         for lock in self._locks:
+            if lock is None:
+                continue
             lock.release()
             LOGGER.debug('Successfully released lock {}'.format(lock.path))
+        self._locks = []
 
     def __exit__(self, *args):
         self._release_all()
 
 
+def dir_size(path):
+    """Get the total size in bytes of the files under ``path``"""
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, f)).st_size
+            except OSError:
+                pass
+
+    return total
+
+
+_SIZE_UNITS = {
+    '': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4
+}
+
+
+def parse_size(size):
+    """Parse a human readable size, e.g ``512M`` or ``10G``
+
+    Args:
+        size(str): A number optionally followed by K, M, G or T
+
+    Returns:
+        int: The size in bytes
+
+    Raises:
+        ValueError: If ``size`` can't be parsed
+    """
+    size = str(size).strip().upper()
+    unit = size[-1:] if size[-1:] in _SIZE_UNITS else ''
+    number = size[:len(size) - len(unit)]
+    try:
+        return int(float(number) * _SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError('Invalid size: {}'.format(size))
+
+
 def safe_mkdir(*path):
     for p in path:
         try:
@@ -0,0 +1,240 @@
+"""Verify the RPMs of the cache against the checksums of their repos
+
+An RPM of a repoid is corrupt if its size or its sha256 doesn't match
+the primary metadata of the repoid, e.g when it was truncated by an
+interrupted reposync. The primary metadata is read from the reposync
+metadata cache of the repoid (see :class:`reposync.MetadataCache`), or
+fetched from upstream if it isn't there.
+
+The RPMs are hashed by a thread pool, hashlib releases the GIL while
+hashing. The checksums are kept in the :class:`rpmindex.RpmIndex` of the
+repoid, keyed by the inode, size and mtime of the RPM, so only the RPMs
+that are new or changed since the last verification are hashed again.
+
+Corrupt RPMs are removed like the packages reposync failed to download
+(see :func:`reposync._remove_failed_packages`), along with their blob if
+they were linked to the blob store, and the sync stamp of their repoid
+is dropped, so the next sync downloads them again.
+"""
+
+import logging
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from mkrepo import blobstore
+from mkrepo import metrics as metrics_mod
+from mkrepo import reposync
+from mkrepo import rpmindex
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_JOBS = 4
+
+
+class VerifyError(Exception):
+    """Corrupt RPMs were found
+
+    Attributes:
+        repoids(list of str): The repoids with corrupt RPMs
+    """
+
+    def __init__(self, message, repoids=()):
+        super(VerifyError, self).__init__(message)
+        self.repoids = list(repoids)
+
+
+VerifyReport = namedtuple(
+    'VerifyReport', ('repoid', 'checked', 'hashed', 'corrupt', 'unknown')
+)
+"""The result of the verification of a repoid
+
+Attributes:
+    repoid(str)
+    checked(int): Number of RPMs that were checked
+    hashed(int): Number of RPMs that had to be hashed, the checksums of
+        the others were known
+    corrupt(list of str): The corrupt RPMs, relative to the repoid dir
+    unknown(int): Number of RPMs that are not in the primary metadata,
+        they can't be checked
+"""
+
+
+def verify(
+    sync_dir, yum_config, repoids, jobs=DEFAULT_JOBS, remove=True,
+    metrics=metrics_mod.NULL
+):
+    """Verify the RPMs of ``repoids``
+
+    The caller must hold the locks of the repoid dirs, exclusively if
+    ``remove`` is set.
+
+    Args:
+        sync_dir(str): Where the RPMs are synced
+        yum_config(str): Path to the yum config
+        repoids(list of str)
+        jobs(int): Max number of RPMs to hash concurrently
+        remove(bool): Remove the corrupt RPMs
+        metrics(metrics.Metrics)
+
+    Returns:
+        list of VerifyReport: Report per repoid, in the order of
+            ``repoids``
+    """
+    reports = []
+    for repoid in repoids:
+        with metrics.phase('verify', repoid=repoid):
+            report = verify_repo(
+                sync_dir, repoid,
+                primary_packages(sync_dir, yum_config, repoid),
+                jobs=jobs, remove=remove
+            )
+        reports.append(report)
+
+    return reports
+
+
+def verify_repo(sync_dir, repoid, packages, jobs=DEFAULT_JOBS, remove=True):
+    """Verify the RPMs of ``repoid`` against ``packages``
+
+    Args:
+        sync_dir(str): Where the RPMs are synced
+        repoid(str)
+        packages(list of blobstore.PrimaryPackage): The packages of the
+            primary metadata of ``repoid``
+        jobs(int): Max number of RPMs to hash concurrently
+        remove(bool): Remove the corrupt RPMs
+
+    Returns:
+        VerifyReport
+    """
+    repo_path = os.path.join(sync_dir, repoid)
+    by_href = dict((os.path.normpath(p.href), p) for p in packages)
+    by_name = dict((os.path.basename(p.href), p) for p in packages)
+
+    with rpmindex.RpmIndex(repo_path) as index:
+        index.refresh()
+        to_check, corrupt, unknown = [], [], 0
+        for rpm in index.rpms():
+            pkg = by_href.get(rpm.path) or by_name.get(
+                os.path.basename(rpm.path)
+            )
+            if pkg is None:
+                unknown += 1
+            elif pkg.size is not None and pkg.size != rpm.size:
+                corrupt.append((rpm, pkg))
+            else:
+                to_check.append((rpm, pkg))
+
+        to_hash = [rpm for rpm, _ in to_check if not rpm.sha256]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            digests = dict(
+                zip(
+                    [rpm.path for rpm in to_hash],
+                    executor.map(
+                        lambda rpm: _digest(os.path.join(repo_path, rpm.path)),
+                        to_hash
+                    )
+                )
+            )
+        for rpm in to_hash:
+            if digests[rpm.path] is not None:
+                index.record_checksum(rpm, digests[rpm.path])
+
+    checked = len(to_check) + len(corrupt)
+    corrupt.extend(
+        (rpm, pkg) for rpm, pkg in to_check
+        if (rpm.sha256 or digests[rpm.path]) != pkg.sha256
+    )
+    report = VerifyReport(
+        repoid, checked, len(to_hash),
+        sorted(rpm.path for rpm, _ in corrupt), unknown
+    )
+    LOGGER.info(
+        'Verified {} RPMs of {}: {} hashed, {} corrupt, {} unknown'.format(
+            report.checked, repoid, report.hashed, len(report.corrupt),
+            report.unknown
+        )
+    )
+
+    if corrupt and remove:
+        _remove_corrupt(sync_dir, repoid, corrupt)
+
+    return report
+
+
+def primary_packages(sync_dir, yum_config, repoid):
+    """Get the packages of the primary metadata of ``repoid``
+
+    The metadata is read from the reposync metadata cache of ``repoid``,
+    or fetched from upstream if it isn't there.
+
+    Returns:
+        list of blobstore.PrimaryPackage: Empty if there is no metadata
+    """
+    cache_dir = reposync.MetadataCache(sync_dir).path(repoid)
+    for dirpath, _, filenames in os.walk(cache_dir):
+        if 'repomd.xml' not in filenames:
+            continue
+        try:
+            with open(os.path.join(dirpath, 'repomd.xml'), 'rb') as f:
+                href = blobstore.primary_location(f)
+            primary = _find(cache_dir, os.path.basename(href or ''))
+            if primary is not None:
+                with open(primary, 'rb') as f:
+                    return blobstore.read_primary(f, primary)
+        except Exception as e:
+            LOGGER.debug(
+                'Failed to read the cached primary metadata of {}: '
+                '{}'.format(repoid, e)
+            )
+
+    LOGGER.debug(
+        'No cached primary metadata for {}, fetching it'.format(repoid)
+    )
+    return reposync.upstream_packages(yum_config, repoid)
+
+
+def _find(root, name):
+    if not name:
+        return None
+
+    for dirpath, _, filenames in os.walk(root):
+        if name in filenames:
+            return os.path.join(dirpath, name)
+
+    return None
+
+
+def _digest(path):
+    try:
+        return rpmindex.file_digest(path)
+    except (IOError, OSError) as e:
+        LOGGER.warning('Failed to read {}: {}'.format(path, e))
+        return None
+
+
+def _remove_corrupt(sync_dir, repoid, corrupt):
+    repo_path = os.path.join(sync_dir, repoid)
+    for rpm, _ in corrupt:
+        LOGGER.warning('Corrupt RPM in {}: {}'.format(repoid, rpm.path))
+
+    store = blobstore.BlobStore(sync_dir)
+    if os.path.isdir(store.root):
+        with store.lock(shared=False):
+            for rpm, pkg in corrupt:
+                blob = store.path(pkg.sha256)
+                try:
+                    if not os.path.samefile(
+                        blob, os.path.join(repo_path, rpm.path)
+                    ):
+                        continue
+                    LOGGER.info('Removing the corrupt blob {}'.format(blob))
+                    os.unlink(blob)
+                except OSError:
+                    pass
+
+    reposync._remove_failed_packages(
+        set(os.path.basename(rpm.path) for rpm, _ in corrupt), repo_path
+    )
+    reposync.drop_stamp(sync_dir, repoid)
@@ -56,10 +56,8 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: Apache Software License',
         'Natural Language :: English',
-        "Programming Language :: Python :: 2",
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.7',
     ],
     description="Build Yum/DNF repositories from multiple sources",
     entry_points={
@@ -74,6 +72,7 @@ setup(
     keywords='mkrepo',
     name='mkrepo',
     packages=find_packages(include=['mkrepo']),
+    python_requires='>=3.7',
     url='https://github.com/gbenhaim/mkrepo',
     version=get_version(),
     zip_safe=False,
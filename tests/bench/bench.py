@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for mkrepo
+
+Runs offline against synthetic RPM caches and stub reposync/repoman
+executables (see ``synthetic.py``), and prints the results as JSON::
+
+    $ python tests/bench/bench.py --scale 1000 --scale 10000 all
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import click
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mkrepo import reposetup_core  # noqa: E402
+from mkrepo import reposync  # noqa: E402
+from mkrepo import utils  # noqa: E402
+import synthetic  # noqa: E402
+
+
+@contextmanager
+def _workdir(keep=False):
+    path = tempfile.mkdtemp(prefix='mkrepo-bench-')
+    try:
+        yield path
+    finally:
+        if not keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def _env(**variables):
+    old = dict((k, os.environ.get(k)) for k in variables)
+    os.environ.update(dict((k, str(v)) for k, v in variables.items()))
+    try:
+        yield
+    finally:
+        for k, v in old.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+def bench_reposetup(
+    workdir, packages, repos, payload_size=1024, sync_latency=0,
+    merge_latency=0, output_lines=0, runs=2, **reposetup_kwargs
+):
+    """Time reposetup_core.reposetup, cold then warm
+
+    Returns:
+        list of dict: One result per run
+    """
+    bin_dir = os.path.join(workdir, 'bin')
+    sync_dir = os.path.join(workdir, 'sync')
+    dest = os.path.join(workdir, 'dest')
+    yum_config = os.path.join(workdir, 'yum.conf')
+    synthetic.install_fake_tools(bin_dir)
+
+    start = time.time()
+    repoids = synthetic.make_cache(sync_dir, repos, packages, payload_size)
+    generate_time = time.time() - start
+    synthetic.write_yum_config(yum_config, repoids)
+
+    results = []
+    with _env(
+        PATH=bin_dir + os.pathsep + os.environ['PATH'],
+        FAKE_REPOSYNC_LATENCY=sync_latency,
+        FAKE_REPOSYNC_OUTPUT_LINES=output_lines,
+        FAKE_REPOMAN_LATENCY=merge_latency,
+        FAKE_REPOMAN_OUTPUT_LINES=output_lines,
+        FAKE_CREATEREPO_LATENCY=merge_latency,
+    ):
+        for run in range(runs):
+            metrics_file = os.path.join(workdir, 'metrics-{}.json'.format(run))
+            start = time.time()
+            reposetup_core.reposetup(
+                dest=dest,
+                sync_dir=sync_dir,
+                sync=True,
+                yum_config=yum_config,
+                repoman_config=None,
+                custom_source=[],
+                lock_timeout=60,
+                metrics_file=metrics_file,
+                **reposetup_kwargs
+            )
+            wall_time = time.time() - start
+            with open(metrics_file) as f:
+                phases = dict(
+                    (p['name'], p['duration'])
+                    for p in json.load(f)['phases']
+                )
+            results.append(dict(
+                scenario='reposetup',
+                run='cold' if run == 0 else 'warm',
+                packages=packages,
+                repos=repos,
+                generate_seconds=generate_time,
+                seconds=wall_time,
+                phases=phases,
+                options=dict(
+                    (k, v) for k, v in reposetup_kwargs.items()
+                ),
+            ))
+
+    return results
+
+
+def _hold_locks(args):
+    paths, hold, queue = args
+    start = time.time()
+    locks = utils.LockFiles(paths, timeout=600, lock_name='mkrepo.lock')
+    with locks:
+        time.sleep(hold)
+    queue.put((locks.wait_time, time.time() - start))
+
+
+def bench_lock_contention(workdir, processes, paths=4, hold=0.05):
+    """Time N processes contending on the same LockFiles set"""
+    lock_dirs = [
+        os.path.join(workdir, 'lock-{}'.format(i)) for i in range(paths)
+    ]
+    utils.safe_mkdir(*lock_dirs)
+    manager = multiprocessing.Manager()
+    queue = manager.Queue()
+
+    start = time.time()
+    workers = [
+        multiprocessing.Process(
+            target=_hold_locks, args=((lock_dirs, hold, queue),)
+        )
+        for _ in range(processes)
+    ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    wall_time = time.time() - start
+
+    waits = [queue.get()[0] for _ in range(processes)]
+    return [dict(
+        scenario='lock_contention',
+        processes=processes,
+        paths=paths,
+        hold_seconds=hold,
+        seconds=wall_time,
+        overhead_seconds=wall_time - processes * hold,
+        mean_wait_seconds=sum(waits) / len(waits),
+        max_wait_seconds=max(waits),
+    )]
+
+
+def bench_fix_reposync_issues(workdir, packages, lines=None, failures=100):
+    """Time _fix_reposync_issues on a large reposync output"""
+    lines = lines or packages
+    sync_dir = os.path.join(workdir, 'fix')
+    repoid, = synthetic.make_cache(sync_dir, 1, packages, payload_size=0)
+    output = synthetic.reposync_output(lines, failures)
+
+    start = time.time()
+    issues = reposync.ReposyncIssues()
+    for line in output.splitlines():
+        issues.feed(line)
+    parse_time = time.time() - start
+
+    start = time.time()
+    reposync._fix_reposync_issues(output, os.path.join(sync_dir, repoid))
+    fix_time = time.time() - start
+
+    return [dict(
+        scenario='fix_reposync_issues',
+        packages=packages,
+        output_lines=lines,
+        output_bytes=len(output),
+        failures=len(issues.packages),
+        parse_seconds=parse_time,
+        seconds=fix_time,
+    )]
+
+
+def import_times(module='mkrepo.cli'):
+    """Import ``module`` in a new interpreter with ``-X importtime``
+
+    Returns:
+        dict: The cumulative import time in seconds of every module that
+            was imported
+    """
+    out = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stderr=subprocess.PIPE, check=True, universal_newlines=True,
+        cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                         '..'),
+    ).stderr
+
+    times = {}
+    for line in out.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def bench_startup(runs=5):
+    """Time the import of the CLI, which every mkrepo run pays
+
+    Returns:
+        list of dict: The best of ``runs`` runs, and what was imported
+    """
+    results = [import_times() for _ in range(runs)]
+    best = min(results, key=lambda times: times['mkrepo.cli'])
+    return [dict(
+        scenario='startup',
+        runs=runs,
+        seconds=best['mkrepo.cli'],
+        modules=len(best),
+        mkrepo_modules=sorted(m for m in best if m.startswith('mkrepo')),
+    )]
+
+
+@click.group()
+@click.option(
+    '--scale', type=int, multiple=True, default=[1000, 10000],
+    show_default=True, help='Number of packages, can be repeated'
+)
+@click.option('--repos', type=int, default=20, show_default=True)
+@click.option('--output', type=click.File('w'), default='-')
+@click.option('--keep', is_flag=True, help='Keep the work dirs')
+@click.pass_context
+def cli(ctx, scale, repos, output, keep):
+    ctx.obj = dict(scale=scale, repos=repos, keep=keep, output=output)
+
+
+def _emit(obj, results):
+    json.dump(results, obj['output'], indent=2, sort_keys=True)
+    obj['output'].write('\n')
+
+
+@cli.command('reposetup')
+@click.option('--sync-latency', type=float, default=0.0)
+@click.option('--merge-latency', type=float, default=0.0)
+@click.option('--output-lines', type=int, default=1000)
+@click.option('--sync-jobs', type=int, default=4)
+@click.option('--incremental-merge', is_flag=True)
+@click.option('--link-mode', default='copy')
+@click.option(
+    '--force-merge', is_flag=True,
+    help='Merge on the warm runs too, even though nothing changed'
+)
+@click.option(
+    '--merge-backend', multiple=True, default=['repoman'],
+    type=click.Choice(['repoman', 'builtin']),
+    help='Can be repeated to compare the backends'
+)
+@click.pass_obj
+def reposetup_cmd(obj, **kwargs):
+    results = []
+    for packages in obj['scale']:
+        for backend in kwargs['merge_backend']:
+            with _workdir(obj['keep']) as workdir:
+                results.extend(
+                    bench_reposetup(
+                        workdir, packages, obj['repos'],
+                        sync_latency=kwargs['sync_latency'],
+                        merge_latency=kwargs['merge_latency'],
+                        output_lines=kwargs['output_lines'],
+                        sync_jobs=kwargs['sync_jobs'],
+                        incremental_merge=kwargs['incremental_merge'],
+                        link_mode=kwargs['link_mode'],
+                        force_merge=kwargs['force_merge'],
+                        merge_backend=backend,
+                    )
+                )
+    _emit(obj, results)
+
+
+@cli.command('locks')
+@click.option('--processes', type=int, multiple=True, default=[2, 8, 32])
+@click.option('--hold', type=float, default=0.05)
+@click.pass_obj
+def locks_cmd(obj, processes, hold):
+    results = []
+    for n in processes:
+        with _workdir(obj['keep']) as workdir:
+            results.extend(bench_lock_contention(workdir, n, hold=hold))
+    _emit(obj, results)
+
+
+@cli.command('fix-reposync-issues')
+@click.option('--failures', type=int, default=100)
+@click.pass_obj
+def fix_cmd(obj, failures):
+    results = []
+    for packages in obj['scale']:
+        with _workdir(obj['keep']) as workdir:
+            results.extend(
+                bench_fix_reposync_issues(workdir, packages, failures=failures)
+            )
+    _emit(obj, results)
+
+
+@cli.command('startup')
+@click.option('--runs', type=int, default=5, show_default=True)
+@click.pass_obj
+def startup_cmd(obj, runs):
+    _emit(obj, bench_startup(runs))
+
+
+if __name__ == '__main__':
+    cli()
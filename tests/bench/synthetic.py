@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""Synthetic RPM caches and stub reposync/repoman executables"""
+
+import os
+import stat
+import sys
+from textwrap import dedent
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+)
+
+from rpmfile import rpm_bytes, rpm_file_name  # noqa: E402
+
+
+def make_cache(sync_dir, repos, packages, payload_size=1024, overlap=0.5):
+    """Generate a synthetic RPM cache
+
+    ``packages`` RPMs are spread evenly over ``repos`` repoids. A fraction
+    ``overlap`` of the package names is shared by all the repoids but the
+    first one, with a different version in each, so ``only-missing`` has
+    work to do.
+
+    Args:
+        sync_dir(str): Where to create the repoid dirs
+        repos(int): Number of repoids
+        packages(int): Total number of RPMs
+        payload_size(int): Size of the payload of every RPM
+        overlap(float): Fraction of shared package names between repos
+
+    Returns:
+        list of str: The repoids
+    """
+    repoids = ['repo-{:03d}'.format(i) for i in range(repos)]
+    per_repo = max(packages // max(repos, 1), 1)
+    for i, repoid in enumerate(repoids):
+        packages_dir = os.path.join(sync_dir, repoid, 'Packages')
+        if not os.path.isdir(packages_dir):
+            os.makedirs(packages_dir)
+        shared = int(per_repo * overlap)
+        for j in range(per_repo):
+            if j < shared and i > 0:
+                name, version = 'shared-{:06d}'.format(j), '1.{}'.format(i)
+            else:
+                name, version = 'pkg-{:03d}-{:06d}'.format(i, j), '1.0'
+            path = os.path.join(
+                packages_dir, rpm_file_name(name, version, '1.el7', 'x86_64')
+            )
+            if not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.write(
+                        rpm_bytes(name, version, '1.el7', 'x86_64',
+                                  payload=b'\0' * payload_size)
+                    )
+
+    return repoids
+
+
+def write_yum_config(path, repoids):
+    with open(path, 'w') as f:
+        f.write('[main]\nreposdir = /dev/null\n')
+        for repoid in repoids:
+            f.write('\n[{0}]\nname = {0}\nbaseurl = file:///dev/null\n'.format(
+                repoid
+            ))
+
+
+_FAKE_REPOSYNC = '''
+    import os, sys, time
+    time.sleep(float(os.environ.get('FAKE_REPOSYNC_LATENCY', 0)))
+    lines = int(os.environ.get('FAKE_REPOSYNC_OUTPUT_LINES', 0))
+    for i in range(lines):
+        sys.stdout.write(
+            '({0}/{1}): pkg-{0:06d}-1.0-1.el7.x86_64.rpm | 1.0 kB\\n'.format(
+                i, lines
+            )
+        )
+'''
+
+_FAKE_REPOMAN = '''
+    import os, sys, time
+    time.sleep(float(os.environ.get('FAKE_REPOMAN_LATENCY', 0)))
+    args = sys.argv[1:]
+    dest = args[args.index('--option=store.RPMStore.rpm_dir=') + 1]
+    command = args[args.index(dest) + 1]
+    lines = int(os.environ.get('FAKE_REPOMAN_OUTPUT_LINES', 0))
+    for i in range(lines):
+        sys.stdout.write('adding package {}\\n'.format(i))
+    if command != 'add':
+        sys.exit(0)
+    target = os.path.join(dest, 'el7', 'x86_64')
+    if not os.path.isdir(target):
+        os.makedirs(target)
+    for source in args[args.index(dest) + 2:]:
+        path = source.split(':')[0]
+        if os.path.isfile(path):
+            files = [path]
+        else:
+            files = [
+                os.path.join(d, f)
+                for d, _, names in os.walk(path) for f in names
+                if f.endswith('.rpm')
+            ]
+        for f in files:
+            dst = os.path.join(target, os.path.basename(f))
+            if not os.path.exists(dst):
+                with open(f, 'rb') as s, open(dst, 'wb') as d:
+                    d.write(s.read())
+    repodata = os.path.join(dest, 'el7', 'repodata')
+    if not os.path.isdir(repodata):
+        os.makedirs(repodata)
+'''
+
+_FAKE_CREATEREPO = '''
+    import os, sys, time
+    time.sleep(float(os.environ.get('FAKE_CREATEREPO_LATENCY', 0)))
+    repodata = os.path.join(sys.argv[-1], 'repodata')
+    if not os.path.isdir(repodata):
+        os.makedirs(repodata)
+    open(os.path.join(repodata, 'repomd.xml'), 'w').close()
+'''
+
+
+def install_fake_tools(bin_dir):
+    """Create stub reposync, repoman and createrepo_c executables in
+    ``bin_dir``
+
+    Their behaviour is controlled with environment variables:
+    ``FAKE_{REPOSYNC,REPOMAN,CREATEREPO}_LATENCY`` (seconds) and
+    ``FAKE_{REPOSYNC,REPOMAN}_OUTPUT_LINES``. The stub repoman copies the
+    RPMs of the sources into ``<dest>/el7/x86_64``.
+    """
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    for name, body in (
+        ('reposync', _FAKE_REPOSYNC), ('repoman', _FAKE_REPOMAN),
+        ('createrepo_c', _FAKE_CREATEREPO),
+    ):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write('#!{}\n'.format(sys.executable))
+            f.write(dedent(body))
+        os.chmod(path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP)
+
+
+def reposync_output(lines, failures):
+    """Generate reposync output with ``failures`` failed packages"""
+    out = []
+    step = max(lines // max(failures, 1), 1)
+    failed = 0
+    for i in range(lines):
+        name = 'pkg-000-{:06d}-1.0-1.el7.x86_64.rpm'.format(i)
+        if failed < failures and i % step == 0:
+            out.append('{}: [Errno 256] No more mirrors to try.'.format(name))
+            failed += 1
+        else:
+            out.append('({}/{}): {} | 1.0 kB  00:00:00'.format(i, lines, name))
+    return '\n'.join(out) + '\n'
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+"""Smoke tests for the benchmarks, at a tiny scale"""
+
+import bench
+
+
+def test_bench_reposetup(tmpdir):
+    cold, warm = bench.bench_reposetup(
+        str(tmpdir), packages=20, repos=2, output_lines=10,
+        incremental_merge=True,
+    )
+    assert cold['run'] == 'cold' and warm['run'] == 'warm'
+    assert set(cold['phases']) == set(
+        ['lock', 'sync', 'fingerprint', 'merge']
+    )
+    assert len(tmpdir.join('dest', 'el7', 'x86_64').listdir()) == 20
+
+
+def test_bench_reposetup_builtin_merge(tmpdir):
+    cold, warm = bench.bench_reposetup(
+        str(tmpdir), packages=20, repos=2, output_lines=10,
+        merge_backend='builtin', link_mode='hardlink',
+    )
+    assert set(cold['phases']) == set(
+        ['lock', 'sync', 'fingerprint', 'merge']
+    )
+    assert len(tmpdir.join('dest', 'el7', 'x86_64').listdir()) == 20
+    assert tmpdir.join('dest', 'el7', 'repodata').isdir()
+
+
+def test_bench_lock_contention(tmpdir):
+    result, = bench.bench_lock_contention(str(tmpdir), processes=3, hold=0)
+    assert result['processes'] == 3
+
+
+def test_bench_fix_reposync_issues(tmpdir):
+    result, = bench.bench_fix_reposync_issues(
+        str(tmpdir), packages=50, failures=5
+    )
+    assert result['failures'] == 5
+    assert len(tmpdir.join('fix', 'repo-000', 'Packages').listdir()) == 45
+
+
+def test_bench_startup():
+    result, = bench.bench_startup(runs=1)
+    assert result['mkrepo_modules'] == [
+        'mkrepo', 'mkrepo.cli', 'mkrepo.defaults'
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+"""Minimal RPM files, shared by the unit tests and the benchmarks"""
+
+import struct
+
+
+def rpm_bytes(name, version, release, arch, epoch=None, payload=b''):
+    """Build a minimal RPM file, with just enough header to be indexed"""
+    tags = [
+        (1000, 6, name), (1001, 6, version), (1002, 6, release),
+        (1022, 6, arch),
+    ]
+    if arch != 'src':
+        tags.append(
+            (1044, 6, '{}-{}-{}.src.rpm'.format(name, version, release))
+        )
+    if epoch is not None:
+        tags.append((1003, 4, epoch))
+
+    index, store = b'', b''
+    for tag, tag_type, value in tags:
+        if tag_type == 4:
+            store += b'\0' * (-len(store) % 4)
+            data = struct.pack('>i', value)
+        else:
+            data = value.encode('utf-8') + b'\0'
+        index += struct.pack('>4I', tag, tag_type, len(store), 1)
+        store += data
+
+    lead = b'\xed\xab\xee\xdb' + b'\0' * 92
+    signature = b'\x8e\xad\xe8\x01' + b'\0' * 12
+    header = (
+        b'\x8e\xad\xe8\x01' + b'\0' * 4
+        + struct.pack('>2I', len(tags), len(store)) + index + store
+    )
+    return lead + signature + header + payload
+
+
+def rpm_file_name(name, version, release, arch):
+    return '{}-{}-{}.{}.rpm'.format(name, version, release, arch)
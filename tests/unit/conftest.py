@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+)
+
+from rpmfile import rpm_bytes, rpm_file_name  # noqa: E402
+
+from mkrepo import runner  # noqa: E402
+from mkrepo import utils  # noqa: E402
+
+
+@pytest.fixture
+def make_rpm():
+    def make(directory, name, version='1.0.0', release='1.el7',
+             arch='x86_64', epoch=None, payload=b''):
+        """Create an RPM in ``directory`` (a py.path), return its path"""
+        rpm_file = directory.join(
+            rpm_file_name(name, version, release, arch)
+        )
+        rpm_file.write_binary(
+            rpm_bytes(name, version, release, arch, epoch, payload)
+        )
+        return rpm_file
+
+    return make
+
+
+class FakeCommands(object):
+    """A fake :func:`runner.run_command`
+
+    Attributes:
+        calls(list of list): Every command that was run, in order
+        handlers(dict): Command name (e.g 'repoman') to a function called
+            with the command and its line callback, which returns its
+            :class:`utils.CommandStatus`, or None if it succeeded. By
+            default, createrepo_c writes an empty repomd.xml.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.handlers = dict(createrepo_c=_fake_createrepo)
+
+    def of(self, name):
+        """The commands named ``name`` that were run"""
+        return [cmd for cmd in self.calls if cmd[0] == name]
+
+    async def run_command(self, cmd, line_callback=None, **kwargs):
+        self.calls.append(cmd)
+        handler = self.handlers.get(cmd[0])
+        status = handler(cmd, line_callback) if handler else None
+        return status or utils.CommandStatus(0, '', '')
+
+
+def _fake_createrepo(cmd, line_callback):
+    utils.safe_mkdir(os.path.join(cmd[-1], 'repodata'))
+    open(os.path.join(cmd[-1], 'repodata', 'repomd.xml'), 'w').close()
+
+
+@pytest.fixture
+def fake_commands(monkeypatch):
+    """Replace :func:`runner.run_command` with a :class:`FakeCommands`"""
+    commands = FakeCommands()
+    monkeypatch.setattr(runner, 'run_command', commands.run_command)
+    return commands
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.batch`."""
+
+import pytest
+
+from mkrepo import batch
+from mkrepo import reposetup_core
+from mkrepo import utils
+
+
+@pytest.fixture
+def failing_syncs(fake_commands):
+    """Fake reposync runs, which fail for the repoids of the returned set"""
+    failing = set()
+
+    def run_reposync(cmd, line_callback):
+        if cmd[cmd.index('--repoid') + 1] in failing:
+            return utils.CommandStatus(1, 'error', '')
+
+    fake_commands.handlers['reposync'] = run_reposync
+    return failing
+
+
+@pytest.fixture
+def manifest(tmpdir):
+    tmpdir.join('a.conf').write('[main]\n[base]\nname=base\n[a]\nname=a\n')
+    tmpdir.join('b.conf').write('[main]\n[base]\nname=base\n[b]\nname=b\n')
+    manifest = tmpdir.join('manifest.ini')
+    manifest.write(
+        '[repos/a]\n'
+        'yum-config = a.conf\n'
+        'custom-source = /builds/a\n'
+        '    /builds/common\n'
+        '[repos/b]\n'
+        'yum-config = b.conf\n'
+    )
+    return str(manifest)
+
+
+def _dest_of(cmd, builds):
+    return [b.dest for b in builds if b.dest in cmd][0]
+
+
+def _synced(fake_commands):
+    return [
+        cmd[cmd.index('--repoid') + 1] for cmd in fake_commands.of('reposync')
+    ]
+
+
+def test_read_manifest_should_resolve_relative_paths(manifest, tmpdir):
+    builds = batch.read_manifest(manifest)
+
+    assert builds == [
+        batch.Build(
+            str(tmpdir.join('repos/a')), str(tmpdir.join('a.conf')),
+            ['/builds/a', '/builds/common'], None
+        ),
+        batch.Build(
+            str(tmpdir.join('repos/b')), str(tmpdir.join('b.conf')), [], None
+        ),
+    ]
+
+
+def test_read_manifest_should_require_a_yum_config(tmpdir):
+    manifest = tmpdir.join('manifest.ini')
+    manifest.write('[repos/a]\ncustom-source = /builds/a\n')
+
+    with pytest.raises(batch.ManifestError):
+        batch.read_manifest(str(manifest))
+
+
+def test_build_many_should_sync_shared_repoids_once(
+    fake_commands, manifest, tmpdir
+):
+    builds = batch.read_manifest(manifest)
+
+    batch.build_many(builds, str(tmpdir.join('cache')))
+
+    assert sorted(_synced(fake_commands)) == ['a', 'b', 'base']
+    assert sorted(
+        _dest_of(cmd, builds) for cmd in fake_commands.of('repoman')
+    ) == sorted(
+        b.dest for b in builds
+    )
+
+
+def test_build_many_should_reject_conflicting_repoids(
+    fake_commands, manifest, tmpdir
+):
+    tmpdir.join('b.conf').write('[base]\nname=other\n')
+
+    with pytest.raises(reposetup_core.ReposetupError):
+        batch.build_many(
+            batch.read_manifest(manifest), str(tmpdir.join('cache'))
+        )
+
+
+def test_build_many_should_reject_conflicting_main_sections(
+    fake_commands, manifest, tmpdir
+):
+    tmpdir.join('b.conf').write(
+        '[main]\ngpgcheck=1\n[base]\nname=base\n[b]\nname=b\n'
+    )
+
+    with pytest.raises(reposetup_core.ReposetupError, match='base'):
+        batch.build_many(
+            batch.read_manifest(manifest), str(tmpdir.join('cache'))
+        )
+
+
+def test_build_many_should_lock_the_caches_of_one_config_at_a_time(
+    fake_commands, manifest, tmpdir, monkeypatch
+):
+    cache = tmpdir.join('cache')
+    free = {}
+
+    def do_sync(yum_config, sync_dir, repoids, **kwargs):
+        others = [p for p in cache.listdir() if p.basename not in repoids]
+        try:
+            with utils.LockFiles(
+                [str(p) for p in others], timeout=0, lock_name='mkrepo.lock'
+            ):
+                free[tuple(repoids)] = True
+        except utils.TimerException:
+            free[tuple(repoids)] = False
+
+    monkeypatch.setattr(reposetup_core, 'do_sync', do_sync)
+    batch.build_many(batch.read_manifest(manifest), str(cache))
+
+    assert free == {('base', 'a'): True, ('b',): True}
+
+
+def test_build_many_should_only_skip_builds_of_failed_repoids(
+    fake_commands, failing_syncs, manifest, tmpdir
+):
+    failing_syncs.add('b')
+    builds = batch.read_manifest(manifest)
+
+    with pytest.raises(reposetup_core.ReposetupError, match='repos/b'):
+        batch.build_many(
+            builds, str(tmpdir.join('cache')), sync_retries=1,
+            sync_retry_backoff=0
+        )
+
+    assert [
+        _dest_of(cmd, builds) for cmd in fake_commands.of('repoman')
+    ] == [builds[0].dest]
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.blobstore`."""
+
+import gzip
+import hashlib
+import os
+
+from mkrepo import blobstore
+
+PRIMARY = """<?xml version="1.0" encoding="UTF-8"?>
+<metadata xmlns="http://linux.duke.edu/metadata/common" packages="2">
+<package type="rpm">
+  <name>foo</name>
+  <checksum type="sha256" pkgid="YES">{foo}</checksum>
+  <size package="{size}"/>
+  <location href="Packages/foo-1.0.0-1.el7.x86_64.rpm"/>
+</package>
+<package type="rpm">
+  <name>bar</name>
+  <checksum type="sha256" pkgid="YES">{bar}</checksum>
+  <location href="Packages/bar-1.0.0-1.el7.x86_64.rpm"/>
+</package>
+</metadata>
+"""
+
+
+def _sync_dir(tmpdir, make_rpm):
+    sync_dir = tmpdir.mkdir('sync')
+    for repoid in ('repo_a', 'repo_b'):
+        make_rpm(
+            sync_dir.mkdir(repoid).mkdir('Packages'), 'foo',
+            payload=b'x' * 1000
+        )
+    return sync_dir
+
+
+def test_dedup_should_link_identical_rpms(tmpdir, make_rpm):
+    sync_dir = _sync_dir(tmpdir, make_rpm)
+    repo_paths = [str(sync_dir.join(r)) for r in ('repo_a', 'repo_b')]
+    rpm_a, rpm_b = [
+        os.path.join(p, 'Packages', 'foo-1.0.0-1.el7.x86_64.rpm')
+        for p in repo_paths
+    ]
+    size = os.path.getsize(rpm_a)
+
+    report = blobstore.dedup(str(sync_dir), repo_paths)
+
+    assert report == blobstore.DedupReport(2, 1, size)
+    assert os.path.samefile(rpm_a, rpm_b)
+    assert blobstore.dedup(str(sync_dir), repo_paths) == \
+        blobstore.DedupReport(2, 0, 0)
+
+
+def test_prelink_should_link_known_packages(tmpdir, make_rpm):
+    sync_dir = _sync_dir(tmpdir, make_rpm)
+    rpm = sync_dir.join('repo_a', 'Packages', 'foo-1.0.0-1.el7.x86_64.rpm')
+    blobstore.dedup(str(sync_dir), [str(sync_dir.join('repo_a'))])
+    primary = tmpdir.join('primary.xml.gz')
+    with gzip.open(str(primary), 'wt') as f:
+        f.write(PRIMARY.format(
+            foo=hashlib.sha256(rpm.read_binary()).hexdigest(),
+            bar='0' * 64, size=rpm.size()
+        ))
+
+    with open(str(primary), 'rb') as f:
+        packages = blobstore.read_primary(f, str(primary))
+    linked = blobstore.prelink(
+        str(sync_dir), str(sync_dir.join('repo_c')), packages
+    )
+
+    assert [p.href for p in packages] == [
+        'Packages/foo-1.0.0-1.el7.x86_64.rpm',
+        'Packages/bar-1.0.0-1.el7.x86_64.rpm',
+    ]
+    assert linked == 1
+    assert os.path.samefile(
+        str(rpm),
+        str(sync_dir.join('repo_c', 'Packages', rpm.basename))
+    )
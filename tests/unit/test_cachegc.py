@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.cachegc`."""
+
+import os
+
+import pytest
+
+from mkrepo import blobstore
+from mkrepo import cachegc
+from mkrepo import reposync
+from mkrepo import sourcecache
+from mkrepo import utils
+
+
+@pytest.fixture
+def sync_dir(tmpdir, make_rpm):
+    """Three repoids of 10KB, used in the order a, b, c"""
+    sync_dir = tmpdir.mkdir('sync')
+    for i, repoid in enumerate(('repo_a', 'repo_b', 'repo_c')):
+        repo = sync_dir.mkdir(repoid)
+        make_rpm(repo, repoid.replace('_', '-'), payload=b'x' * 10000)
+        cachegc.touch([str(repo)])
+        used = os.path.join(str(repo), utils.STATE_DIR, cachegc.LAST_USED)
+        os.utime(used, (1000 + i, 1000 + i))
+        reposync.write_stamp(str(sync_dir), repoid)
+        repo.join('mkrepo.lock').write('')
+    return sync_dir
+
+
+def test_collect_should_evict_least_recently_used(sync_dir):
+    report = cachegc.collect(str(sync_dir), budget=15000)
+
+    assert report.evicted == ['repo_a', 'repo_b']
+    assert report.after <= 15000 < report.before
+    assert sync_dir.join('repo_a').listdir() == [
+        sync_dir.join('repo_a', 'mkrepo.lock')
+    ]
+    assert reposync.read_stamp(str(sync_dir), 'repo_a') is None
+    assert reposync.read_stamp(str(sync_dir), 'repo_c') is not None
+
+
+def test_collect_should_skip_repoids_in_use(sync_dir):
+    lock = utils.Flock(str(sync_dir.join('repo_a', 'mkrepo.lock')))
+    lock.acquire()
+    try:
+        report = cachegc.collect(
+            str(sync_dir), budget=15000, keep=['repo_c']
+        )
+    finally:
+        lock.release()
+
+    assert report.evicted == ['repo_b']
+    assert report.after > 15000
+
+
+def test_collect_should_remove_orphan_blobs(tmpdir, make_rpm):
+    sync_dir = tmpdir.mkdir('sync')
+    for repoid in ('repo_a', 'repo_b'):
+        make_rpm(sync_dir.mkdir(repoid), 'foo', payload=b'x' * 10000)
+    repo_paths = [str(sync_dir.join(r)) for r in ('repo_a', 'repo_b')]
+    blobstore.dedup(str(sync_dir), repo_paths)
+
+    report = cachegc.collect(str(sync_dir), budget=15000, keep=['repo_b'])
+    assert report.evicted == ['repo_a'] and report.orphan_blobs == 0
+    assert report.after > 10000
+
+    report = cachegc.collect(str(sync_dir), budget=0)
+    assert report.evicted == ['repo_b'] and report.orphan_blobs == 1
+    assert report.after < 10000
+
+
+def test_collect_should_evict_cached_custom_sources(
+    sync_dir, tmpdir, make_rpm
+):
+    source = tmpdir.mkdir('source')
+    make_rpm(source, 'foo', payload=b'x' * 10000)
+    _, paths = sourcecache.resolve(str(sync_dir), [str(source)])
+
+    report = cachegc.collect(
+        str(sync_dir), budget=25000, keep=['repo_a', 'repo_b', 'repo_c']
+    )
+
+    assert report.evicted == [os.path.relpath(paths[0], str(sync_dir))]
+    assert sourcecache.read_validator(paths[0]) == {}
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.cli`."""
+
+import json
+import os
+import subprocess
+import sys
+
+from click.testing import CliRunner
+
+from mkrepo import cli
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+# Slow to import, and needed only by some commands
+LAZY_MODULES = [
+    'asyncio', 'pkg_resources', 'sqlite3', 'mkrepo.batch',
+    'mkrepo.reposetup_core', 'mkrepo.reposync', 'mkrepo.server',
+    'mkrepo.verify',
+]
+
+
+def _modules_imported_by(code):
+    out = subprocess.check_output(
+        [
+            sys.executable, '-c',
+            code + '\nimport json, sys\nprint(json.dumps(list(sys.modules)))'
+        ],
+        cwd=ROOT,
+    )
+    return set(json.loads(out.decode('utf-8').splitlines()[-1]))
+
+
+def test_cli_should_import_commands_lazily():
+    modules = _modules_imported_by('import mkrepo.cli')
+
+    assert modules.isdisjoint(LAZY_MODULES)
+
+
+def test_help_should_not_import_commands():
+    modules = _modules_imported_by(
+        'from mkrepo.cli import cli\n'
+        'try:\n'
+        '    cli(["reposetup", "--help"])\n'
+        'except SystemExit:\n'
+        '    pass'
+    )
+
+    assert modules.isdisjoint(LAZY_MODULES)
+
+
+def test_reposetup_should_import_the_server_only_with_server(tmpdir):
+    modules = _modules_imported_by(
+        'from mkrepo.cli import cli\n'
+        'try:\n'
+        '    cli([\n'
+        '        "reposetup", "--dest", {dest!r}, "--sync-dir", {sync!r},\n'
+        '        "--skip-sync", "--merge-backend", "builtin",\n'
+        '    ])\n'
+        'except SystemExit:\n'
+        '    pass'.format(
+            dest=str(tmpdir.join('dest')), sync=str(tmpdir.join('sync'))
+        )
+    )
+
+    assert 'mkrepo.reposetup_core' in modules
+    assert 'mkrepo.server' not in modules
+
+
+def test_gc_should_import_its_modules(tmpdir):
+    result = CliRunner().invoke(
+        cli.cli, ['gc', '--budget', '1G', '--sync-dir', str(tmpdir)]
+    )
+
+    assert result.exit_code == 0, result.output
+    assert 'evicted: nothing' in result.output
+
+
+def test_link_mode_should_require_the_builtin_backend(tmpdir):
+    result = CliRunner().invoke(
+        cli.cli, [
+            'reposetup', '--dest', str(tmpdir.join('dest')),
+            '--sync-dir', str(tmpdir), '--link-mode', 'hardlink',
+        ]
+    )
+
+    assert result.exit_code == 2
+    assert 'only supported by the builtin merge backend' in result.output
+
+
+def test_pipeline_should_require_the_builtin_backend(tmpdir):
+    result = CliRunner().invoke(
+        cli.cli, [
+            'reposetup', '--dest', str(tmpdir.join('dest')),
+            '--sync-dir', str(tmpdir), '--pipeline',
+        ]
+    )
+
+    assert result.exit_code == 2
+    assert 'only supported by the builtin merge backend' in result.output
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.delta`."""
+
+import os
+
+import pytest
+
+from mkrepo import delta
+from mkrepo import reposetup_core
+
+
+@pytest.fixture
+def repos(tmpdir):
+    custom = tmpdir.mkdir('custom')
+    cache = tmpdir.mkdir('cache')
+    dest = tmpdir.mkdir('dest')
+    custom.join('foo-1.0.0-1.el7.x86_64.rpm').write('foo1')
+    cache.join('foo-2.0.0-1.el7.x86_64.rpm').write('foo2')
+    cache.join('bar-1.0.0-1.el7.x86_64.rpm').write('bar1')
+    sources = [str(custom), str(cache) + ':only-missing']
+    return sources, custom, cache, dest
+
+
+def test_plan_should_be_empty_if_nothing_changed(repos):
+    sources = repos[0]
+    assert delta.plan(
+        delta.snapshot(sources), delta.snapshot(sources)
+    ) == delta.MergePlan([], set())
+
+
+def test_plan_should_require_full_merge_for_opaque_sources(repos):
+    sources = repos[0] + ['conf:/not/a/local/source']
+    assert delta.snapshot(sources) is None
+    assert delta.plan(delta.snapshot(repos[0]), None) is None
+
+
+def test_plan_should_re_add_shadowed_packages(repos):
+    sources, custom, cache, _ = repos
+    previous = delta.snapshot(sources)
+    custom.join('foo-1.0.0-1.el7.x86_64.rpm').remove()
+
+    merge_plan = delta.plan(previous, delta.snapshot(sources))
+
+    assert merge_plan.remove == set(['foo-1.0.0-1.el7.x86_64.rpm'])
+    assert merge_plan.sources == [
+        str(cache.join('foo-2.0.0-1.el7.x86_64.rpm')) + ':only-missing'
+    ]
+
+
+def test_plan_should_require_full_merge_for_latest_sources(repos):
+    _, _, cache, _ = repos
+    cache.join('foo-1.0.0-1.el7.x86_64.rpm').write('foo1')
+    sources = [str(cache) + ':latest']
+    previous = delta.snapshot(sources)
+    cache.join('foo-3.0.0-1.el7.x86_64.rpm').write('foo3')
+
+    assert delta.plan(previous, delta.snapshot(sources)) is None
+
+
+def test_incremental_merge_should_only_add_the_delta(repos, fake_commands):
+    sources, _, cache, dest = repos
+
+    for _ in range(2):
+        reposetup_core.do_merge(sources, str(dest), incremental=True)
+    cache.join('baz-1.0.0-1.el7.x86_64.rpm').write('baz1')
+    reposetup_core.do_merge(sources, str(dest), incremental=True)
+
+    assert [
+        cmd[cmd.index('--option=store.RPMStore.rpm_dir=') + 2:]
+        for cmd in fake_commands.of('repoman')
+    ] == [
+        ['add'] + sources,
+        [
+            'add',
+            os.path.join(str(cache), 'baz-1.0.0-1.el7.x86_64.rpm')
+            + ':only-missing'
+        ],
+    ]
+
+
+def test_incremental_merge_should_update_repodata_on_removal(
+    repos, fake_commands
+):
+    sources, _, cache, dest = repos
+
+    def run_repoman(cmd, line_callback):
+        dest.ensure('el7', 'x86_64', 'bar-1.0.0-1.el7.x86_64.rpm')
+        dest.ensure('el7', 'repodata', 'repomd.xml')
+
+    fake_commands.handlers['repoman'] = run_repoman
+    reposetup_core.do_merge(sources, str(dest), incremental=True)
+    cache.join('bar-1.0.0-1.el7.x86_64.rpm').remove()
+    reposetup_core.do_merge(sources, str(dest), incremental=True)
+
+    assert [cmd[0] for cmd in fake_commands.calls] == [
+        'repoman', 'createrepo_c'
+    ]
+    assert not dest.join('el7', 'x86_64').listdir()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.fingerprint`."""
+
+import pytest
+
+from mkrepo import fingerprint
+from mkrepo import reposetup_core
+
+
+@pytest.fixture
+def build(tmpdir):
+    cache = tmpdir.mkdir('cache')
+    cache.join('foo-1.0.0-1.el7.x86_64.rpm').write('foo')
+    yum_config = tmpdir.join('yum.conf')
+    yum_config.write('[cache]\n')
+    dest = tmpdir.mkdir('dest')
+
+    def merge(force=False):
+        return reposetup_core.merge_if_changed(
+            [str(cache) + ':only-missing'], str(dest), str(yum_config),
+            None, force=force
+        )
+
+    return merge, cache, yum_config, dest
+
+
+def test_compute_should_ignore_builds_with_remote_sources(tmpdir):
+    assert fingerprint.compute([str(tmpdir)]) is not None
+    assert fingerprint.compute(
+        [str(tmpdir), 'http://example.com/repo']
+    ) is None
+    assert not fingerprint.matches(str(tmpdir), None)
+
+
+def test_merge_if_changed_should_skip_unchanged_builds(
+    fake_commands, build
+):
+    merge, _, _, _ = build
+
+    assert merge()
+    runs = len(fake_commands.calls)
+    assert not merge()
+    assert len(fake_commands.calls) == runs
+    assert merge(force=True)
+
+
+@pytest.mark.parametrize('change', ['cache', 'yum_config', 'dest'])
+def test_merge_if_changed_should_merge_changed_builds(
+    fake_commands, build, change
+):
+    merge, cache, yum_config, dest = build
+    merge()
+
+    if change == 'cache':
+        cache.join('bar-1.0.0-1.el7.x86_64.rpm').write('bar')
+    elif change == 'yum_config':
+        yum_config.write('[cache]\nname=cache\n')
+    else:
+        dest.join('foo-1.0.0-1.el7.x86_64.rpm').write('changed')
+
+    assert merge()
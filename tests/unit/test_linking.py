@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.linking`."""
+
+import os
+
+import pytest
+
+from mkrepo import linking
+
+
+@pytest.mark.parametrize('mode', linking.LINK_MODES)
+def test_link_or_copy_should_create_dst(tmpdir, mode):
+    src = tmpdir.join('src.rpm')
+    src.write('content')
+    dst = tmpdir.join('dst.rpm')
+    dst.write('old content')
+
+    method = linking.link_or_copy(str(src), str(dst), mode)
+
+    assert dst.read() == 'content'
+    assert (method == linking.HARDLINK) == os.path.samefile(str(src), str(dst))
+    if mode == linking.COPY:
+        assert method == linking.COPY
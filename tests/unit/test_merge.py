@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.merge`."""
+
+import os
+
+import pytest
+
+from mkrepo import merge
+
+
+def _pkg(version, release='1', epoch=0):
+    return merge.Package('foo', epoch, version, release, 'x86_64', '')
+
+
+@pytest.mark.parametrize(
+    'a,b,expected', [
+        ('1.0', '1.0', 0),
+        ('1.0', '2.0', -1),
+        ('2.0', '1.0', 1),
+        ('1.10', '1.9', 1),
+        ('1.0010', '1.9', 1),
+        ('1.05', '1.5', 0),
+        ('1.0', '1.0.1', -1),
+        ('1.0a', '1.0', 1),
+        ('2.0.1', '2.0.1a', -1),
+        ('1.0', '1.a', 1),
+        ('1.0~rc1', '1.0', -1),
+        ('1.0~rc1', '1.0~rc2', -1),
+        ('1.0^git1', '1.0', 1),
+        ('1.0^git1', '1.0.1', -1),
+        ('1_0', '1.0', 0),
+        ('fc4', 'fc.4', 0),
+    ]
+)
+def test_rpmvercmp(a, b, expected):
+    assert merge.rpmvercmp(a, b) == expected
+    assert merge.rpmvercmp(b, a) == -expected
+
+
+def test_compare_evr_should_prefer_epoch():
+    assert merge.compare_evr(_pkg('1.0', epoch=1), _pkg('2.0')) == 1
+    assert merge.compare_evr(_pkg('1.0', '2'), _pkg('1.0', '10')) == -1
+
+
+def test_resolve_should_follow_source_precedence(tmpdir, make_rpm):
+    custom = tmpdir.mkdir('custom')
+    cache = tmpdir.mkdir('cache')
+    make_rpm(custom, 'foo', '1.0.0')
+    make_rpm(cache, 'foo', '2.0.0')
+    make_rpm(cache, 'bar', '1.0.0')
+    make_rpm(cache, 'bar', '1.10.0')
+    make_rpm(cache, 'bar', '1.0.0', arch='src')
+
+    packages = merge.resolve(
+        [str(custom), str(cache) + ':only-missing'], cache_dirs=[str(cache)]
+    )
+
+    assert [(p.name, p.version) for p in packages] == [
+        ('foo', '1.0.0'), ('bar', '1.10.0')
+    ]
+
+
+def test_resolve_should_reject_non_local_sources():
+    with pytest.raises(merge.MergeError):
+        merge.resolve(['conf:/not/a/local/source'])
+
+
+def test_merge_should_materialize_dest(tmpdir, make_rpm, fake_commands):
+    custom = tmpdir.mkdir('custom')
+    cache = tmpdir.mkdir('cache')
+    dest = tmpdir.join('dest')
+    make_rpm(custom, 'foo', '1.0.0')
+    make_rpm(cache, 'foo', '2.0.0')
+    make_rpm(cache, 'bar', '1.0.0', release='1.el8', arch='noarch')
+    make_rpm(cache, 'baz', '1.0.0', release='1')
+    sources = [str(custom), str(cache) + ':only-missing']
+
+    merge.merge(sources, str(dest), cache_dirs=[str(cache)])
+
+    assert sorted(
+        os.path.relpath(os.path.join(d, f), str(dest))
+        for d, _, files in os.walk(str(dest))
+        for f in files
+        if f.endswith('.rpm')
+    ) == [
+        'el7/x86_64/baz-1.0.0-1.x86_64.rpm',
+        'el7/x86_64/foo-1.0.0-1.el7.x86_64.rpm',
+        'el8/noarch/bar-1.0.0-1.el8.noarch.rpm',
+        'el8/x86_64/baz-1.0.0-1.x86_64.rpm',
+    ]
+    assert [cmd[-1] for cmd in fake_commands.of('createrepo_c')] == [
+        str(dest.join('el7')), str(dest.join('el8'))
+    ]
+
+    del fake_commands.calls[:]
+    assert merge.merge(sources, str(dest), cache_dirs=[str(cache)]) == []
+    assert fake_commands.calls == []
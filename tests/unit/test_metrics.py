@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.metrics`."""
+
+import json
+import os
+import stat
+
+from mkrepo import reposetup_core
+
+
+def _write_script(path, content):
+    path.write('#!/bin/sh\n' + content)
+    path.chmod(stat.S_IRWXU)
+
+
+def test_reposetup_should_write_metrics(tmpdir, monkeypatch):
+    bin_dir = tmpdir.mkdir('bin')
+    # Fake reposync, downloads a single RPM into the repo
+    _write_script(
+        bin_dir.join('reposync'),
+        'while [ "$1" != "--download_path" ]; do shift; done\n'
+        'path=$2\n'
+        'while [ "$1" != "--repoid" ]; do shift; done\n'
+        'mkdir -p $path/$2 && echo rpm > $path/$2/foo-1-1.x86_64.rpm\n'
+    )
+    _write_script(bin_dir.join('repoman'), 'exit 0\n')
+    monkeypatch.setenv(
+        'PATH', str(bin_dir) + os.pathsep + os.environ['PATH']
+    )
+    yum_config = tmpdir.join('yum.conf')
+    yum_config.write('[main]\n[repo_a]\n[repo_b]\n')
+    metrics_file = tmpdir.join('metrics.json')
+
+    reposetup_core.reposetup(
+        dest=str(tmpdir.join('dest')),
+        sync_dir=str(tmpdir.join('sync')),
+        sync=True,
+        yum_config=str(yum_config),
+        repoman_config=None,
+        custom_source=[],
+        lock_timeout=10,
+        metrics_file=str(metrics_file),
+    )
+
+    report = json.loads(metrics_file.read())
+    assert [p['name'] for p in report['phases']] == [
+        'lock', 'sync', 'fingerprint', 'merge'
+    ]
+    assert sorted(report['sync']) == ['repo_a', 'repo_b']
+    repo_a = report['sync']['repo_a']
+    assert repo_a['rpms']['added'] == 1
+    assert repo_a['rpms']['added_bytes'] == 4
+    command, = repo_a['commands']
+    assert command['branch'] == 'initial'
+    assert command['exit_code'] == 0
+    assert 'cpu_user' in command and 'max_rss_kb' in command
+    merge_command, = report['merge'][str(tmpdir.join('dest'))]['commands']
+    assert merge_command['subcommand'] == 'add'
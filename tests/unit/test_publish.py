@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.publish`."""
+
+import os
+
+import pytest
+
+from mkrepo import publish
+from mkrepo import reposetup_core
+from mkrepo import utils
+
+
+@pytest.fixture
+def fake_repoman(fake_commands):
+    """Fake repoman runs, which add ``rpms`` to the repo"""
+    rpms = []
+
+    def run_repoman(cmd, line_callback):
+        dest = cmd[cmd.index('--option=store.RPMStore.rpm_dir=') + 1]
+        if not rpms:
+            return utils.CommandStatus(1, '', 'failed')
+        for rpm in rpms:
+            with open(os.path.join(dest, rpm), 'w') as f:
+                f.write(rpm)
+
+    fake_commands.handlers['repoman'] = run_repoman
+    return rpms
+
+
+def _build(tmpdir, dest):
+    return reposetup_core.merge_if_changed(
+        [str(tmpdir.ensure('cache', dir=True))], dest, None, None,
+        staged=True
+    )
+
+
+def _rpms(dest):
+    return sorted(name for name in os.listdir(dest) if name.endswith('.rpm'))
+
+
+def test_stage_should_link_rpms_and_copy_the_rest(tmpdir):
+    dest = tmpdir.mkdir('dest')
+    dest.join('foo.rpm').write('foo')
+    dest.join('repodata', 'repomd.xml').write('repomd', ensure=True)
+    dest.join('mkrepo.lock').write('')
+
+    staged = publish.stage(str(dest))
+
+    assert staged.startswith(publish.generations_dir(str(dest)))
+    assert os.path.samefile(
+        str(dest.join('foo.rpm')), os.path.join(staged, 'foo.rpm')
+    )
+    repomd = os.path.join(staged, 'repodata', 'repomd.xml')
+    assert not os.path.samefile(str(dest.join('repodata', 'repomd.xml')),
+                                repomd)
+    assert not os.path.exists(os.path.join(staged, 'mkrepo.lock'))
+
+
+def test_publish_should_swap_dest_atomically(tmpdir):
+    dest = tmpdir.mkdir('dest')
+    dest.join('old.rpm').write('old')
+
+    first = publish.publish(str(dest), publish.stage(str(dest)))
+    assert os.path.realpath(str(dest)) == first
+    assert os.listdir(str(dest)) == ['old.rpm']
+
+    second_stage = publish.stage(str(dest))
+    with open(os.path.join(second_stage, 'new.rpm'), 'w') as f:
+        f.write('new')
+    assert os.listdir(str(dest)) == ['old.rpm']
+    second = publish.publish(str(dest), second_stage)
+
+    assert os.path.realpath(str(dest)) == second
+    assert sorted(os.listdir(str(dest))) == ['new.rpm', 'old.rpm']
+    generations = publish.generations_dir(str(dest))
+    assert sorted(
+        os.path.join(generations, name) for name in os.listdir(generations)
+        if not name.endswith('.lock')
+    ) == [first, second]
+
+
+def test_staged_merge_should_publish_only_successful_builds(
+    tmpdir, fake_repoman
+):
+    dest = str(tmpdir.join('dest'))
+
+    with pytest.raises(reposetup_core.RepomanError):
+        _build(tmpdir, dest)
+    assert not os.path.lexists(dest)
+
+    fake_repoman.append('foo.rpm')
+    assert _build(tmpdir, dest)
+    assert os.path.islink(dest)
+    assert _rpms(dest) == ['foo.rpm']
+    assert not _build(tmpdir, dest)
+
+    del fake_repoman[:]
+    tmpdir.join('cache', 'bar.rpm').write('bar')
+    with pytest.raises(reposetup_core.RepomanError):
+        _build(tmpdir, dest)
+    assert _rpms(dest) == ['foo.rpm']
+    assert not [
+        name for name in os.listdir(publish.generations_dir(dest))
+        if name.endswith(publish.STAGING_SUFFIX)
+    ]
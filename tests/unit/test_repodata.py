@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.repodata`."""
+
+import pytest
+
+from mkrepo import repodata
+from mkrepo import utils
+
+
+def test_update_should_reuse_previous_metadata(tmpdir, fake_commands):
+    dest = tmpdir.mkdir('dest')
+    rpm = dest.mkdir('el7').mkdir('x86_64').join('foo-1.0-1.el7.x86_64.rpm')
+    rpm.write('foo')
+
+    assert repodata.update(str(dest), 'el7')
+    assert fake_commands.calls == [[
+        'createrepo_c', '--update',
+        '--cachedir', str(dest.join('.mkrepo', 'createrepo-cache')),
+        str(dest.join('el7')),
+    ]]
+
+
+def test_update_should_skip_unchanged_repos(tmpdir, fake_commands):
+    dest = tmpdir.mkdir('dest')
+    packages = dest.mkdir('el7').mkdir('x86_64')
+    packages.join('foo-1.0-1.el7.x86_64.rpm').write('foo')
+    dest.mkdir('el8').mkdir('x86_64').join('bar-1.0-1.el8.x86_64.rpm').write(
+        'bar'
+    )
+
+    assert repodata.update_all(str(dest)) == ['el7', 'el8']
+    assert repodata.update_all(str(dest)) == []
+
+    packages.join('foo-1.1-1.el7.x86_64.rpm').write('foo')
+    assert repodata.update_all(str(dest)) == ['el7']
+
+    repodata.invalidate(str(dest))
+    assert repodata.update_all(str(dest)) == ['el7', 'el8']
+
+
+def test_update_should_fail_if_createrepo_failed(tmpdir, fake_commands):
+    fake_commands.handlers['createrepo_c'] = (
+        lambda cmd, line_callback: utils.CommandStatus(1, '', 'boom')
+    )
+    with pytest.raises(repodata.RepodataError):
+        repodata.update(str(tmpdir), 'el7')
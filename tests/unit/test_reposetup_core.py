@@ -3,6 +3,8 @@
 
 """Tests for `mkrepo` package."""
 
+import os
+
 import pytest
 import tempfile
 from collections import OrderedDict
@@ -10,10 +12,16 @@ from collections import OrderedDict
 from click.testing import CliRunner
 
 from mkrepo.reposetup_core import (
+    get_lock_plan,
     get_repo_paths
 )
+from mkrepo.utils import LockFiles
 
 from mkrepo import cli
+from mkrepo import merge
+from mkrepo import reposetup_core
+from mkrepo import reposync
+from mkrepo import utils
 
 
 @pytest.fixture
@@ -42,6 +50,155 @@ def test_get_repo_paths_should_sucess(sync_dir, config_str, expected, tmpfile):
     assert result == expected
 
 
+def test_get_repo_paths_should_reload_a_modified_config(tmpfile):
+    with open(tmpfile, mode='w') as f:
+        f.write('[repo_a]\n')
+    assert list(get_repo_paths('/sync', tmpfile)) == ['repo_a']
+
+    with open(tmpfile, mode='w') as f:
+        f.write('[repo_a]\n[repo_b]\n')
+    assert list(get_repo_paths('/sync', tmpfile)) == ['repo_a', 'repo_b']
+
+
 def test_get_repo_paths_shoud_fail_if_config_does_not_exist():
     with pytest.raises(IOError):
         get_repo_paths('/var/cache/mkrepo', 'not_exists')
+
+
+@pytest.mark.parametrize(
+    'sync,expected_plan', [
+        (True, [('/cache/a', False), ('/cache/b', False), ('/dest', False)]),
+        (False, [('/cache/a', True), ('/cache/b', True), ('/dest', False)]),
+    ]
+)
+def test_get_lock_plan_should_lock_caches_exclusively_only_on_sync(
+    sync, expected_plan
+):
+    kwargs = get_lock_plan('/dest', ['/cache/a', '/cache/b'], sync, 10)
+    assert LockFiles(**kwargs).plan == expected_plan
+
+
+def test_get_lock_plan_should_share_locks_of_fresh_caches():
+    kwargs = get_lock_plan(
+        '/dest', ['/cache/a', '/cache/b'], True, 10, fresh_paths=['/cache/a']
+    )
+    assert LockFiles(**kwargs).plan == [
+        ('/cache/a', True), ('/cache/b', False), ('/dest', False)
+    ]
+
+
+def test_lock_stale_should_lock_only_stale_caches_exclusively(tmpdir):
+    yum_config = tmpdir.join('yum.conf')
+    yum_config.write('[main]\n[repo_a]\n[repo_b]\n')
+    sync_dir = str(tmpdir.join('sync'))
+    repoid_to_path = reposetup_core.get_repo_paths(sync_dir, str(yum_config))
+    utils.safe_mkdir(*repoid_to_path.values())
+    reposync.write_stamp(sync_dir, 'repo_a')
+
+    with LockFiles(
+        [], shared_paths=repoid_to_path.values(), lock_name='mkrepo.lock'
+    ) as locks:
+        to_sync, _ = reposetup_core.lock_stale(
+            locks, str(yum_config), sync_dir, repoid_to_path, 3600
+        )
+
+        assert to_sync == ['repo_b']
+        assert locks.plan == [
+            (repoid_to_path['repo_a'], True),
+            (repoid_to_path['repo_b'], False),
+        ]
+
+
+@pytest.fixture
+def fake_pipeline(tmpdir, monkeypatch, fake_commands):
+    """Fake reposync runs and builtin merges
+
+    Returns the merged sources, and whether the lock of ``repo_a`` was
+    free at every merge
+    """
+    merged = []
+    failing = set()
+
+    def run_reposync(cmd, line_callback):
+        repoid = cmd[cmd.index('--repoid') + 1]
+        if repoid in failing:
+            return utils.CommandStatus(1, 'error', '')
+        download_path = cmd[cmd.index('--download_path') + 1]
+        os.makedirs(os.path.join(download_path, repoid), exist_ok=True)
+
+    def fake_merge(sources, dest, **kwargs):
+        try:
+            with LockFiles(
+                [str(tmpdir.join('sync', 'repo_a'))], timeout=0,
+                lock_name='mkrepo.lock'
+            ):
+                free = True
+        except utils.TimerException:
+            free = False
+        merged.append((sources, free))
+
+    fake_commands.handlers['reposync'] = run_reposync
+    monkeypatch.setattr(merge, 'merge', fake_merge)
+    return merged, failing
+
+
+def _pipelined_reposetup(tmpdir, yum_config, merge_backend=merge.BUILTIN):
+    reposetup_core.reposetup(
+        dest=str(tmpdir.join('dest')),
+        sync_dir=str(tmpdir.join('sync')),
+        sync=True,
+        yum_config=str(yum_config),
+        repoman_config=None,
+        custom_source=[str(tmpdir.mkdir('custom'))],
+        lock_timeout=10,
+        sync_jobs=2,
+        sync_retries=1,
+        merge_backend=merge_backend,
+        pipeline=True,
+    )
+
+
+def test_pipelined_reposetup_should_merge_in_order_and_release_locks(
+    tmpdir, fake_pipeline
+):
+    merged, _ = fake_pipeline
+    yum_config = tmpdir.join('yum.conf')
+    yum_config.write('[main]\n[repo_a]\n[repo_b]\n')
+
+    _pipelined_reposetup(tmpdir, yum_config)
+
+    assert merged == [
+        ([str(tmpdir.join('custom'))], False),
+        ([str(tmpdir.join('sync', 'repo_a')) + ':only-missing'], False),
+        ([str(tmpdir.join('sync', 'repo_b')) + ':only-missing'], True),
+    ]
+
+
+def test_pipelined_reposetup_should_stop_at_the_first_failed_repoid(
+    tmpdir, fake_pipeline
+):
+    merged, failing = fake_pipeline
+    failing.add('repo_b')
+    yum_config = tmpdir.join('yum.conf')
+    yum_config.write('[main]\n[repo_a]\n[repo_b]\n[repo_c]\n')
+
+    with pytest.raises(reposetup_core.ReposetupError):
+        _pipelined_reposetup(tmpdir, yum_config)
+
+    assert [sources for sources, _ in merged] == [
+        [str(tmpdir.join('custom'))],
+        [str(tmpdir.join('sync', 'repo_a')) + ':only-missing'],
+    ]
+
+
+def test_pipelined_reposetup_should_require_the_builtin_backend(
+    tmpdir, fake_pipeline
+):
+    merged, _ = fake_pipeline
+    yum_config = tmpdir.join('yum.conf')
+    yum_config.write('[main]\n[repo_a]\n')
+
+    with pytest.raises(reposetup_core.ReposetupError, match='builtin'):
+        _pipelined_reposetup(tmpdir, yum_config, merge_backend=merge.REPOMAN)
+
+    assert merged == []
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.reposync`."""
+
+import os
+
+import pytest
+
+from mkrepo import metrics
+from mkrepo import reposync
+from mkrepo import utils
+
+
+NO_RETRY_DELAY = reposync.RetryPolicy(backoff=0)
+
+
+@pytest.fixture
+def fake_reposync(fake_commands):
+    """Fake reposync runs
+
+    ``failing`` maps a repoid to the outputs of its runs, None for success
+    """
+    calls = []
+    failing = {}
+
+    def run_reposync(cmd, line_callback):
+        repoid = cmd[cmd.index('--repoid') + 1]
+        cache_dir = cmd[cmd.index('--cachedir') + 1]
+        calls.append((repoid, cache_dir))
+        outputs = failing.get(repoid)
+        if not outputs:
+            return None
+        out = outputs.pop(0) if len(outputs) > 1 else outputs[0]
+        if out is None:
+            return None
+        for line in out.splitlines(True):
+            line_callback(line, 'out')
+        return utils.CommandStatus(1, out, '')
+
+    fake_commands.handlers['reposync'] = run_reposync
+    return calls, failing
+
+
+def test_sync_should_use_a_cache_dir_per_repoid(fake_reposync, tmpdir):
+    calls, _ = fake_reposync
+
+    results = reposync.sync(
+        'yum.conf', str(tmpdir), ['repo_a', 'repo_b', 'repo_c'], jobs=3
+    )
+
+    assert [r.repoid for r in results] == ['repo_a', 'repo_b', 'repo_c']
+    assert all(r.error is None for r in results)
+    assert len(set(cache_dir for _, cache_dir in calls)) == 3
+
+
+def test_sync_should_sync_all_repoids_before_failing(fake_reposync, tmpdir):
+    calls, failing = fake_reposync
+    failing['repo_a'] = ['error']
+
+    with pytest.raises(reposync.ReposyncError) as e:
+        reposync.sync(
+            'yum.conf', str(tmpdir), ['repo_a', 'repo_b'], jobs=2,
+            retry=NO_RETRY_DELAY
+        )
+
+    assert 'repo_a' in str(e.value)
+    assert 'repo_b' in set(repoid for repoid, _ in calls)
+
+
+def test_sync_should_report_every_repoid_when_done(fake_reposync, tmpdir):
+    _, failing = fake_reposync
+    failing['repo_b'] = ['error']
+    done = []
+
+    with pytest.raises(reposync.ReposyncError):
+        reposync.sync(
+            'yum.conf', str(tmpdir), ['repo_a', 'repo_b'], jobs=2,
+            retry=NO_RETRY_DELAY, on_done=done.append
+        )
+
+    assert sorted((r.repoid, r.error is None) for r in done) == [
+        ('repo_a', True), ('repo_b', False)
+    ]
+
+
+def test_metadata_cache_should_persist_between_syncs(fake_reposync, tmpdir):
+    calls, _ = fake_reposync
+
+    reposync.sync('yum.conf', str(tmpdir), ['repo_a'])
+    reposync.sync('yum.conf', str(tmpdir), ['repo_a'])
+
+    first, second = [cache_dir for _, cache_dir in calls]
+    assert first == second
+    assert tmpdir.join(reposync.METADATA_CACHE_DIR, 'repo_a').check(dir=1)
+
+
+def test_metadata_cache_should_evict_big_cache_dirs(tmpdir):
+    cache = reposync.MetadataCache(str(tmpdir), max_size=10)
+    path = cache.prepare('repo_a')
+    with open(path + '/primary.sqlite', 'w') as f:
+        f.write('x' * 100)
+    cache.prepare('repo_b')
+
+    assert cache.prepare('repo_a') == path
+    assert tmpdir.join(reposync.METADATA_CACHE_DIR, 'repo_a').listdir() == [
+        tmpdir.join(reposync.METADATA_CACHE_DIR, 'repo_a', '.created')
+    ]
+    assert tmpdir.join(reposync.METADATA_CACHE_DIR, 'repo_b').check(dir=1)
+
+
+def test_fix_reposync_issues_should_remove_failed_packages(tmpdir, make_rpm):
+    foo = make_rpm(tmpdir.mkdir('Packages'), 'foo')
+    bar = make_rpm(tmpdir, 'bar')
+
+    reposync._fix_reposync_issues(
+        'foo-1.0.0-1.el7.x86_64.rpm: [Errno 256] No more mirrors to try.\n',
+        str(tmpdir)
+    )
+
+    assert not foo.check()
+    assert bar.check()
+
+
+def _sync_branches(tmpdir, repoid):
+    m = metrics.Metrics()
+    reposync.sync(
+        'yum.conf', str(tmpdir), [repoid], metrics=m, retry=NO_RETRY_DELAY
+    )
+    return [c['branch'] for c in m.report()['sync'][repoid]['commands']]
+
+
+def test_sync_should_only_retry_failed_packages(
+    fake_reposync, tmpdir, make_rpm
+):
+    _, failing = fake_reposync
+    failing['repo_a'] = [
+        'foo-1.0.0-1.el7.x86_64.rpm: [Errno 256] No more mirrors to try.\n',
+        None,
+    ]
+    repo = tmpdir.mkdir('repo_a')
+    foo, bar = make_rpm(repo, 'foo'), make_rpm(repo, 'bar')
+    cache = reposync.MetadataCache(str(tmpdir))
+    metadata = tmpdir.join(reposync.METADATA_CACHE_DIR, 'repo_a', 'repomd')
+    cache.prepare('repo_a')
+    metadata.write('')
+
+    assert _sync_branches(tmpdir, 'repo_a') == ['initial', 'retry-packages']
+    assert not foo.check()
+    assert bar.check()
+    assert metadata.check()
+
+
+def test_sync_should_clear_metadata_cache_when_failures_repeat(
+    fake_reposync, tmpdir
+):
+    _, failing = fake_reposync
+    failing['repo_a'] = [
+        'foo-1.0.0-1.el7.x86_64.rpm: [Errno 256] No more mirrors to try.\n'
+    ]
+
+    with pytest.raises(reposync.ReposyncError):
+        _sync_branches(tmpdir, 'repo_a')
+
+    failing['repo_b'] = ['Cannot retrieve repository metadata', None]
+    assert _sync_branches(tmpdir, 'repo_b') == ['initial', 'clear-cache']
+
+
+def test_retry_policy_delay_should_grow_exponentially():
+    retry = reposync.RetryPolicy(backoff=2, max_backoff=5)
+
+    assert 1 <= retry.delay(1) <= 2
+    assert 2 <= retry.delay(2) <= 4
+    assert 2.5 <= retry.delay(5) <= 5
+
+
+@pytest.fixture
+def upstream(tmpdir):
+    """A yum config with file:// upstream repos, and their sync dir"""
+    repos = {}
+    config = '[main]\n'
+    for repoid in ('repo_a', 'repo_b'):
+        repomd = tmpdir.join('upstream', repoid, 'repodata', 'repomd.xml')
+        repomd.write(repoid, ensure=True)
+        repos[repoid] = repomd
+        config += '[{}]\nbaseurl=file://{}\n'.format(
+            repoid, tmpdir.join('upstream', repoid)
+        )
+    tmpdir.join('yum.conf').write(config)
+    return str(tmpdir.join('yum.conf')), str(tmpdir.mkdir('sync')), repos
+
+
+def test_sync_should_record_a_stamp(fake_reposync, upstream):
+    yum_config, sync_dir, _ = upstream
+    _, failing = fake_reposync
+    failing['repo_b'] = ['error']
+
+    with pytest.raises(reposync.ReposyncError):
+        reposync.sync(
+            yum_config, sync_dir, ['repo_a', 'repo_b'], retry=NO_RETRY_DELAY,
+            repomd_checksums={'repo_a': 'abc'}
+        )
+
+    assert reposync.read_stamp(sync_dir, 'repo_a').repomd_sha256 == 'abc'
+    assert reposync.read_stamp(sync_dir, 'repo_b') is None
+
+
+def test_check_freshness_should_skip_recent_syncs(fake_reposync, upstream):
+    yum_config, sync_dir, _ = upstream
+    reposync.sync(yum_config, sync_dir, ['repo_a'])
+
+    fresh, checksums = reposync.check_freshness(
+        yum_config, sync_dir, ['repo_a', 'repo_b'], max_age=3600
+    )
+
+    assert fresh == set(['repo_a'])
+    assert set(checksums) == set(['repo_b'])
+
+
+def test_check_freshness_should_compare_upstream_checksums(
+    fake_reposync, upstream
+):
+    yum_config, sync_dir, repos = upstream
+    _, checksums = reposync.check_freshness(
+        yum_config, sync_dir, ['repo_a', 'repo_b'], max_age=0
+    )
+    reposync.sync(
+        yum_config, sync_dir, ['repo_a', 'repo_b'],
+        repomd_checksums=checksums
+    )
+    repos['repo_b'].write('changed')
+
+    fresh, checksums = reposync.check_freshness(
+        yum_config, sync_dir, ['repo_a', 'repo_b'], max_age=0
+    )
+
+    assert fresh == set(['repo_a'])
+    assert list(checksums) == ['repo_b']
+
+
+def test_sync_with_dedup_should_store_rpms_in_blobs(
+    fake_reposync, upstream, make_rpm, tmpdir
+):
+    yum_config, sync_dir, _ = upstream
+    for repoid in ('repo_a', 'repo_b'):
+        make_rpm(tmpdir.join('sync').mkdir(repoid), 'foo')
+
+    reposync.sync(yum_config, sync_dir, ['repo_a', 'repo_b'], dedup=True)
+
+    assert os.path.samefile(
+        os.path.join(sync_dir, 'repo_a', 'foo-1.0.0-1.el7.x86_64.rpm'),
+        os.path.join(sync_dir, 'repo_b', 'foo-1.0.0-1.el7.x86_64.rpm'),
+    )
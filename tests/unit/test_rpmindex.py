@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.rpmindex`."""
+
+import hashlib
+
+from mkrepo import rpmindex
+
+
+def test_read_header_should_return_nevra(tmpdir, make_rpm):
+    path = make_rpm(tmpdir, 'foo-bar', '2.0.1', '3.el7', 'noarch', epoch=1)
+
+    assert rpmindex.read_header(str(path)) == dict(
+        name='foo-bar', epoch=1, version='2.0.1', release='3.el7',
+        arch='noarch'
+    )
+
+
+def test_refresh_should_only_reindex_changed_files(tmpdir, make_rpm):
+    repo = tmpdir.mkdir('repo')
+    make_rpm(repo.mkdir('Packages'), 'foo')
+    bar = make_rpm(repo, 'bar')
+
+    with rpmindex.RpmIndex(str(repo)) as index:
+        assert index.refresh() == (2, 0)
+        assert index.refresh() == (0, 0)
+
+        bar.remove()
+        make_rpm(repo, 'baz', payload=b'payload')
+        assert index.refresh() == (1, 1)
+
+        assert [(r.path, r.name) for r in index.rpms()] == [
+            ('Packages/foo-1.0.0-1.el7.x86_64.rpm', 'foo'),
+            ('baz-1.0.0-1.el7.x86_64.rpm', 'baz'),
+        ]
+
+
+def test_checksum_should_be_stored(tmpdir, make_rpm):
+    path = make_rpm(tmpdir, 'foo', payload=b'payload')
+
+    with rpmindex.RpmIndex(str(tmpdir)) as index:
+        index.refresh()
+        rpm, = index.rpms()
+        digest = index.checksum(rpm)
+        rpm, = index.rpms()
+
+    assert digest == hashlib.sha256(path.read_binary()).hexdigest()
+    assert rpm.sha256 == digest
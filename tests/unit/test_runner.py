@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.runner`."""
+
+import time
+
+import pytest
+
+from mkrepo import runner
+
+
+def test_run_command_should_return_status_and_output():
+    lines = []
+
+    ret, out, err = runner.run_command_sync(
+        ['sh', '-c', 'echo out; echo err >&2; exit 3'],
+        line_callback=lambda line, name: lines.append((name, line)),
+    )
+
+    assert (ret, out, err) == (3, 'out\n', 'err\n')
+    assert sorted(lines) == [('err', 'err\n'), ('out', 'out\n')]
+
+
+def test_run_command_should_kill_after_timeout():
+    start = time.time()
+
+    with pytest.raises(runner.CommandTimeout):
+        runner.run_command_sync(
+            ['sh', '-c', 'trap "" TERM; sleep 30'],
+            timeout=0.2,
+            term_timeout=0.2,
+        )
+
+    assert time.time() - start < 5
+
+
+def test_gather_should_run_commands_concurrently():
+    start = time.time()
+
+    results = runner.run(
+        runner.gather(
+            [runner.run_command(['sleep', '0.5']) for _ in range(4)],
+            jobs=4
+        )
+    )
+
+    assert [r.code for r in results] == [0] * 4
+    assert time.time() - start < 1.5
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.server`."""
+
+import asyncio
+import time
+from functools import partial, wraps
+
+import pytest
+
+from mkrepo import reposetup_core
+from mkrepo import server
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    calls = []
+
+    @wraps(reposetup_core.reposetup)
+    def reposetup(dest, **kwargs):
+        calls.append(dest)
+        time.sleep(0.3)
+        if dest == 'bad':
+            raise reposetup_core.ReposetupError('boom')
+
+    monkeypatch.setattr(reposetup_core, 'reposetup', reposetup)
+    return calls
+
+
+def _params(dest):
+    return dict(
+        dest=dest, sync_dir='/sync', sync=True, yum_config=None,
+        repoman_config=None, custom_source=[], lock_timeout=10,
+    )
+
+
+def _run(socket_path, coro_factory):
+    async def main():
+        srv = server.Server(socket_path, jobs=2)
+        await srv.start()
+        try:
+            return srv, await coro_factory()
+        finally:
+            await srv.close()
+
+    return asyncio.run(main())
+
+
+def _requests(socket_path, *dests):
+    async def send_all():
+        loop = asyncio.get_event_loop()
+        return await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    None,
+                    partial(
+                        server.request, socket_path, 'reposetup',
+                        **_params(dest)
+                    )
+                )
+                for dest in dests
+            ],
+            return_exceptions=True
+        )
+
+    return send_all
+
+
+def test_identical_requests_should_be_coalesced(tmpdir, builds):
+    socket_path = str(tmpdir.join('mkrepo.sock'))
+
+    srv, responses = _run(
+        socket_path, _requests(socket_path, 'a', 'a', 'a', 'b')
+    )
+
+    assert responses == [dict(ok=True)] * 4
+    assert sorted(builds) in (['a', 'a', 'b'], ['a', 'b'])
+    assert srv.stats['builds'] + srv.stats['coalesced'] == 4
+
+
+def test_requests_should_not_join_a_running_build(tmpdir, builds):
+    socket_path = str(tmpdir.join('mkrepo.sock'))
+
+    async def send():
+        first = asyncio.ensure_future(_requests(socket_path, 'a')())
+        await asyncio.sleep(0.1)
+        return await asyncio.gather(
+            first, _requests(socket_path, 'a', 'a', 'a')()
+        )
+
+    srv, responses = _run(socket_path, send)
+
+    assert responses == [[dict(ok=True)], [dict(ok=True)] * 3]
+    assert builds == ['a', 'a']
+    assert srv.stats == dict(requests=4, builds=2, coalesced=2)
+
+
+def test_failed_builds_should_be_reported(tmpdir, builds):
+    socket_path = str(tmpdir.join('mkrepo.sock'))
+
+    _, (response, ) = _run(socket_path, _requests(socket_path, 'bad'))
+
+    assert isinstance(response, server.ServerError)
+    assert 'boom' in str(response)
+
+
+def test_unknown_params_should_be_rejected(tmpdir, builds):
+    socket_path = str(tmpdir.join('mkrepo.sock'))
+
+    async def send():
+        return await asyncio.get_event_loop().run_in_executor(
+            None, partial(
+                server.request, socket_path, 'reposetup', destination='a'
+            )
+        )
+
+    with pytest.raises(server.ServerError):
+        _run(socket_path, send)
+    assert builds == []
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.sourcecache`."""
+
+import hashlib
+import os
+import threading
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+import pytest
+
+from mkrepo import sourcecache
+
+REPOMD = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo">
+  <data type="primary">
+    <location href="repodata/primary.xml"/>
+  </data>
+</repomd>
+"""
+
+PRIMARY = """<?xml version="1.0" encoding="UTF-8"?>
+<metadata xmlns="http://linux.duke.edu/metadata/common">
+  <package type="rpm">
+    <checksum type="sha256" pkgid="YES">{sha256}</checksum>
+    <size package="{size}"/>
+    <location href="Packages/{name}"/>
+  </package>
+</metadata>
+"""
+
+
+@pytest.fixture
+def http_server(tmpdir):
+    """Serve ``tmpdir/www`` over HTTP, record the status of every GET"""
+    root = tmpdir.mkdir('www')
+    requests = []
+
+    class Handler(SimpleHTTPRequestHandler):
+        def log_request(self, code='-', size='-'):
+            requests.append((self.path, int(code)))
+
+    server = HTTPServer(
+        ('127.0.0.1', 0), partial(Handler, directory=str(root))
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}'.format(server.server_port), root, requests
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _publish_repo(root, rpm):
+    repo = root.mkdir('repo')
+    repo.join('Packages', rpm.basename).write_binary(
+        rpm.read_binary(), ensure=True
+    )
+    repo.join('repodata', 'repomd.xml').write(REPOMD, ensure=True)
+    repo.join('repodata', 'primary.xml').write(
+        PRIMARY.format(
+            sha256=hashlib.sha256(rpm.read_binary()).hexdigest(),
+            size=rpm.size(), name=rpm.basename
+        )
+    )
+    return repo
+
+
+def test_resolve_should_mirror_local_dirs_once(tmpdir, make_rpm):
+    source = tmpdir.mkdir('source')
+    rpm = make_rpm(source, 'foo')
+    sync_dir = str(tmpdir.mkdir('sync'))
+
+    resolved, paths = sourcecache.resolve(
+        sync_dir, [str(source) + ':latest', 'conf:/not/cached']
+    )
+
+    entry = sourcecache.entry_path(sync_dir, str(source))
+    assert resolved == [entry + ':latest', 'conf:/not/cached']
+    assert paths == [entry]
+    assert os.path.isfile(os.path.join(entry, rpm.basename))
+
+    parsed = sourcecache.sources_mod.parse_source(str(source))
+    assert not sourcecache.refresh(parsed, entry, sync_dir)
+
+    rpm.remove()
+    make_rpm(source, 'bar')
+    assert sourcecache.refresh(parsed, entry, sync_dir)
+    assert sorted(
+        f for f in os.listdir(entry) if f.endswith('.rpm')
+    ) == ['bar-1.0.0-1.el7.x86_64.rpm']
+
+
+def test_resolve_should_fetch_repo_urls_only_when_modified(
+    http_server, tmpdir, make_rpm
+):
+    url, root, requests = http_server
+    rpm = make_rpm(tmpdir.mkdir('build'), 'foo')
+    _publish_repo(root, rpm)
+    sync_dir = str(tmpdir.mkdir('sync'))
+
+    resolved, _ = sourcecache.resolve(sync_dir, [url + '/repo'])
+
+    entry = sourcecache.entry_path(sync_dir, url + '/repo')
+    assert resolved == [entry]
+    cached = os.path.join(entry, 'Packages', rpm.basename)
+    with open(cached, 'rb') as f:
+        assert f.read() == rpm.read_binary()
+    assert (
+        '/repo/Packages/{}'.format(rpm.basename), 200
+    ) in requests
+
+    del requests[:]
+    assert sourcecache.resolve(sync_dir, [url + '/repo']) == (
+        [entry], [entry]
+    )
+    assert requests == [('/repo/repodata/repomd.xml', 304)]
+
+
+def test_resolve_should_not_cache_bad_repos(http_server, tmpdir, make_rpm):
+    url, root, _ = http_server
+    rpm = make_rpm(tmpdir.mkdir('build'), 'foo')
+    repo = _publish_repo(root, rpm)
+    repo.join('Packages', rpm.basename).write('corrupted')
+    sync_dir = str(tmpdir.mkdir('sync'))
+
+    resolved, paths = sourcecache.resolve(
+        sync_dir, [url + '/repo', url + '/missing']
+    )
+
+    assert resolved == [url + '/repo', url + '/missing']
+    assert paths == []
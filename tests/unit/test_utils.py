@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.utils`."""
+
+import sys
+import threading
+import time
+
+import pytest
+
+from mkrepo import utils
+
+
+@pytest.fixture
+def held_lock(tmpdir):
+    lock = utils.Flock(str(tmpdir.join('l.lock')))
+    lock.acquire()
+    yield lock
+    lock.release()
+
+
+def _run_in_thread(func):
+    result = {}
+
+    def target():
+        try:
+            func()
+        except Exception as e:
+            result['error'] = e
+
+    t = threading.Thread(target=target)
+    t.start()
+    t.join()
+    return result
+
+
+@pytest.mark.parametrize('in_thread', [False, True])
+def test_lock_files_should_wake_up_when_lock_is_released(
+    tmpdir, held_lock, in_thread
+):
+    threading.Timer(0.2, held_lock.release).start()
+
+    def lock():
+        with utils.LockFiles([str(tmpdir)], timeout=30, lock_name='l.lock'):
+            pass
+
+    start = time.time()
+    if in_thread:
+        assert 'error' not in _run_in_thread(lock)
+    else:
+        lock()
+    assert time.time() - start < 2
+
+
+@pytest.mark.parametrize('in_thread', [False, True])
+def test_lock_files_should_fail_after_timeout(tmpdir, held_lock, in_thread):
+    def lock():
+        with utils.LockFiles([str(tmpdir)], timeout=0.3, lock_name='l.lock'):
+            pass
+
+    if in_thread:
+        result = _run_in_thread(lock)
+        assert isinstance(result['error'], utils.TimerException)
+    else:
+        with pytest.raises(utils.TimerException):
+            lock()
+
+
+def test_lock_files_should_allow_concurrent_shared_locks(tmpdir):
+    path = str(tmpdir)
+    with utils.LockFiles([], shared_paths=[path], lock_name='l.lock'):
+        with utils.LockFiles(
+            [], shared_paths=[path], timeout=0.3, lock_name='l.lock'
+        ):
+            pass
+
+        with pytest.raises(utils.TimerException):
+            with utils.LockFiles([path], timeout=0.3, lock_name='l.lock'):
+                pass
+
+
+def test_lock_files_plan_should_prefer_exclusive_locks():
+    lock_files = utils.LockFiles(['/b', '/c'], shared_paths=['/a', '/b'])
+    assert lock_files.plan == [('/a', True), ('/b', False), ('/c', False)]
+
+
+def test_lock_files_should_downgrade_and_release_single_locks(tmpdir):
+    a, b = str(tmpdir.mkdir('a')), str(tmpdir.mkdir('b'))
+    with utils.LockFiles([a, b], lock_name='l.lock') as locks:
+        locks.downgrade(a)
+        with utils.LockFiles(
+            [], shared_paths=[a], timeout=0.3, lock_name='l.lock'
+        ):
+            pass
+
+        locks.release(b)
+        with utils.LockFiles([b], timeout=0.3, lock_name='l.lock'):
+            pass
+        with pytest.raises(utils.TimerException):
+            with utils.LockFiles([a], timeout=0.3, lock_name='l.lock'):
+                pass
+
+
+def test_lock_files_should_upgrade_shared_locks(tmpdir):
+    a, b, c = (str(tmpdir.mkdir(name)) for name in 'abc')
+    with utils.LockFiles(
+        [c], shared_paths=[a, b], lock_name='l.lock'
+    ) as locks:
+        locks.upgrade([b, c])
+        assert locks.plan == [(a, True), (b, False), (c, False)]
+        with utils.LockFiles(
+            [], shared_paths=[a], timeout=0.3, lock_name='l.lock'
+        ):
+            pass
+        for path in (b, c):
+            with pytest.raises(utils.TimerException):
+                with utils.LockFiles(
+                    [], shared_paths=[path], timeout=0.3, lock_name='l.lock'
+                ):
+                    pass
+
+
+def test_run_command_should_not_use_a_shell():
+    ret, out, _ = utils.run_command(['echo', '"$HOME" `id`'])
+    assert ret == 0
+    assert out == '"$HOME" `id`\n'
+
+
+def test_run_command_should_replace_invalid_utf8():
+    ret, out, _ = utils.run_command(
+        [sys.executable, '-c', 'import os; os.write(1, b"a\\xffb\\n")']
+    )
+    assert ret == 0
+    assert out == u'a\ufffdb\n'
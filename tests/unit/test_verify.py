@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `mkrepo.verify`."""
+
+import hashlib
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from mkrepo import blobstore
+from mkrepo import cli
+from mkrepo import reposetup_core
+from mkrepo import reposync
+from mkrepo import verify
+
+REPOMD = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo">
+  <data type="primary">
+    <location href="repodata/abc-primary.xml"/>
+  </data>
+</repomd>
+"""
+
+PRIMARY_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<metadata xmlns="http://linux.duke.edu/metadata/common">
+"""
+
+PACKAGE = """<package type="rpm">
+  <checksum type="sha256" pkgid="YES">{sha256}</checksum>
+  <size package="{size}"/>
+  <location href="Packages/{name}"/>
+</package>
+"""
+
+
+def _sync_dir(tmpdir, make_rpm, names=('foo', 'bar', 'baz')):
+    """A synced repo_a, with its primary metadata in the metadata cache"""
+    sync_dir = tmpdir.mkdir('sync')
+    packages = sync_dir.mkdir('repo_a').mkdir('Packages')
+    primary = PRIMARY_HEADER
+    for name in names:
+        rpm = make_rpm(packages, name, payload=b'x' * 100)
+        primary += PACKAGE.format(
+            sha256=hashlib.sha256(rpm.read_binary()).hexdigest(),
+            size=rpm.size(), name=rpm.basename
+        )
+    cache_dir = sync_dir.join(reposync.METADATA_CACHE_DIR, 'repo_a')
+    cache_dir.join('repomd.xml').write(REPOMD, ensure=True)
+    cache_dir.join('abc-primary.xml').write(primary + '</metadata>\n')
+    reposync.write_stamp(str(sync_dir), 'repo_a')
+    return sync_dir
+
+
+def _corrupt(rpm, truncate=False):
+    content = rpm.read_binary()
+    if truncate:
+        rpm.write_binary(content[:-10])
+    else:
+        rpm.write_binary(content[:-1] + b'y')
+
+
+def test_verify_should_remove_corrupt_rpms(tmpdir, make_rpm):
+    sync_dir = _sync_dir(tmpdir, make_rpm)
+    packages = sync_dir.join('repo_a', 'Packages')
+    _corrupt(packages.join('foo-1.0.0-1.el7.x86_64.rpm'))
+    _corrupt(packages.join('bar-1.0.0-1.el7.x86_64.rpm'), truncate=True)
+    make_rpm(packages, 'unknown')
+
+    report, = verify.verify(str(sync_dir), None, ['repo_a'])
+
+    assert report == verify.VerifyReport(
+        'repo_a', 3, 2, [
+            'Packages/bar-1.0.0-1.el7.x86_64.rpm',
+            'Packages/foo-1.0.0-1.el7.x86_64.rpm',
+        ], 1
+    )
+    assert sorted(os.listdir(str(packages))) == [
+        'baz-1.0.0-1.el7.x86_64.rpm', 'unknown-1.0.0-1.el7.x86_64.rpm'
+    ]
+    assert reposync.read_stamp(str(sync_dir), 'repo_a') is None
+
+
+def test_verify_should_only_hash_changed_rpms(tmpdir, make_rpm):
+    sync_dir = _sync_dir(tmpdir, make_rpm)
+
+    first, = verify.verify(str(sync_dir), None, ['repo_a'], jobs=2)
+    second, = verify.verify(str(sync_dir), None, ['repo_a'], jobs=2)
+    _corrupt(sync_dir.join('repo_a', 'Packages', 'baz-1.0.0-1.el7.x86_64.rpm'))
+    third, = verify.verify(str(sync_dir), None, ['repo_a'], remove=False)
+
+    assert (first.checked, first.hashed, first.corrupt) == (3, 3, [])
+    assert (second.checked, second.hashed, second.corrupt) == (3, 0, [])
+    assert (third.hashed, third.corrupt) == (
+        1, ['Packages/baz-1.0.0-1.el7.x86_64.rpm']
+    )
+    assert reposync.read_stamp(str(sync_dir), 'repo_a') is not None
+
+
+def test_verify_should_remove_corrupt_blobs(tmpdir, make_rpm):
+    sync_dir = _sync_dir(tmpdir, make_rpm, names=('foo',))
+    rpm = sync_dir.join('repo_a', 'Packages', 'foo-1.0.0-1.el7.x86_64.rpm')
+    blobstore.dedup(str(sync_dir), [str(sync_dir.join('repo_a'))])
+    blob = blobstore.BlobStore(str(sync_dir)).path(
+        hashlib.sha256(rpm.read_binary()).hexdigest()
+    )
+    with open(str(rpm), 'r+b') as f:
+        f.write(b'corrupt')
+
+    report, = verify.verify(str(sync_dir), None, ['repo_a'])
+
+    assert report.corrupt == ['Packages/foo-1.0.0-1.el7.x86_64.rpm']
+    assert not rpm.check()
+    assert not os.path.exists(blob)
+
+
+def test_verify_command_should_fail_on_corrupt_rpms(tmpdir, make_rpm):
+    sync_dir = _sync_dir(tmpdir, make_rpm)
+    yum_config = tmpdir.join('yum.conf')
+    yum_config.write('[main]\n[repo_a]\n')
+    args = [
+        'verify', '--no-remove', '--sync-dir', str(sync_dir),
+        '--yum-config', str(yum_config)
+    ]
+
+    result = CliRunner().invoke(cli.cli, args)
+    assert result.exit_code == 0, result.output
+    assert 'repo_a: checked 3 RPMs, hashed 3, 0 corrupt' in result.output
+
+    _corrupt(sync_dir.join('repo_a', 'Packages', 'foo-1.0.0-1.el7.x86_64.rpm'))
+    result = CliRunner().invoke(cli.cli, args)
+    assert result.exit_code == 1
+    assert 'corrupt: Packages/foo-1.0.0-1.el7.x86_64.rpm' in result.output
+
+
+def test_verify_caches_should_sync_corrupt_repoids_again(
+    tmpdir, make_rpm, monkeypatch
+):
+    sync_dir = _sync_dir(tmpdir, make_rpm)
+    rpm = sync_dir.join('repo_a', 'Packages', 'foo-1.0.0-1.el7.x86_64.rpm')
+    content = rpm.read_binary()
+    synced = []
+
+    def do_sync(yum_config, sync_dir, repoids, **kwargs):
+        synced.extend(repoids)
+        rpm.write_binary(content)
+
+    monkeypatch.setattr(reposetup_core, 'do_sync', do_sync)
+    _corrupt(rpm)
+    with pytest.raises(verify.VerifyError) as e:
+        reposetup_core.verify_caches(None, str(sync_dir), ['repo_a'])
+    assert e.value.repoids == ['repo_a']
+    assert not rpm.check()
+
+    rpm.write_binary(content)
+    _corrupt(rpm)
+    reposetup_core.verify_caches(
+        None, str(sync_dir), ['repo_a'], sync_kwargs={}
+    )
+    assert synced == ['repo_a']
+    assert rpm.read_binary() == content